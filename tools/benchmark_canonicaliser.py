@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Measures canonicaliser throughput over the bundled datasets.
+
+Every query in data/*.json that has a matching *-fields.txt file is passed
+through the stages of make_canonical, timing each one. The report gives
+queries/sec and time per stage for each dataset, plus percentiles of the
+per-query time grouped by query length (tokens) and nesting depth. Saving
+reports and passing an old one to --compare shows changes between runs.
+"""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import platform
+import time
+
+from canonicaliser import read_schema, example_jobs, add_semicolon, standardise_blank_spaces, capitalise, standardise_aliases, order_query
+from json_stream import read_examples
+
+STAGES = ['add_semicolon', 'standardise_blank_spaces', 'capitalise', 'standardise_aliases', 'order_query']
+LENGTH_BUCKETS = [25, 50, 100, 200]
+
+def run_stages(query, schema, variables):
+    times = []
+    start = time.perf_counter()
+    query = add_semicolon(query)
+    times.append(time.perf_counter())
+    query = standardise_blank_spaces(query)
+    times.append(time.perf_counter())
+    query = capitalise(query, variables)
+    times.append(time.perf_counter())
+    query = standardise_aliases(query, schema)
+    times.append(time.perf_counter())
+    query = order_query(query, variables)
+    times.append(time.perf_counter())
+    durations = [end - begin for begin, end in zip([start] + times, times)]
+    return query, durations
+
+def query_depth(tokens):
+    """Number of nested SELECTs, counting brackets that open a subquery."""
+    depth = 1
+    max_depth = 1
+    stack = []
+    for i, token in enumerate(tokens):
+        if token.endswith('('):
+            opens = i + 1 < len(tokens) and tokens[i + 1] == 'SELECT'
+            stack.append(opens)
+            if opens:
+                depth += 1
+                max_depth = max(max_depth, depth)
+        elif token == ')' and len(stack) > 0:
+            if stack.pop():
+                depth -= 1
+    return max_depth
+
+def length_bucket(length):
+    low = 0
+    for high in LENGTH_BUCKETS:
+        if length < high:
+            return "{}-{}".format(low, high - 1)
+        low = high
+    return "{}+".format(low)
+
+def percentiles(values):
+    values = sorted(values)
+    summary = {'count': len(values)}
+    for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+        pos = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+        summary[name + '_ms'] = values[pos] * 1000
+    return summary
+
+def benchmark_dataset(json_filename, fields_filename, repeat):
+    schema = read_schema(fields_filename)
+    jobs = []
+    with open(json_filename) as input_file:
+        for data in read_examples(input_file):
+            jobs.extend(example_jobs(data))
+
+    stage_totals = [0.0 for _ in STAGES]
+    per_query = []
+    for _ in range(repeat):
+        for query, variables in jobs:
+            canonical, durations = run_stages(query, schema, variables)
+            for i, duration in enumerate(durations):
+                stage_totals[i] += duration
+            tokens = canonical.split()
+            per_query.append((sum(durations), len(tokens), query_depth(tokens)))
+
+    total = sum(stage_totals)
+    by_length = {}
+    by_depth = {}
+    for duration, length, depth in per_query:
+        by_length.setdefault(length_bucket(length), []).append(duration)
+        by_depth.setdefault(str(depth), []).append(duration)
+    return {
+        'queries': len(jobs),
+        'repeat': repeat,
+        'seconds': total,
+        'queries_per_sec': len(per_query) / total if total > 0 else None,
+        'stage_seconds': {stage: value for stage, value in zip(STAGES, stage_totals)},
+        'by_length': {bucket: percentiles(values) for bucket, values in by_length.items()},
+        'by_depth': {bucket: percentiles(values) for bucket, values in by_depth.items()},
+    }
+
+def find_datasets(data_dir, names):
+    datasets = []
+    for json_filename in sorted(glob.glob(os.path.join(data_dir, '*.json'))):
+        name = os.path.basename(json_filename)[:-len('.json')]
+        fields_filename = os.path.join(data_dir, name + '-fields.txt')
+        if os.path.exists(fields_filename) and (names is None or name in names):
+            datasets.append((name, json_filename, fields_filename))
+    return datasets
+
+def format_number(value, spec, suffix=''):
+    return "n/a" if value is None else format(value, spec) + suffix
+
+def format_change(before, after):
+    """Percentage change, or n/a if either run is missing or took no time."""
+    if before is None or after is None or before == 0:
+        return "n/a"
+    return "{:+.1f}%".format(100 * (after - before) / before)
+
+def stage_times(report, names):
+    """Seconds per query for each stage, over the named datasets only."""
+    seconds = {stage: 0.0 for stage in STAGES}
+    count = 0
+    for name in names:
+        result = report['datasets'][name]
+        count += result['queries'] * result.get('repeat', 1)
+        for stage in STAGES:
+            seconds[stage] += result.get('stage_seconds', {}).get(stage, 0.0)
+    return {stage: (value / count if count > 0 else None) for stage, value in seconds.items()}
+
+def compare(old, new):
+    shared = sorted(name for name in new['datasets'] if name in old['datasets'])
+    print("{:<14} {:>12} {:>12} {:>8}".format("dataset", "old q/s", "new q/s", "change"))
+    for name in shared:
+        before = old['datasets'][name].get('queries_per_sec')
+        after = new['datasets'][name].get('queries_per_sec')
+        print("{:<14} {:>12} {:>12} {:>8}".format(name, format_number(before, '.1f'), format_number(after, '.1f'), format_change(before, after)))
+    # Totals would differ just because the runs covered different datasets,
+    # so stages are compared per query over the datasets both runs have.
+    old_stages = stage_times(old, shared)
+    new_stages = stage_times(new, shared)
+    print("Time per query in each stage, over {} shared datasets:".format(len(shared)))
+    for stage in STAGES:
+        before = old_stages[stage]
+        after = new_stages[stage]
+        before_ms = None if before is None else before * 1000
+        after_ms = None if after is None else after * 1000
+        print("{:<26} {:>9} -> {:>9} {:>8}".format(stage, format_number(before_ms, '.4f', 'ms'), format_number(after_ms, '.4f', 'ms'), format_change(before, after)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Times the canonicaliser, stage by stage, over every dataset with a fields file.')
+    parser.add_argument('--data', help='Directory containing the json and fields files.', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'))
+    parser.add_argument('--datasets', help='Comma separated names of datasets to run (default all).')
+    parser.add_argument('--repeat', help='Number of times to run over each dataset.', type=int, default=1)
+    parser.add_argument('--output', help='Save the report as json to this file.')
+    parser.add_argument('--compare', help='A report from an earlier run to compare against.')
+    args = parser.parse_args()
+
+    names = None
+    if args.datasets is not None:
+        names = set(args.datasets.split(","))
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'datasets': {},
+    }
+    total_queries = 0
+    total_seconds = 0.0
+    total_stages = {stage: 0.0 for stage in STAGES}
+    for name, json_filename, fields_filename in find_datasets(args.data, names):
+        result = benchmark_dataset(json_filename, fields_filename, args.repeat)
+        report['datasets'][name] = result
+        total_queries += result['queries'] * args.repeat
+        total_seconds += result['seconds']
+        for stage in STAGES:
+            total_stages[stage] += result['stage_seconds'][stage]
+        print("{:<14} {:>6} queries {:>8.2f}s {:>10} queries/sec".format(name, result['queries'], result['seconds'], format_number(result['queries_per_sec'], '.1f')))
+    report['total'] = {
+        'queries': total_queries,
+        'seconds': total_seconds,
+        'queries_per_sec': total_queries / total_seconds if total_seconds > 0 else None,
+        'stage_seconds': total_stages,
+    }
+    print("Total: {} queries in {:.2f}s ({} queries/sec)".format(total_queries, total_seconds, format_number(report['total']['queries_per_sec'], '.1f')))
+    for stage in STAGES:
+        print("  {:<26} {:.3f}s".format(stage, total_stages[stage]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4, sort_keys=True)
+    if args.compare is not None:
+        with open(args.compare) as old_file:
+            compare(json.load(old_file), report)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Loads a database dump into a new SQLite file, quickly.
+
+Two kinds of dump are understood:
+- mysqldump output (e.g. data/geography-db.sql). Tables are created from
+  its CREATE TABLE statements and filled from its INSERT statements. Any
+  KEY / UNIQUE KEY lines become indexes.
+- Files with one fact per line, as in data/restaurants-db.txt:
+      RESTAURANT(225, "denny's restaurant", "american", "vallejo", 2.0)
+  The tables must be created by a schema file (--schema) holding CREATE
+  TABLE statements, and values are given in column order.
+
+The dump is read one statement or line at a time, rows are added with
+executemany in batches, everything happens in a single transaction, and
+indexes are only created once the data is in.
+
+Usage:
+    bulk_load_sqlite.py ../data/geography-db.sql geography.sqlite
+    bulk_load_sqlite.py ../data/restaurants-db.txt restaurants.sqlite --schema restaurants.sql
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import sqlite3
+
+BATCH_SIZE = 10000
+
+TOKEN_PATTERN = re.compile(r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")|([^,()'"\s;]+)|([(),;])|(\S)""", re.DOTALL)
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+ESCAPE_PATTERN = re.compile(r"\\(.)", re.DOTALL)
+
+def unquote(token):
+    quote = token[0]
+    text = token[1:-1]
+    if '\\' in text or quote + quote in text:
+        text = text.replace(quote + quote, quote)
+        text = ESCAPE_PATTERN.sub(lambda match: ESCAPES.get(match.group(1), match.group(1)), text)
+    return text
+
+def bare_value(token):
+    if token.upper() == 'NULL':
+        return None
+    if token[0] in '-.0123456789':
+        try:
+            return int(token)
+        except ValueError:
+            try:
+                return float(token)
+            except ValueError:
+                pass
+    return token
+
+def parse_tuples(text, pos=0):
+    """Parse a series of bracketed, comma separated values, e.g.
+    "(1,'a'),(2,'b')", returning a list of tuples."""
+    rows = []
+    row = None
+    for quoted, bare, punct, other in TOKEN_PATTERN.findall(text, pos):
+        if quoted or bare:
+            if row is None:
+                raise ValueError("Value outside brackets in: " + text[pos:pos + 50])
+            row.append(unquote(quoted) if quoted else bare_value(bare))
+        elif punct == '(':
+            if row is not None:
+                raise ValueError("Nested brackets in: " + text[pos:pos + 50])
+            row = []
+        elif punct == ')':
+            if row is None:
+                raise ValueError("Unmatched ')' in: " + text[pos:pos + 50])
+            rows.append(tuple(row))
+            row = None
+        elif other:
+            raise ValueError("Unable to read {} in: {}".format(other, text[pos:pos + 50]))
+    if row is not None:
+        raise ValueError("Missing ')' in: " + text[pos:pos + 50])
+    return rows
+
+def mysql_statements(dump_file):
+    """Yield each statement in a mysqldump file, without comments."""
+    lines = []
+    for line in dump_file:
+        stripped = line.strip()
+        if len(lines) == 0 and (stripped == '' or stripped.startswith('--') or stripped.startswith('/*')):
+            continue
+        lines.append(line)
+        if stripped.endswith(';'):
+            yield ''.join(lines).strip()
+            lines = []
+
+INT_WIDTH_PATTERN = re.compile(r"\b(tinyint|smallint|mediumint|int|integer|bigint)\(\d+\)", re.IGNORECASE)
+MYSQL_ONLY_PATTERN = re.compile(r"\s+(unsigned|AUTO_INCREMENT|CHARACTER SET \w+|COLLATE \w+)\b", re.IGNORECASE)
+KEY_PATTERN = re.compile(r'^\s*(UNIQUE |FULLTEXT )?KEY\s+"([^"]+)"\s*\((.*)\),?\s*$', re.IGNORECASE)
+
+def convert_create(statement):
+    """Turn a MySQL CREATE TABLE into SQLite, returning it with the
+    statements to create its keys as indexes."""
+    statement = statement.replace('`', '"')
+    statement = statement[:statement.rindex(')') + 1]
+    table = re.match(r'CREATE TABLE\s+"([^"]+)"', statement).group(1)
+    lines = []
+    indexes = []
+    for line in statement.split('\n'):
+        match = KEY_PATTERN.match(line)
+        if match is not None:
+            # Drop MySQL prefix lengths, e.g. "name"(10)
+            columns = re.sub(r'\(\d+\)', '', match.group(3))
+            unique = 'UNIQUE ' if match.group(1) is not None and match.group(1).strip().upper() == 'UNIQUE' else ''
+            indexes.append('CREATE {}INDEX "{}_{}" ON "{}" ({})'.format(unique, table, match.group(2), table, columns))
+            continue
+        line = INT_WIDTH_PATTERN.sub(r'\1', line)
+        line = MYSQL_ONLY_PATTERN.sub('', line)
+        lines.append(line)
+    # Removing keys can leave a comma before the closing bracket
+    if len(lines) > 1 and lines[-2].rstrip().endswith(','):
+        lines[-2] = lines[-2].rstrip()[:-1]
+    return table, '\n'.join(lines), indexes
+
+def read_mysql_dump(dump_file):
+    """Yield ('create', table, sql, indexes) and ('rows', table, rows) for
+    the statements in a mysqldump file."""
+    for statement in mysql_statements(dump_file):
+        upper = statement[:20].upper()
+        if upper.startswith('CREATE TABLE'):
+            yield ('create',) + convert_create(statement)
+        elif upper.startswith('INSERT INTO'):
+            match = re.match(r'INSERT INTO\s+[`"]?([^`"\s]+)[`"]?\s*(\([^)]*\))?\s*VALUES\s*', statement, re.IGNORECASE)
+            yield ('rows', match.group(1), parse_tuples(statement, match.end()))
+
+def read_facts(fact_file):
+    """Yield ('rows', table, [row]) for each TABLE(value, ...) line."""
+    for line in fact_file:
+        line = line.strip()
+        if line == '':
+            continue
+        split_at = line.index('(')
+        yield ('rows', line[:split_at].strip(), parse_tuples(line, split_at))
+
+def split_statements(text):
+    return [statement.strip() for statement in text.split(';') if statement.strip() != '']
+
+def load(output_path, items, schema=(), extra_indexes=(), batch_size=BATCH_SIZE):
+    """Create a new SQLite file from items (as yielded by read_mysql_dump or
+    read_facts), running the schema statements first."""
+    tmp_path = output_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path, isolation_level=None)
+    loaded = False
+    try:
+        conn.execute("PRAGMA journal_mode = OFF")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("BEGIN")
+        for statement in schema:
+            conn.execute(statement)
+
+        indexes = []
+        pending = {}
+        counts = {}
+        def flush(table):
+            rows = pending.pop(table)
+            conn.executemany('INSERT INTO "{}" VALUES ({})'.format(table, ','.join('?' * len(rows[0]))), rows)
+            counts[table] = counts.get(table, 0) + len(rows)
+
+        for item in items:
+            if item[0] == 'create':
+                _, table, sql, table_indexes = item
+                conn.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+                conn.execute(sql)
+                indexes.extend(table_indexes)
+            else:
+                _, table, rows = item
+                for row in rows:
+                    # Rows of a different length need their own executemany
+                    batch = pending.setdefault(table, [])
+                    if len(batch) > 0 and len(batch[0]) != len(row):
+                        flush(table)
+                        batch = pending.setdefault(table, [])
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        flush(table)
+        for table in list(pending):
+            flush(table)
+
+        for statement in indexes + list(extra_indexes):
+            conn.execute(statement)
+        conn.execute("COMMIT")
+        loaded = True
+    finally:
+        # Leave no half-built file behind if anything above fails
+        conn.close()
+        if not loaded:
+            os.remove(tmp_path)
+    os.replace(tmp_path, output_path)
+    return counts
+
+def index_statement(spec):
+    """'TABLE.COLUMN' to the statement creating an index on it."""
+    table, column = spec.split('.')
+    return 'CREATE INDEX "{}_{}" ON "{}" ("{}")'.format(table, column, table, column)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load a mysqldump file, or a file of TABLE(value, ...) facts, into a new SQLite database.')
+    parser.add_argument('dump', help='File to load.')
+    parser.add_argument('output', help='SQLite file to create (replaced if it exists).')
+    parser.add_argument('--schema', help='File of CREATE TABLE statements to run first (needed for fact files).')
+    parser.add_argument('--index', help='Create an index on TABLE.COLUMN after loading (can be repeated).', action='append', default=[])
+    parser.add_argument('--facts', help='Read the dump as TABLE(value, ...) lines, even if it does not end in .txt.', action='store_true')
+    args = parser.parse_args()
+
+    schema = []
+    if args.schema is not None:
+        with open(args.schema) as schema_file:
+            schema = split_statements(schema_file.read())
+    with open(args.dump) as dump_file:
+        if args.facts or args.dump.endswith('.txt'):
+            items = read_facts(dump_file)
+        else:
+            items = read_mysql_dump(dump_file)
+        counts = load(args.output, items, schema, [index_statement(spec) for spec in args.index])
+    for table in sorted(counts):
+        print(table, counts[table])
@@ -15,6 +15,21 @@ import string
 import json
 import sys
 import argparse
+import bisect
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import sqlite3
+
+import common
+import json_stream
+import schema_index
+import sql_lexer
+from common import SQL_RESERVED_WORDS, file_hash
+from json_stream import read_examples, write_examples
+from schema_index import as_index, load_schema
+from sql_lexer import lex, update_quotes, update_token_quotes
 
 LOGGING = False
 
@@ -43,207 +58,126 @@ LOGGING = False
 ###  - We assume AND and OR are not mixed without brackets to indicate
 ###    precedence (it is legal SQL to do so, though a bad idea anyway).
 
-SQL_RESERVED_WORDS = {w for w in """ACCOUNT ACTION ADD AFTER AGAINST AGGREGATE
-ALGORITHM ALL ALTER ALWAYS ANALYSE ANALYZE AND ANY AS ASC ASCII ASENSITIVE AT
-AUTOEXTEND_SIZE AUTO_INCREMENT AVG AVG_ROW_LENGTH BACKUP BEFORE BEGIN BETWEEN
-BIGINT BINARY BINLOG BIT BLOB BLOCK BOOL BOOLEAN BOTH BTREE BY BYTE CACHE CALL
-CASCADE CASCADED CASE CATALOG_NAME CESSIBLE CHAIN CHANGE CHANGED CHANNEL CHAR
-CHARACTER CHARSET CHECK CHECKSUM CIPHER CLASS_ORIGIN CLIENT CLOSE COALESCE CODE
-COLLATE COLLATION COLUMN COLUMNS COLUMN_FORMAT COLUMN_NAME COMMENT COMMIT
-COMMITTED COMPACT COMPLETION COMPRESSED COMPRESSION CONCURRENT CONDITION
-CONNECTION CONSISTENT CONSTRAINT CONSTRAINT_CATALOG CONSTRAINT_NAME
-CONSTRAINT_SCHEMA CONTAINS CONTEXT CONTINUE CONVERT CPU CREATE CROSS CUBE
-CURRENT CURRENT_DATE CURRENT_TIME CURRENT_TIMESTAMP CURRENT_USER CURSOR
-CURSOR_NAME DATA DATABASE DATABASES DATAFILE DATE DATETIME DAY DAY_HOUR
-DAY_MICROSECOND DAY_MINUTE DAY_SECOND DEALLOCATE DEC DECIMAL DECLARE DEFAULT
-DEFAULT_AUTH DEFINER DELAYED DELAY_KEY_WRITE DELETE DESC DESCRIBE DES_KEY_FILE
-DETERMINISTIC DIAGNOSTICS DIRECTORY DISABLE DISCARD DISK DISTINCT DISTINCTROW
-DIV DO DOUBLE DROP DUAL DUMPFILE DUPLICATE DYNAMIC EACH ELSE ELSEIF ENABLE
-ENCLOSED ENCRYPTION END ENDS ENGINE ENGINES ENUM ERROR ERRORS ESCAPE ESCAPED
-EVENT EVENTS EVERY EXCHANGE EXECUTE EXISTS EXIT EXPANSION EXPIRE EXPLAIN EXPORT
-EXTENDED EXTENT_SIZE FALSE FAST FAULTS FETCH FIELDS FILE FILE_BLOCK_SIZE FILTER
-FIRST FIXED FLOAT FLOAT4 FLOAT8 FLUSH FOLLOWS FOR FORCE FOREIGN FORMAT FOUND
-FROM FULL FULLTEXT FUNCTION GENERAL GENERATED GEOMETRY GEOMETRYCOLLECTION GET
-GET_FORMAT GLOBAL GRANT GRANTS GROUP GROUP_REPLICATION HANDLER HASH HAVING HELP
-HIGH_PRIORITY HOST HOSTS HOUR HOUR_MICROSECOND HOUR_MINUTE HOUR_SECOND
-IDENTIFIED IF IGNORE IGNORE_SERVER_IDS IMPORT IN INDEX INDEXES INFILE
-INITIAL_SIZE INNER INOUT INSENSITIVE INSERT INSERT_METHOD INSTALL INSTANCE INT
-INT1 INT2 INT3 INT4 INT8 INTEGER INTERVAL INTO INVOKER IO IO_AFTER_GTIDS
-IO_BEFORE_GTIDS IO_THREAD IPC IS ISOLATION ISSUER ITERATE JOIN JSON KEY KEYS
-KEY_BLOCK_SIZE KILL LANGUAGE LAST LEADING LEAVE LEAVES LEFT LESS LEVEL LIKE
-LIMIT LINEAR LINES LINESTRING LIST LOAD LOCAL LOCALTIME LOCALTIMESTAMP LOCK
-LOCKS LOGFILE LOGS LONG LONGBLOB LONGTEXT LOOP LOW_PRIORITY MASTER
-MASTER_AUTO_POSITION MASTER_BIND MASTER_CONNECT_RETRY MASTER_DELAY
-MASTER_HEARTBEAT_PERIOD MASTER_HOST MASTER_LOG_FILE MASTER_LOG_POS
-MASTER_PASSWORD MASTER_PORT MASTER_RETRY_COUNT MASTER_SERVER_ID MASTER_SSL
-MASTER_SSL_CA MASTER_SSL_CAPATH MASTER_SSL_CERT MASTER_SSL_CIPHER
-MASTER_SSL_CRL MASTER_SSL_CRLPATH MASTER_SSL_KEY MASTER_SSL_VERIFY_SERVER_CERT
-MASTER_TLS_VERSION MASTER_USER MATCH MAXVALUE MAX_CONNECTIONS_PER_HOUR
-MAX_QUERIES_PER_HOUR MAX_ROWS MAX_SIZE MAX_STATEMENT_TIME MAX_UPDATES_PER_HOUR
-MAX_USER_CONNECTIONS MEDIUM MEDIUMBLOB MEDIUMINT MEDIUMTEXT MEMORY MERGE
-MESSAGE_TEXT MICROSECOND MIDDLEINT MIGRATE MINUTE MINUTE_MICROSECOND
-MINUTE_SECOND MIN_ROWS MOD MODE MODIFIES MODIFY MONTH MULTILINESTRING
-MULTIPOINT MULTIPOLYGON MUTEX MYSQL_ERRNO NAME NAMES NATIONAL NATURAL NCHAR NDB
-NDBCLUSTER NEVER NEW NEXT NO NODEGROUP NONBLOCKING NONE NOT NO_WAIT
-NO_WRITE_TO_BINLOG NULL NUMBER NUMERIC NVARCHAR OFFSET OLD_PASSWORD ON ONE ONLY
-OPEN OPTIMIZE OPTIMIZER_COSTS OPTION OPTIONALLY OPTIONS OR ORDER OUT OUTER
-OUTFILE OWNER PACK_KEYS PAGE PARSER PARSE_GCOL_EXPR PARTIAL PARTITION
-PARTITIONING PARTITIONS PASSWORD PHASE PLUGIN PLUGINS PLUGIN_DIR POINT POLYGON
-PORT PRECEDES PRECISION PREPARE PRESERVE PREV PRIMARY PRIVILEGES PROCEDURE
-PROCESSLIST PROFILE PROFILES PROXY PURGE QUARTER QUERY QUICK RANGE READ READS
-READ_ONLY READ_WRITE REAL REBUILD RECOVER REDOFILE REDO_BUFFER_SIZE REDUNDANT
-REFERENCES REGEXP RELAY RELAYLOG RELAY_LOG_FILE RELAY_LOG_POS RELAY_THREAD
-RELEASE RELOAD REMOVE RENAME REORGANIZE REPAIR REPEAT REPEATABLE REPLACE
-REPLICATE_DO_DB REPLICATE_DO_TABLE REPLICATE_IGNORE_DB REPLICATE_IGNORE_TABLE
-REPLICATE_REWRITE_DB REPLICATE_WILD_DO_TABLE REPLICATE_WILD_IGNORE_TABLE
-REPLICATION REQUIRE RESET RESIGNAL RESTORE RESTRICT RESUME RETURN
-RETURNED_SQLSTATE RETURNS REVERSE REVOKE RIGHT RLIKE ROLLBACK ROLLUP ROTATE
-ROUTINE ROW ROWS ROW_COUNT ROW_FORMAT RTREE SAVEPOINT SCHEDULE SCHEMA SCHEMAS
-SCHEMA_NAME SECOND SECOND_MICROSECOND SECURITY SELECT SENSITIVE SEPARATOR
-SERIAL SERIALIZABLE SERVER SESSION SET SHARE SHOW SHUTDOWN SIGNAL SIGNED SIMPLE
-SLAVE SLOW SMALLINT SNAPSHOT SOCKET SOME SONAME SOUNDS SOURCE SPATIAL SPECIFIC
-SQL SQLEXCEPTION SQLSTATE SQLWARNING SQL_AFTER_GTIDS SQL_AFTER_MTS_GAPS
-SQL_BEFORE_GTIDS SQL_BIG_RESULT SQL_BUFFER_RESULT SQL_CACHE SQL_CALC_FOUND_ROWS
-SQL_NO_CACHE SQL_SMALL_RESULT SQL_THREAD SQL_TSI_DAY SQL_TSI_HOUR
-SQL_TSI_MINUTE SQL_TSI_MONTH SQL_TSI_QUARTER SQL_TSI_SECOND SQL_TSI_WEEK
-SQL_TSI_YEAR SSL STACKED START STARTING STARTS STATS_AUTO_RECALC
-STATS_PERSISTENT STATS_SAMPLE_PAGES STATUS STOP STORAGE STORED STRAIGHT_JOIN
-STRING SUBCLASS_ORIGIN SUBJECT SUBPARTITION SUBPARTITIONS SUPER SUSPEND SWAPS
-SWITCHES TABLE TABLES TABLESPACE TABLE_CHECKSUM TABLE_NAME TEMPORARY TEMPTABLE
-TERMINATED TEXT THAN THEN TIME TIMESTAMP TIMESTAMPADD TIMESTAMPDIFF TINYBLOB
-TINYINT TINYTEXT TO TRAILING TRANSACTION TRIGGER TRIGGERS TRUE TRUNCATE TYPE
-TYPES UNCOMMITTED UNDEFINED UNDO UNDOFILE UNDO_BUFFER_SIZE UNICODE UNINSTALL
-UNION UNIQUE UNKNOWN UNLOCK UNSIGNED UNTIL UPDATE UPGRADE USAGE USE USER
-USER_RESOURCES USE_FRM USING UTC_DATE UTC_TIME UTC_TIMESTAMP VALIDATION VALUE
-VALUES VARBINARY VARCHAR VARCHARACTER VARIABLES VARYING VIEW VIRTUAL WAIT
-WARNINGS WEEK WEIGHT_STRING WHEN WHERE WHILE WITH WITHOUT WORK WRAPPER WRITE
-X509 XA XID XML XOR YEAR YEAR_MONTH ZEROFILL""".split()}
-
 def add_semicolon(query):
     query = query.strip()
     if len(query) > 0 and query[-1] != ';':
         return query + ';'
     return query
 
-def update_quotes(char, in_single, in_double):
-    if char == '"' and not in_single:
-        in_double = not in_double
-    elif char == "'" and not in_double:
-        in_single = not in_single
-    return in_single, in_double
+SPECIAL_PATTERN = re.compile(r"[!=<>+*]+|[,;()\[\]{}/\\#]")
+QUOTE_PATTERN = re.compile("['\"]")
+FUNCTION_PATTERN = re.compile(r"(count|lower|max|min|sum|COUNT|LOWER|MAX|MIN|SUM) \((\*?)|COUNT\(\*|YEAR \( CURDATE \( \) \)")
+
+def trim_quoted(content, closed):
+    # Remove blank spaces just inside quotes, keeping a leading or trailing %
+    content = content.lstrip(" \n")
+    if content.startswith("%"):
+        content = "%" + content[1:].lstrip(" \n")
+    if closed:
+        if content[-1:] in (" ", "\n"):
+            content = content[:-1]
+        elif len(content) > 1 and content[-1] == "%" and content[-2] in " \n":
+            content = content[:-2] + "%"
+    return content
+
+def fix_function(match):
+    name, star = match.group(1), match.group(2)
+    if name is None:
+        if match.group(0) == "COUNT(*":
+            return "COUNT( *"
+        return "YEAR(CURDATE())"
+    name = name.upper()
+    if star and name == "COUNT":
+        return "COUNT( *"
+    return name + "(" + star
 
 def standardise_blank_spaces(query):
-    # split on special characters except _.:-
-    in_squote, in_dquote = False, False
-    tmp_query = []
-    pos = 0
-    while pos < len(query):
-        char = query[pos]
-        pos += 1
-        # Handle whether we are in quotes
-        if char in ["'", '"']:
-            if not (in_squote or in_dquote):
-                tmp_query.append(" ")
-            in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-            tmp_query.append(char)
-            if not (in_squote or in_dquote):
-                tmp_query.append(" ")
-        elif in_squote or in_dquote:
-            tmp_query.append(char)
-        elif char in "!=<>,;()[]{}+*/\\#":
-            tmp_query.append(" ")
-            tmp_query.append(char)
-            while pos < len(query) and query[pos] in "!=<>+*" and char in "!=<>+*":
-                tmp_query.append(query[pos])
-                pos += 1
-            tmp_query.append(" ")
-        else:
-            tmp_query.append(char)
-    new_query = ''.join(tmp_query)
-
-    # Remove blank spaces just inside quotes:
-    tmp_query = []
-    in_squote, in_dquote = False, False
-    prev = None
-    prev2 = None
-    for char in new_query:
-        skip = False
-        for quote, symbol in [(in_squote, "'"), (in_dquote, '"')]:
-            if quote:
-                if char in " \n"  and prev == symbol:
-                    skip = True
-                    break
-                if char in " \n"  and prev == "%" and prev2 == symbol:
-                    skip = True
-                    break
-                elif char == symbol and prev in " \n":
-                    tmp_query.pop()
-                elif char == symbol and prev == "%" and prev2 in " \n":
-                    tmp_query.pop(len(tmp_query) - 2)
-        if skip:
-            continue
-
-        in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-        tmp_query.append(char)
-        prev2 = prev
-        prev = char
-    new_query = ''.join(tmp_query)
+    # A single pass over the query that splits on special characters (except
+    # _.:-) and trims spaces inside quotes. The pieces produced are fed
+    # straight into a scan that replaces single quotes with double quotes
+    # where possible. That scan has its own (historical) view of which quote
+    # we are in, which is kept exactly so output does not change.
+    parts = []
+    in_single = False
+    in_double = False
+    single_run = None # the pieces of a single quoted string while we are in one
+    run_has_double = False
+    def emit(text):
+        nonlocal in_single, in_double, single_run, run_has_double
+        pos = 0
+        while pos < len(text):
+            if single_run is not None:
+                end = text.find("'", pos)
+                chunk = text[pos:] if end < 0 else text[pos:end + 1]
+                single_run.append(chunk)
+                run_has_double = run_has_double or '"' in chunk
+                if end < 0:
+                    return
+                run = ''.join(single_run)
+                if not run_has_double:
+                    run = '"' + run[1:-1] + '"'
+                parts.append(run)
+                single_run = None
+                pos = end + 1
+                continue
+            match = QUOTE_PATTERN.search(text, pos)
+            if match is None:
+                parts.append(text[pos:])
+                return
+            quote = match.start()
+            parts.append(text[pos:quote])
+            char = text[quote]
+            if char == "'" and not in_double:
+                in_single = not in_single
+                single_run = ["'"]
+                run_has_double = False
+            else:
+                parts.append(char)
+                in_single, in_double = update_quotes(char, in_single, in_double)
+            pos = quote + 1
 
-    # Replace single quotes with double quotes where possible
-    tmp_query = []
-    in_squote, in_dquote = False, False
     pos = 0
-    while pos < len(new_query):
-        char = new_query[pos]
-        if (not in_dquote) and char == "'":
-            to_add = [char]
-            pos += 1
-            saw_double = False
-            while pos < len(new_query):
-                tchar = new_query[pos]
-                if tchar == '"':
-                    saw_double = True
-                to_add.append(tchar)
-                if tchar == "'":
-                    break
-                pos += 1
-            if not saw_double:
-                to_add[0] = '"'
-                to_add[-1] = '"'
-            tmp_query.append(''.join(to_add))
-        else:
-            tmp_query.append(char)
-
-        in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-
-        pos += 1
-    new_query = ''.join(tmp_query)
-
-    # remove repeated blank spaces
-    new_query = ' '.join(new_query.split())
-
-    # Remove spaces that would break SQL functions
-    new_query = "COUNT(".join(new_query.split("count ("))
-    new_query = "LOWER(".join(new_query.split("lower ("))
-    new_query = "MAX(".join(new_query.split("max ("))
-    new_query = "MIN(".join(new_query.split("min ("))
-    new_query = "SUM(".join(new_query.split("sum ("))
-    new_query = "COUNT(".join(new_query.split("COUNT ("))
-    new_query = "LOWER(".join(new_query.split("LOWER ("))
-    new_query = "MAX(".join(new_query.split("MAX ("))
-    new_query = "MIN(".join(new_query.split("MIN ("))
-    new_query = "SUM(".join(new_query.split("SUM ("))
-    new_query = "COUNT( *".join(new_query.split("COUNT(*"))
-    new_query = "YEAR(CURDATE())".join(new_query.split("YEAR ( CURDATE ( ) )"))
-
-    return new_query
+    while pos < len(query):
+        match = QUOTE_PATTERN.search(query, pos)
+        if match is None:
+            emit(SPECIAL_PATTERN.sub(r" \g<0> ", query[pos:]))
+            break
+        start = match.start()
+        emit(SPECIAL_PATTERN.sub(r" \g<0> ", query[pos:start]))
+        quote = query[start]
+        end = query.find(quote, start + 1)
+        if end < 0:
+            emit(" " + quote + trim_quoted(query[start + 1:], False))
+            break
+        emit(" " + quote + trim_quoted(query[start + 1:end], True) + quote + " ")
+        pos = end + 1
+    if single_run is not None:
+        run = ''.join(single_run)
+        if not run_has_double:
+            run = '"' + run[1:-1] + '"' if len(run) > 1 else '"'
+        parts.append(run)
+
+    # Remove repeated blank spaces, then spaces that would break SQL functions
+    new_query = ' '.join(''.join(parts).split())
+    return FUNCTION_PATTERN.sub(fix_function, new_query)
 
 def capitalise(query, variables):
     ntokens = []
+    lexed = lex(query)
+    # Variables are passed over without updating the quote state, so if one
+    # contains a quote the lexer's state no longer applies and we track it
+    # here instead.
+    quotes = lexed.quotes
     in_squote, in_dquote = False, False
-    for token in query.split():
+    for pos, token in enumerate(lexed.tokens):
+        if quotes is not None:
+            in_squote, in_dquote = quotes[pos]
         if token in variables or token in ["credit0", "level0", "level1", "number0", "number1", "year0", "business_rating0"]:
             ntokens.append(token)
+            if "'" in token or '"' in token:
+                quotes = None
+        elif not ("'" in token or '"' in token):
+            ntokens.append(token if in_squote or in_dquote else token.upper())
         else:
             modified = []
             for char in token:
@@ -259,6 +193,16 @@ def capitalise(query, variables):
 
     return ' '.join(ntokens)
 
+def toggles_quote(word):
+    return word.count('"') % 2 == 1
+
+def same_bracket_structure(old, new):
+    """True if swapping old for new cannot change any subquery_range result."""
+    return old is new or (
+        ('(' in old) == ('(' in new) and
+        (')' in old) == (')' in new) and
+        QUOTE_PATTERN.findall(old) == QUOTE_PATTERN.findall(new))
+
 def subquery_range(current, pos, tokens, in_quote=False):
     if tokens[pos] == '(' and (not in_quote):
         start = pos
@@ -266,12 +210,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0:
-            for char in tokens[end]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[end]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[end]:
+                if '(' in token:
                     depth += 1
-                elif ')' in tokens[end]:
+                elif ')' in token:
                     depth -= 1
             end += 1
         return (start, end)
@@ -281,12 +225,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0 and start > 0:
-            for char in tokens[start]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[start]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[start]:
+                if '(' in token:
                     depth -= 1
-                elif ')' in tokens[start]:
+                elif ')' in token:
                     depth += 1
             start -= 1
         if start != 0:
@@ -302,6 +246,7 @@ def subquery_range(current, pos, tokens, in_quote=False):
 
 ALIAS_PATTERN = re.compile("[A-Za-z0-9_]*")
 def standardise_aliases(query, schema):
+    schema = as_index(schema, SQL_RESERVED_WORDS)
     count = {} # dictionary storing how many times each table has been used
     aliases = {} # dictionary mapping old aliases to standardised aliases
     field_aliases = {}
@@ -313,9 +258,8 @@ def standardise_aliases(query, schema):
     seen_where = {}
     in_quote = False
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if word == "FROM":
             if LOGGING: print("Seen from", current_subquery[0], i)
@@ -371,16 +315,23 @@ def standardise_aliases(query, schema):
             print(alias, aliases[alias])
         for field_alias in field_aliases:
             print(field_alias, field_aliases[field_alias])
+    # The token list no longer changes length, so the range of each subquery
+    # holding an alias is worked out once and reused. The stored ranges are
+    # only dropped if a rewritten token could move a bracket or quote.
+    alias_ranges = {}
     in_quote = False
+    previous = None
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if previous is not None and not same_bracket_structure(previous, tokens[i-1]):
+            alias_ranges.clear()
+        previous = word
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if (current_subquery[0], word) in aliases:
             if len(tokens) > i + 1 and tokens[i+1] != "AS":
                 tokens[i] = aliases[current_subquery[0], word]
-        if word in SQL_RESERVED_WORDS and word not in schema[1]:
+        if word in SQL_RESERVED_WORDS and word not in schema.reserved_names:
             continue
         parts = word.split('.')
         if len(parts) == 2:
@@ -393,7 +344,9 @@ def standardise_aliases(query, schema):
                 tokens[i] = table +"."+ field
             else:
                 for alias in aliases:
-                    other = subquery_range((0, -1), alias[0], tokens)
+                    if alias[0] not in alias_ranges:
+                        alias_ranges[alias[0]] = subquery_range((0, -1), alias[0], tokens)
+                    other = alias_ranges[alias[0]]
                     if LOGGING: print("   ", alias, alias[1], parts[0], other[0], current_subquery[0], other[1], i)
                     if alias[1] == parts[0] and other[0] < current_subquery[0] and (other[1] == -1 or other[1] > i):
                         tokens[i] = aliases[alias] +'.'+ parts[1]
@@ -405,19 +358,18 @@ def standardise_aliases(query, schema):
             sw = seen_where.get(current_subquery[0], None)
             done = False
             if sf is None or i < sf or (sw is not None and i > sw):
-                for table in schema[0]:
-###                    print(table, schema[0][table])
-                    if word in schema[0][table]:
-###                        print("Found", i, word, table, current_subquery)
-                        for pair in aliases:
-                            alias = aliases[pair]
-                            start = alias.split("alias")[0]
-                            if pair[0] == current_subquery[0] and start == table:
-                                tokens[i] = alias +'.' + word
-                                done = True
-                                break
-                        if done:
+                # Tables holding this column, in fields file order
+                for table in schema.column_tables.get(word, ()):
+###                    print("Found", i, word, table, current_subquery)
+                    for pair in aliases:
+                        alias = aliases[pair]
+                        start = alias.split("alias")[0]
+                        if pair[0] == current_subquery[0] and start == table:
+                            tokens[i] = alias +'.' + word
+                            done = True
                             break
+                    if done:
+                        break
             if (not done) and word in field_aliases:
                 tokens[i] = field_aliases[word]
 
@@ -425,24 +377,74 @@ def standardise_aliases(query, schema):
 
 def tokens_for_chunk(tokens, chunk):
     return tokens[chunk[0]:chunk[1]+1]
-def get_matching_chunk(tokens, chunks, pos, target, default=None):
-    saw_between = False
-    while pos < len(chunks):
-        chunk = chunks[pos]
-        if tokens[chunk[0]].upper() == "BETWEEN":
-            saw_between = True
-        if chunk[0] == chunk[1] and tokens[chunk[0]] == target:
-            if target != "AND" or (not saw_between):
-                return pos
-        if saw_between and tokens[chunk[0]].upper() == 'AND':
-            saw_between = False
-        pos += 1
-    return default
-def sort_chunk_list(start, end, chunks, tokens, separator=","):
+
+class ClauseIndex:
+    """The one-token chunks of a chunk list, by token, so that finding the
+    next keyword or separator is a bisect rather than a scan along the
+    chunks. An AND that follows a BETWEEN (counting from where the search
+    starts) belongs to the BETWEEN and is not matched. After tokens in a
+    range of chunks are rewritten, refresh that range."""
+    def __init__(self, tokens, chunks):
+        self.tokens = tokens
+        self.chunks = chunks
+        self.starts = [tokens[chunk[0]] for chunk in chunks]
+        self.positions = {}
+        # Chunks starting with BETWEEN or AND, which turn the AND rule on and off
+        self.events = []
+        for number, chunk in enumerate(chunks):
+            start = self.starts[number]
+            if chunk[0] == chunk[1]:
+                self.positions.setdefault(start, []).append(number)
+            if start.upper() in ("BETWEEN", "AND"):
+                self.events.append(number)
+
+    def add(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            bisect.insort(self.positions.setdefault(start, []), number)
+        if start.upper() in ("BETWEEN", "AND"):
+            bisect.insort(self.events, number)
+
+    def remove(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            self.positions[start].remove(number)
+        if start.upper() in ("BETWEEN", "AND"):
+            self.events.remove(number)
+
+    def refresh(self, first, last):
+        """Update the index after tokens in chunks first to last changed."""
+        for number in range(first, last + 1):
+            start = self.tokens[self.chunks[number][0]]
+            if start != self.starts[number]:
+                self.remove(number)
+                self.starts[number] = start
+                self.add(number)
+
+    def after_between(self, pos, number):
+        event = bisect.bisect_left(self.events, number) - 1
+        return event >= 0 and self.events[event] >= pos and \
+            self.starts[self.events[event]].upper() == "BETWEEN"
+
+    def find(self, pos, target, default=None):
+        """The first chunk from pos on that is just target, or default."""
+        found = self.positions.get(target, ())
+        place = bisect.bisect_left(found, pos)
+        while place < len(found):
+            if target != "AND" or not self.after_between(pos, found[place]):
+                return found[place]
+            place += 1
+        return default
+
+def sort_chunk_list(start, end, index, separator=","):
+    chunks = index.chunks
+    tokens = index.tokens
     to_rearrange = []
     pos = start
     while pos < end:
-        npos = get_matching_chunk(tokens, chunks, pos + 1, separator)
+        npos = index.find(pos + 1, separator)
         if npos is None or npos > end:
             npos = end - 1
         left = chunks[pos][0]
@@ -476,6 +478,7 @@ def sort_chunk_list(start, end, chunks, tokens, separator=","):
             if cpos <= max_pos:
                 tokens[cpos] = separator
             cpos += 1
+        index.refresh(start, min(end, len(chunks) - 1))
 
 def order_sequence(tokens, start, end, variables):
     # Note - using https://ronsavage.github.io/SQL/sql-92.bnf.html to assist in
@@ -486,9 +489,8 @@ def order_sequence(tokens, start, end, variables):
     chunks = [(start, start)]
     in_quote = False
     while cpos < end:
-        for part in tokens[cpos].split('"'):
+        if toggles_quote(tokens[cpos]):
             in_quote = not in_quote
-        in_quote = not in_quote
         sub = subquery_range(None, cpos, tokens, in_quote)
         if sub is None:
             chunks.append((cpos, cpos))
@@ -498,20 +500,22 @@ def order_sequence(tokens, start, end, variables):
             order_sequence(tokens, sub[0], sub[1] - 1, variables)
             cpos = sub[1]
 
+    index = ClauseIndex(tokens, chunks)
+
     # Handle SELECT
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_select = get_matching_chunk(tokens, chunks, cur_chunk, "SELECT")
+        next_select = index.find(cur_chunk, "SELECT")
         if next_select is None: break
         
-        next_distinct = get_matching_chunk(tokens, chunks, next_select, "DISTINCT")
-        next_all = get_matching_chunk(tokens, chunks, next_select, "ALL")
+        next_distinct = index.find(next_select, "DISTINCT")
+        next_all = index.find(next_select, "ALL")
         if next_distinct == next_select + 1 or next_all == next_select + 1:
             next_select += 1
 
-        next_from = get_matching_chunk(tokens, chunks, next_select, "FROM", len(chunks))
+        next_from = index.find(next_select, "FROM", len(chunks))
 
-        sort_chunk_list(next_select + 1, next_from, chunks, tokens)
+        sort_chunk_list(next_select + 1, next_from, index)
 
         cur_chunk = next_from
     
@@ -519,7 +523,7 @@ def order_sequence(tokens, start, end, variables):
     for symbol in ["=", "!="]:
         cur_chunk = 0
         while cur_chunk < len(chunks):
-            next_equals = get_matching_chunk(tokens, chunks, cur_chunk, symbol)
+            next_equals = index.find(cur_chunk, symbol)
             if next_equals is None:
                 break
             left = tokens_for_chunk(tokens, chunks[next_equals - 1])
@@ -548,31 +552,32 @@ def order_sequence(tokens, start, end, variables):
                 for token in left:
                     tokens[cpos] = token
                     cpos += 1
+                index.refresh(next_equals - 1, next_equals + 1)
 
             cur_chunk = next_equals + 2
 
     #  - Table names in 'from'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_from = get_matching_chunk(tokens, chunks, cur_chunk, "FROM")
+        next_from = index.find(cur_chunk, "FROM")
         if next_from is None: break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_from, "WHERE", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "JOIN", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, ";", len(chunks))
+            index.find(next_from, "WHERE", len(chunks)),
+            index.find(next_from, "JOIN", len(chunks)),
+            index.find(next_from, "GROUP", len(chunks)),
+            index.find(next_from, "HAVING", len(chunks)),
+            index.find(next_from, "LIMIT", len(chunks)),
+            index.find(next_from, "ORDER", len(chunks)),
+            index.find(next_from, ";", len(chunks))
         )
-        sort_chunk_list(next_from + 1, next_item, chunks, tokens)
+        sort_chunk_list(next_from + 1, next_item, index)
         cur_chunk = next_item
 
     #  - Comparisons in 'where'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_where = get_matching_chunk(tokens, chunks, cur_chunk, "WHERE")
+        next_where = index.find(cur_chunk, "WHERE")
         if next_where is None:
             if tokens[chunks[0][0]] != "SELECT" and tokens[chunks[1][1]] != "SELECT":
                 next_where = 0
@@ -580,11 +585,11 @@ def order_sequence(tokens, start, end, variables):
                 break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_where, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, ";", len(chunks))
+            index.find(next_where, "GROUP", len(chunks)),
+            index.find(next_where, "HAVING", len(chunks)),
+            index.find(next_where, "LIMIT", len(chunks)),
+            index.find(next_where, "ORDER", len(chunks)),
+            index.find(next_where, ";", len(chunks))
         )
         has_and = False
         has_or = False
@@ -605,8 +610,8 @@ def order_sequence(tokens, start, end, variables):
             min_pos = min([chunks[v][0] for v in range(next_where + 1, next_item)])
             max_pos = max([chunks[v][1] for v in range(next_where + 1, next_item)])
             ctokens = tokens[min_pos:max_pos+1]
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "AND")
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "OR")
+            sort_chunk_list(next_where + 1, next_item, index, "AND")
+            sort_chunk_list(next_where + 1, next_item, index, "OR")
         cur_chunk = next_item
 
 def order_query(query, variables):
@@ -627,86 +632,279 @@ def make_canonical(query, schema, variables, skip=set()):
     return query
 
 def read_schema(schema_filename):
-    schema = {}
-    all_words = set()
-    with open(schema_filename) as schema_file:
-        for line in schema_file:
-            fields = line.strip().split()
-            if len(fields) > 1:
-                table = fields[0].upper()
-                column = fields[1].upper()
-                schema.setdefault(table, set()).add(column)
-                all_words.add(table)
-                all_words.add(column)
-    return schema, all_words
-
-def standarise_file(filename, schema_filename, log, overwrite, skip, nonjson):
+    return load_schema(schema_filename, SQL_RESERVED_WORDS)
+
+# Worker state for --jobs, set once per process by init_worker so the schema
+# is not pickled with every query.
+WORKER_SCHEMA = None
+WORKER_SKIP = set()
+
+def init_worker(schema, skip):
+    global WORKER_SCHEMA, WORKER_SKIP
+    WORKER_SCHEMA = schema
+    WORKER_SKIP = skip
+
+def canonicalise_job(job):
+    query, variables = job
+    return make_canonical(query, WORKER_SCHEMA, variables, WORKER_SKIP)
+
+def code_version():
+    """Hashes of this file and of the tools it uses, so that editing any of
+    them invalidates cached canonical forms."""
+    return ' '.join(file_hash(filename) for filename in [__file__, common.__file__, json_stream.__file__, schema_index.__file__, sql_lexer.__file__])
+
+class CanonicalCache:
+    """Persistent cache of make_canonical output, stored in a SQLite file.
+
+    Entries are keyed by a hash of the query, the variables, the skip set, the
+    fields file and the canonicaliser's source (see code_version), so any
+    change to the canonicaliser invalidates old results. Once there are more than max_entries rows, the
+    least recently used ones are dropped when the cache is closed.
+    """
+    def __init__(self, path, fields_filename, max_entries=1000000):
+        self.max_entries = max_entries
+        self.context = file_hash(fields_filename) + ' ' + code_version()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS canonical (key TEXT PRIMARY KEY, query TEXT, used INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS canonical_used ON canonical (used)")
+        self.generation = self.conn.execute("SELECT COALESCE(MAX(used), 0) + 1 FROM canonical").fetchone()[0]
+
+    def key(self, query, variables, skip):
+        content = json.dumps([query, sorted(variables), sorted(skip), self.context])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT query FROM canonical WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE canonical SET used = ? WHERE key = ?", (self.generation, key))
+        return row[0]
+
+    def put(self, key, query):
+        self.conn.execute("INSERT OR REPLACE INTO canonical VALUES (?, ?, ?)", (key, query, self.generation))
+
+    def close(self):
+        total = self.conn.execute("SELECT COUNT(*) FROM canonical").fetchone()[0]
+        if total > self.max_entries:
+            self.conn.execute("DELETE FROM canonical WHERE key IN (SELECT key FROM canonical ORDER BY used LIMIT ?)", (total - self.max_entries,))
+        self.conn.commit()
+        self.conn.close()
+
+def canonicalise_jobs(jobs, schema, skip, pool=None, cache=None, chunksize=64):
+    """Canonicalise a list of (query, variables) pairs, keeping their order."""
+    if cache is None:
+        if pool is None:
+            return [make_canonical(query, schema, variables, skip) for query, variables in jobs]
+        if isinstance(pool, multiprocessing.pool.ThreadPool):
+            # Threads share our memory, so there is no worker state to use
+            return pool.map(lambda job: make_canonical(job[0], schema, job[1], skip), jobs, chunksize)
+        return pool.map(canonicalise_job, jobs, chunksize)
+
+    # Look up each distinct job once and only compute the misses
+    keys = [cache.key(query, variables, skip) for query, variables in jobs]
+    found = {}
+    missing = {}
+    for key, job in zip(keys, jobs):
+        if key not in found and key not in missing:
+            value = cache.get(key)
+            if value is None:
+                missing[key] = job
+            else:
+                found[key] = value
+    missing_keys = list(missing)
+    computed = canonicalise_jobs([missing[key] for key in missing_keys], schema, skip, pool)
+    for key, value in zip(missing_keys, computed):
+        cache.put(key, value)
+        found[key] = value
+    return [found[key] for key in keys]
+
+def example_jobs(data):
+    """The (query, variables) pairs to canonicalise for one example."""
+    jobs = []
+    variables = set()
+    if len(data['variables']) > 0:
+        for variable in data['variables']:
+            variables.add(variable['name'])
+    for query in data['sql']:
+        jobs.append((query, variables))
+
+    if 'sql-with-vars' in data:
+        variables = set()
+        if 'variables' in data:
+            for item in data['variables']:
+                variables.add(item['name'])
+        jobs.append((data['sql-with-vars'], variables))
+    return jobs
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+class Canonicaliser:
+    """Canonicalise queries from Python code, reading the fields file once.
+
+    With jobs > 1 the work is spread over a pool of processes, or of threads
+    if use_threads is set. Results always come back in the order given. Call
+    close() when done, or use it in a with statement.
+
+        with Canonicaliser("data/atis-fields.txt", jobs=4) as canonicaliser:
+            canonical = canonicaliser.canonicalise_many(queries, variables)
+    """
+    def __init__(self, fields, skip=(), jobs=1, use_threads=False, cache=None, cache_size=1000000, batch_size=1000):
+        self.schema = read_schema(fields)
+        self.skip = set(skip)
+        self.batch_size = batch_size
+        self.pool = None
+        if jobs > 1:
+            if use_threads:
+                self.pool = multiprocessing.pool.ThreadPool(jobs)
+            else:
+                self.pool = multiprocessing.Pool(jobs, init_worker, (self.schema, self.skip))
+        self.cache = None
+        if cache is not None:
+            self.cache = CanonicalCache(cache, fields, cache_size)
+
+    def canonicalise(self, query, variables=()):
+        return self.canonicalise_many([query], [variables])[0]
+
+    def iter_canonical(self, queries, variables=None):
+        """Yield the canonical form of each query, working in batches.
+
+        variables is either one set of variable names used for every query,
+        or an iterable with one set per query. Both may be generators.
+        """
+        if variables is None:
+            variables = set()
+        if isinstance(variables, (set, frozenset)):
+            jobs = ((query, variables) for query in queries)
+        else:
+            jobs = ((query, set(names)) for query, names in zip(queries, variables))
+        for batch in batches(jobs, self.batch_size):
+            for canonical in canonicalise_jobs(batch, self.schema, self.skip, self.pool, self.cache):
+                yield canonical
+
+    def canonicalise_many(self, queries, variables=None):
+        return list(self.iter_canonical(queries, variables))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def run_jobs(jobs, schema, skip, log, pool=None, cache=None):
+    results = canonicalise_jobs(jobs, schema, skip, pool, cache)
+    if log:
+        for (query, _), canonical in zip(jobs, results):
+            print(query)
+            print(canonical)
+            print()
+    return results
+
+class Manifest:
+    """Canonical SQL for each example of a file, from an earlier run.
+
+    Examples are keyed by a hash of their SQL, variables, the skip set, the
+    fields file and the canonicaliser's source (see code_version), so on a
+    later run only examples whose key is new need to be canonicalised. Only the keys seen in the latest run
+    are kept when the manifest is saved.
+    """
+    def __init__(self, path, fields_filename, skip):
+        self.path = path
+        self.context = [sorted(skip), file_hash(fields_filename), code_version()]
+        self.previous = {}
+        self.current = {}
+        if os.path.exists(path):
+            with open(path) as manifest_file:
+                self.previous = json.load(manifest_file)
+
+    def key(self, data):
+        jobs = [[query, sorted(variables)] for query, variables in example_jobs(data)]
+        content = json.dumps([jobs, self.context])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.previous.get(key)
+
+    def put(self, key, queries):
+        self.current[key] = queries
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as manifest_file:
+            json.dump(self.current, manifest_file, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+def canonicalise_examples(examples, schema, skip, log=False, pool=None, cache=None, manifest=None, batch_size=1000):
+    """Yield the examples with their SQL canonicalised.
+
+    Examples are read and processed a batch at a time, so memory use depends
+    on batch_size rather than the number of examples. If a manifest is given,
+    examples it already knows are spliced in without being canonicalised.
+    """
+    for batch in batches(examples, batch_size):
+        jobs = []
+        known = []
+        for data in batch:
+            key = None
+            queries = None
+            if manifest is not None:
+                key = manifest.key(data)
+                queries = manifest.get(key)
+            if queries is None:
+                jobs.extend(example_jobs(data))
+            known.append((key, queries))
+        results = iter(run_jobs(jobs, schema, skip, log, pool, cache))
+        for data, (key, queries) in zip(batch, known):
+            if queries is None:
+                queries = [next(results) for _ in example_jobs(data)]
+            if manifest is not None:
+                manifest.put(key, queries)
+            queries = iter(queries)
+            data['sql'] = [next(queries) for _ in data['sql']]
+            if 'sql-with-vars' in data:
+                data['sql-with-vars'] = next(queries)
+            yield data
+
+def standarise_file(filename, schema_filename, log, overwrite, skip, nonjson, pool=None, cache=None, incremental=False):
     schema = read_schema(schema_filename)
 
-    # Canonicalise
-    final_data = None
-    with open(filename, 'r') as input_file:
-        if nonjson:
-            data = []
-            for line in input_file:
-                sent, query = line.split(" ||| ")
-                if log:
-                    print(query)
-                query = make_canonical(query, schema, set(), skip)
-                if log:
-                    print(query)
-                    print()
-                data.append(sent +" ||| "+ query)
-            final_data = data
-        else:
-            all_data = json.load(input_file)
-
-            if type(all_data) != list:
-                all_data = [all_data]
-
-            for data in all_data:
-                nqueries = []
-                variables = set()
-                if len(data['variables']) > 0:
-                    for variable in data['variables']:
-                        variables.add(variable['name'])
-                for query in data['sql']:
-                    if log:
-                        print(query)
-                    nqueries.append(make_canonical(query, schema, variables, skip))
-                    if log:
-                        print(nqueries[-1])
-                        print()
-                data['sql'] = nqueries
-
-                if 'sql-with-vars' in data:
-                    variables = set()
-                    if 'variables' in data:
-                        for item in data['variables']:
-                            variables.add(item['name'])
-                    query = data['sql-with-vars']
-                    if log:
-                        print(query)
-                    query = make_canonical(query, schema, variables, skip)
-                    if log:
-                        print(query)
-                        print()
-                    data['sql-with-vars'] = query
-            final_data = all_data
-
-    # Print to file
+    # Canonicalise, writing each batch out as soon as it is done. Output goes
+    # to a temporary file first as it may replace the input.
     new_path = filename
     if not overwrite:
         new_path += '.canonical.json'
-    with open(new_path, 'w') as write_file:
+    tmp_path = new_path + '.tmp'
+    manifest = None
+    if incremental:
+        manifest = Manifest(new_path + '.manifest', schema_filename, skip)
+    with open(filename, 'r') as input_file, open(tmp_path, 'w') as write_file:
         if nonjson:
-            for line in final_data:
-                print(line, file=write_file)
+            for batch in batches(input_file, 1000):
+                pairs = [line.split(" ||| ") for line in batch]
+                results = run_jobs([(query, set()) for _, query in pairs], schema, skip, log, pool, cache)
+                for (sent, _), query in zip(pairs, results):
+                    print(sent +" ||| "+ query, file=write_file)
         else:
-            to_print = json.dumps(final_data, indent=4, sort_keys=True)
-            for line in to_print.split("\n"):
-                line = line.rstrip()
-                print(line, file=write_file)
+            examples = read_examples(input_file)
+            write_examples(canonicalise_examples(examples, schema, skip, log, pool, cache, manifest), write_file)
+    os.replace(tmp_path, new_path)
+    if manifest is not None:
+        manifest.save()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Modifies SQL to have a consistent tokenization. Expects a list of filenames as stdin.')
@@ -720,17 +918,34 @@ if __name__ == '__main__':
     parser.add_argument('--skip', help='Functions that should not be applied (choices are [standardise_blank_spaces, capitalise, standardise_aliases, order_query]).')
     parser.add_argument('--overwrite', help='Replace the file rather than creating a new one.', action='store_true')
     parser.add_argument('--nonjson', help='The files contain "Sentence ||| SQL" rather than json.', action='store_true')
+    parser.add_argument('--jobs', help='Number of worker processes to canonicalise with (default 1, no pool).', type=int, default=1)
+    parser.add_argument('--cache', help='SQLite file used to remember canonical forms between runs.')
+    parser.add_argument('--cache-size', help='Maximum number of queries kept in the cache.', type=int, default=1000000)
+    parser.add_argument('--incremental', help='Keep a manifest next to each output file and only canonicalise examples that changed since the last run.', action='store_true')
     args = parser.parse_args()
+    if args.incremental and args.nonjson:
+        parser.error("--incremental only works with json files")
 
     skip = set()
     if args.skip is not None:
         skip = {v for v in args.skip.split(",")}
 
     if not (args.testadv or args.testgeo or args.testatis or args.testscholar or args.testyelp):
+        pool = None
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs, init_worker, (read_schema(args.fields), skip))
+        cache = None
+        if args.cache is not None:
+            cache = CanonicalCache(args.cache, args.fields, args.cache_size)
         for line in sys.stdin:
             if args.log:
                 print("Doing", line.strip())
-            standarise_file(line.strip(), args.fields, args.log, args.overwrite, skip, args.nonjson)
+            standarise_file(line.strip(), args.fields, args.log, args.overwrite, skip, args.nonjson, pool, cache, args.incremental)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if cache is not None:
+            cache.close()
     else:
         sample_queries = [
             ("select * from student where student.s_id < 5",
@@ -15,6 +15,21 @@ import string
 import json
 import sys
 import argparse
+import bisect
+import multiprocessing
+import os
+import pickle
+
+import common
+import json_stream
+import multi_match
+import schema_index
+import sql_lexer
+from common import file_hash
+from json_stream import read_examples, write_examples
+from multi_match import apply_spans, locate_variables
+from schema_index import as_index, compile_schema, load_schema
+from sql_lexer import lex, update_quotes, update_token_quotes
 
 LOGGING = False
 
@@ -125,120 +140,113 @@ def add_semicolon(query):
         return query + ';'
     return query
 
-def update_quotes(char, in_single, in_double):
-    if char == '"' and not in_single:
-        in_double = not in_double
-    elif char == "'" and not in_double:
-        in_single = not in_single
-    return in_single, in_double
+SPECIAL_PATTERN = re.compile(r"[!=<>+*]+|[,;()\[\]{}/\\#]")
+QUOTE_PATTERN = re.compile("['\"]")
+FUNCTION_PATTERN = re.compile(r"(count|lower|max|min|sum|avg|COUNT|LOWER|MAX|MIN|SUM|AVG) \((\*?)|COUNT\(\*|YEAR \( CURDATE \( \) \)")
+
+def trim_quoted(content, closed):
+    # Remove blank spaces just inside quotes, keeping a leading or trailing %
+    content = content.lstrip(" \n")
+    if content.startswith("%"):
+        content = "%" + content[1:].lstrip(" \n")
+    if closed:
+        if content[-1:] in (" ", "\n"):
+            content = content[:-1]
+        elif len(content) > 1 and content[-1] == "%" and content[-2] in " \n":
+            content = content[:-2] + "%"
+    return content
+
+def fix_function(match):
+    name, star = match.group(1), match.group(2)
+    if name is None:
+        if match.group(0) == "COUNT(*":
+            return "COUNT( *"
+        return "YEAR(CURDATE())"
+    name = name.upper()
+    if star and name == "COUNT":
+        return "COUNT( *"
+    return name + "(" + star
 
 def standardise_blank_spaces(query):
-    # split on special characters except _.:-
-    in_squote, in_dquote = False, False
-    tmp_query = []
-    pos = 0
-    while pos < len(query):
-        char = query[pos]
-        pos += 1
-        # Handle whether we are in quotes
-        if char in ["'", '"']:
-            if not (in_squote or in_dquote):
-                tmp_query.append(" ")
-            in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-            tmp_query.append(char)
-            if not (in_squote or in_dquote):
-                tmp_query.append(" ")
-        elif in_squote or in_dquote:
-            tmp_query.append(char)
-        elif char in "!=<>,;()[]{}+*/\\#":
-            tmp_query.append(" ")
-            tmp_query.append(char)
-            while pos < len(query) and query[pos] in "!=<>+*" and char in "!=<>+*":
-                tmp_query.append(query[pos])
-                pos += 1
-            tmp_query.append(" ")
-        else:
-            tmp_query.append(char)
-    new_query = ''.join(tmp_query)
-
-    # Remove blank spaces just inside quotes:
-    tmp_query = []
-    in_squote, in_dquote = False, False
-    prev = None
-    prev2 = None
-    for char in new_query:
-        skip = False
-        for quote, symbol in [(in_squote, "'"), (in_dquote, '"')]:
-            if quote:
-                if char in " \n"  and prev == symbol:
-                    skip = True
-                    break
-                if char in " \n"  and prev == "%" and prev2 == symbol:
-                    skip = True
-                    break
-                elif char == symbol and prev in " \n":
-                    tmp_query.pop()
-                elif char == symbol and prev == "%" and prev2 in " \n":
-                    tmp_query.pop(len(tmp_query) - 2)
-        if skip:
-            continue
-
-        in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-        tmp_query.append(char)
-        prev2 = prev
-        prev = char
-    new_query = ''.join(tmp_query)
+    # A single pass over the query that splits on special characters (except
+    # _.:-) and trims spaces inside quotes. The pieces produced are fed
+    # straight into a scan that replaces single quotes with double quotes
+    # where possible. That scan has its own (historical) view of which quote
+    # we are in, which is kept exactly so output does not change.
+    parts = []
+    in_single = False
+    in_double = False
+    single_run = None # the pieces of a single quoted string while we are in one
+    run_has_double = False
+    def emit(text):
+        nonlocal in_single, in_double, single_run, run_has_double
+        pos = 0
+        while pos < len(text):
+            if single_run is not None:
+                end = text.find("'", pos)
+                chunk = text[pos:] if end < 0 else text[pos:end + 1]
+                single_run.append(chunk)
+                run_has_double = run_has_double or '"' in chunk
+                if end < 0:
+                    return
+                run = ''.join(single_run)
+                if not run_has_double:
+                    run = '"' + run[1:-1] + '"'
+                parts.append(run)
+                single_run = None
+                pos = end + 1
+                continue
+            match = QUOTE_PATTERN.search(text, pos)
+            if match is None:
+                parts.append(text[pos:])
+                return
+            quote = match.start()
+            parts.append(text[pos:quote])
+            char = text[quote]
+            if char == "'" and not in_double:
+                in_single = not in_single
+                single_run = ["'"]
+                run_has_double = False
+            else:
+                parts.append(char)
+                in_single, in_double = update_quotes(char, in_single, in_double)
+            pos = quote + 1
 
-    # Replace single quotes with double quotes where possible
-    tmp_query = []
-    in_squote, in_dquote = False, False
     pos = 0
-    while pos < len(new_query):
-        char = new_query[pos]
-        if (not in_dquote) and char == "'":
-            to_add = [char]
-            pos += 1
-            saw_double = False
-            while pos < len(new_query):
-                tchar = new_query[pos]
-                if tchar == '"':
-                    saw_double = True
-                to_add.append(tchar)
-                if tchar == "'":
-                    break
-                pos += 1
-            if not saw_double:
-                to_add[0] = '"'
-                to_add[-1] = '"'
-            tmp_query.append(''.join(to_add))
-        else:
-            tmp_query.append(char)
-
-        in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
-
-        pos += 1
-    new_query = ''.join(tmp_query)
-
-    # remove repeated blank spaces
-    new_query = ' '.join(new_query.split())
-
-    # Remove spaces that would break SQL functions
-    new_query = "COUNT(".join(new_query.split("count ("))
-    new_query = "LOWER(".join(new_query.split("lower ("))
-    new_query = "MAX(".join(new_query.split("max ("))
-    new_query = "MIN(".join(new_query.split("min ("))
-    new_query = "SUM(".join(new_query.split("sum ("))
-    new_query = "AVG(".join(new_query.split("avg ("))
-    new_query = "COUNT(".join(new_query.split("COUNT ("))
-    new_query = "LOWER(".join(new_query.split("LOWER ("))
-    new_query = "MAX(".join(new_query.split("MAX ("))
-    new_query = "AVG(".join(new_query.split("AVG ("))
-    new_query = "MIN(".join(new_query.split("MIN ("))
-    new_query = "SUM(".join(new_query.split("SUM ("))
-    new_query = "COUNT( *".join(new_query.split("COUNT(*"))
-    new_query = "YEAR(CURDATE())".join(new_query.split("YEAR ( CURDATE ( ) )"))
-
-    return new_query
+    while pos < len(query):
+        match = QUOTE_PATTERN.search(query, pos)
+        if match is None:
+            emit(SPECIAL_PATTERN.sub(r" \g<0> ", query[pos:]))
+            break
+        start = match.start()
+        emit(SPECIAL_PATTERN.sub(r" \g<0> ", query[pos:start]))
+        quote = query[start]
+        end = query.find(quote, start + 1)
+        if end < 0:
+            emit(" " + quote + trim_quoted(query[start + 1:], False))
+            break
+        emit(" " + quote + trim_quoted(query[start + 1:end], True) + quote + " ")
+        pos = end + 1
+    if single_run is not None:
+        run = ''.join(single_run)
+        if not run_has_double:
+            run = '"' + run[1:-1] + '"' if len(run) > 1 else '"'
+        parts.append(run)
+
+    # Remove repeated blank spaces, then spaces that would break SQL functions
+    new_query = ' '.join(''.join(parts).split())
+    return FUNCTION_PATTERN.sub(fix_function, new_query)
+
+def toggles_quote(word):
+    return word.count('"') % 2 == 1
+
+def same_bracket_structure(old, new):
+    """True if swapping old for new cannot change any subquery_range result."""
+    return old is new or (
+        (old == 'SELECT') == (new == 'SELECT') and
+        ('(' in old) == ('(' in new) and
+        (')' in old) == (')' in new) and
+        QUOTE_PATTERN.findall(old) == QUOTE_PATTERN.findall(new))
 
 def subquery_range(current, pos, tokens, in_quote=False):
     if current is not None and tokens[pos] == 'SELECT' and (not in_quote):
@@ -249,12 +257,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0:
-            for char in tokens[end]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[end]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[end]:
+                if '(' in token:
                     depth += 1
-                elif ')' in tokens[end]:
+                elif ')' in token:
                     depth -= 1
             end += 1
         return (start, end)
@@ -264,12 +272,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0 and start > 0:
-            for char in tokens[start]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[start]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[start]:
+                if '(' in token:
                     depth -= 1
-                elif ')' in tokens[start]:
+                elif ')' in token:
                     depth += 1
             start -= 1
         if start != 0:
@@ -285,6 +293,7 @@ def subquery_range(current, pos, tokens, in_quote=False):
 
 ALIAS_PATTERN = re.compile("[A-Za-z0-9_]*")
 def standardise_aliases(query, schema):
+    schema = as_index(schema, SQL_RESERVED_WORDS)
     count = {} # dictionary storing how many times each table has been used
     aliases = {} # dictionary mapping old aliases to standardised aliases
     field_aliases = {}
@@ -297,9 +306,8 @@ def standardise_aliases(query, schema):
     in_quote = False
     if LOGGING: print("Starting tokens:", tokens)
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if word == "FROM":
             if LOGGING: print("Seen from", current_subquery[0], i)
@@ -357,16 +365,23 @@ def standardise_aliases(query, schema):
             print(alias, aliases[alias])
         for field_alias in field_aliases:
             print(field_alias, field_aliases[field_alias])
+    # The token list no longer changes length, so the range of each subquery
+    # holding an alias is worked out once and reused. The stored ranges are
+    # only dropped if a rewritten token could move a bracket or quote.
+    alias_ranges = {}
     in_quote = False
+    previous = None
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if previous is not None and not same_bracket_structure(previous, tokens[i-1]):
+            alias_ranges.clear()
+        previous = word
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if (current_subquery[0], word) in aliases:
             if len(tokens) > i + 1 and tokens[i+1] != "AS":
                 tokens[i] = aliases[current_subquery[0], word]
-        if word in SQL_RESERVED_WORDS and word not in schema[1]:
+        if word in SQL_RESERVED_WORDS and word not in schema.reserved_names:
             continue
         parts = word.split('.')
         if len(parts) == 2:
@@ -379,7 +394,9 @@ def standardise_aliases(query, schema):
                 tokens[i] = table +"."+ field
             else:
                 for alias in aliases:
-                    other = subquery_range((0, -1), alias[0], tokens)
+                    if alias[0] not in alias_ranges:
+                        alias_ranges[alias[0]] = subquery_range((0, -1), alias[0], tokens)
+                    other = alias_ranges[alias[0]]
                     if LOGGING: print("   ", alias, alias[1], parts[0], other[0], current_subquery[0], other[1], i)
                     if alias[1] == parts[0] and other[0] < current_subquery[0] and (other[1] == -1 or other[1] > i):
                         tokens[i] = aliases[alias] +'.'+ parts[1]
@@ -392,19 +409,18 @@ def standardise_aliases(query, schema):
             done = False
             if LOGGING: print(i, word, parts, sf, sw)
             if sf is None or i < sf or (sw is not None and i > sw):
-                for table in schema[0]:
-###                    print(table, schema[0][table])
-                    if word in schema[0][table]:
-###                        print("Found", i, word, table, current_subquery)
-                        for pair in aliases:
-                            alias = aliases[pair]
-                            start = alias.split("alias")[0]
-                            if pair[0] == current_subquery[0] and start == table:
-                                tokens[i] = alias +'.' + word
-                                done = True
-                                break
-                        if done:
+                # Tables holding this column, in fields file order
+                for table in schema.column_tables.get(word, ()):
+###                    print("Found", i, word, table, current_subquery)
+                    for pair in aliases:
+                        alias = aliases[pair]
+                        start = alias.split("alias")[0]
+                        if pair[0] == current_subquery[0] and start == table:
+                            tokens[i] = alias +'.' + word
+                            done = True
                             break
+                    if done:
+                        break
             if (not done) and word in field_aliases:
                 tokens[i] = field_aliases[word]
 
@@ -412,24 +428,74 @@ def standardise_aliases(query, schema):
 
 def tokens_for_chunk(tokens, chunk):
     return tokens[chunk[0]:chunk[1]+1]
-def get_matching_chunk(tokens, chunks, pos, target, default=None):
-    saw_between = False
-    while pos < len(chunks):
-        chunk = chunks[pos]
-        if tokens[chunk[0]].upper() == "BETWEEN":
-            saw_between = True
-        if chunk[0] == chunk[1] and tokens[chunk[0]] == target:
-            if target != "AND" or (not saw_between):
-                return pos
-        if saw_between and tokens[chunk[0]].upper() == 'AND':
-            saw_between = False
-        pos += 1
-    return default
-def sort_chunk_list(start, end, chunks, tokens, separator=","):
+
+class ClauseIndex:
+    """The one-token chunks of a chunk list, by token, so that finding the
+    next keyword or separator is a bisect rather than a scan along the
+    chunks. An AND that follows a BETWEEN (counting from where the search
+    starts) belongs to the BETWEEN and is not matched. After tokens in a
+    range of chunks are rewritten, refresh that range."""
+    def __init__(self, tokens, chunks):
+        self.tokens = tokens
+        self.chunks = chunks
+        self.starts = [tokens[chunk[0]] for chunk in chunks]
+        self.positions = {}
+        # Chunks starting with BETWEEN or AND, which turn the AND rule on and off
+        self.events = []
+        for number, chunk in enumerate(chunks):
+            start = self.starts[number]
+            if chunk[0] == chunk[1]:
+                self.positions.setdefault(start, []).append(number)
+            if start.upper() in ("BETWEEN", "AND"):
+                self.events.append(number)
+
+    def add(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            bisect.insort(self.positions.setdefault(start, []), number)
+        if start.upper() in ("BETWEEN", "AND"):
+            bisect.insort(self.events, number)
+
+    def remove(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            self.positions[start].remove(number)
+        if start.upper() in ("BETWEEN", "AND"):
+            self.events.remove(number)
+
+    def refresh(self, first, last):
+        """Update the index after tokens in chunks first to last changed."""
+        for number in range(first, last + 1):
+            start = self.tokens[self.chunks[number][0]]
+            if start != self.starts[number]:
+                self.remove(number)
+                self.starts[number] = start
+                self.add(number)
+
+    def after_between(self, pos, number):
+        event = bisect.bisect_left(self.events, number) - 1
+        return event >= 0 and self.events[event] >= pos and \
+            self.starts[self.events[event]].upper() == "BETWEEN"
+
+    def find(self, pos, target, default=None):
+        """The first chunk from pos on that is just target, or default."""
+        found = self.positions.get(target, ())
+        place = bisect.bisect_left(found, pos)
+        while place < len(found):
+            if target != "AND" or not self.after_between(pos, found[place]):
+                return found[place]
+            place += 1
+        return default
+
+def sort_chunk_list(start, end, index, separator=","):
+    chunks = index.chunks
+    tokens = index.tokens
     to_rearrange = []
     pos = start
     while pos < end:
-        npos = get_matching_chunk(tokens, chunks, pos + 1, separator)
+        npos = index.find(pos + 1, separator)
         if npos is None or npos > end:
             npos = end - 1
         left = chunks[pos][0]
@@ -463,6 +529,7 @@ def sort_chunk_list(start, end, chunks, tokens, separator=","):
             if cpos <= max_pos:
                 tokens[cpos] = separator
             cpos += 1
+        index.refresh(start, min(end, len(chunks) - 1))
 
 def order_sequence(tokens, start, end, variables):
     # Note - using https://ronsavage.github.io/SQL/sql-92.bnf.html to assist in
@@ -473,9 +540,8 @@ def order_sequence(tokens, start, end, variables):
     chunks = [(start, start)]
     in_quote = False
     while cpos < end:
-        for part in tokens[cpos].split('"'):
+        if toggles_quote(tokens[cpos]):
             in_quote = not in_quote
-        in_quote = not in_quote
         sub = subquery_range(None, cpos, tokens, in_quote)
         if sub is None:
             chunks.append((cpos, cpos))
@@ -485,20 +551,22 @@ def order_sequence(tokens, start, end, variables):
             order_sequence(tokens, sub[0], sub[1] - 1, variables)
             cpos = sub[1]
 
+    index = ClauseIndex(tokens, chunks)
+
     # Handle SELECT
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_select = get_matching_chunk(tokens, chunks, cur_chunk, "SELECT")
+        next_select = index.find(cur_chunk, "SELECT")
         if next_select is None: break
         
-        next_distinct = get_matching_chunk(tokens, chunks, next_select, "DISTINCT")
-        next_all = get_matching_chunk(tokens, chunks, next_select, "ALL")
+        next_distinct = index.find(next_select, "DISTINCT")
+        next_all = index.find(next_select, "ALL")
         if next_distinct == next_select + 1 or next_all == next_select + 1:
             next_select += 1
 
-        next_from = get_matching_chunk(tokens, chunks, next_select, "FROM", len(chunks))
+        next_from = index.find(next_select, "FROM", len(chunks))
 
-        sort_chunk_list(next_select + 1, next_from, chunks, tokens)
+        sort_chunk_list(next_select + 1, next_from, index)
 
         cur_chunk = next_from
     
@@ -506,7 +574,7 @@ def order_sequence(tokens, start, end, variables):
     for symbol in ["=", "!="]:
         cur_chunk = 0
         while cur_chunk < len(chunks):
-            next_equals = get_matching_chunk(tokens, chunks, cur_chunk, symbol)
+            next_equals = index.find(cur_chunk, symbol)
             if next_equals is None:
                 break
             left = tokens_for_chunk(tokens, chunks[next_equals - 1])
@@ -535,31 +603,32 @@ def order_sequence(tokens, start, end, variables):
                 for token in left:
                     tokens[cpos] = token
                     cpos += 1
+                index.refresh(next_equals - 1, next_equals + 1)
 
             cur_chunk = next_equals + 2
 
     #  - Table names in 'from'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_from = get_matching_chunk(tokens, chunks, cur_chunk, "FROM")
+        next_from = index.find(cur_chunk, "FROM")
         if next_from is None: break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_from, "WHERE", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "JOIN", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, ";", len(chunks))
+            index.find(next_from, "WHERE", len(chunks)),
+            index.find(next_from, "JOIN", len(chunks)),
+            index.find(next_from, "GROUP", len(chunks)),
+            index.find(next_from, "HAVING", len(chunks)),
+            index.find(next_from, "LIMIT", len(chunks)),
+            index.find(next_from, "ORDER", len(chunks)),
+            index.find(next_from, ";", len(chunks))
         )
-        sort_chunk_list(next_from + 1, next_item, chunks, tokens)
+        sort_chunk_list(next_from + 1, next_item, index)
         cur_chunk = next_item
 
     #  - Comparisons in 'where'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_where = get_matching_chunk(tokens, chunks, cur_chunk, "WHERE")
+        next_where = index.find(cur_chunk, "WHERE")
         if next_where is None:
             if tokens[chunks[0][0]] != "SELECT" and tokens[chunks[1][1]] != "SELECT":
                 next_where = 0
@@ -567,11 +636,11 @@ def order_sequence(tokens, start, end, variables):
                 break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_where, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, ";", len(chunks))
+            index.find(next_where, "GROUP", len(chunks)),
+            index.find(next_where, "HAVING", len(chunks)),
+            index.find(next_where, "LIMIT", len(chunks)),
+            index.find(next_where, "ORDER", len(chunks)),
+            index.find(next_where, ";", len(chunks))
         )
         has_and = False
         has_or = False
@@ -592,8 +661,8 @@ def order_sequence(tokens, start, end, variables):
             min_pos = min([chunks[v][0] for v in range(next_where + 1, next_item)])
             max_pos = max([chunks[v][1] for v in range(next_where + 1, next_item)])
             ctokens = tokens[min_pos:max_pos+1]
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "AND")
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "OR")
+            sort_chunk_list(next_where + 1, next_item, index, "AND")
+            sort_chunk_list(next_where + 1, next_item, index, "OR")
         cur_chunk = next_item
 
 def order_query(query, variables):
@@ -601,12 +670,35 @@ def order_query(query, variables):
     order_sequence(tokens, 0, len(tokens)-1, variables)
     return ' '.join(tokens)
 
+def make_canonical(query, schema, variables, skip=set()):
+    query = add_semicolon(query)
+    if 'standardise_blank_spaces' not in skip:
+        query = standardise_blank_spaces(query)
+    if 'capitalise' not in skip:
+        query = capitalise(query, variables)
+    if 'standardise_aliases' not in skip:
+        query = standardise_aliases(query, schema)
+    if 'order_query' not in skip:
+        query = order_query(query, variables)
+    return query
+
 def capitalise(query, variables):
     ntokens = []
+    lexed = lex(query)
+    # Variables are passed over without updating the quote state, so if one
+    # contains a quote the lexer's state no longer applies and we track it
+    # here instead.
+    quotes = lexed.quotes
     in_squote, in_dquote = False, False
-    for token in query.split():
+    for pos, token in enumerate(lexed.tokens):
+        if quotes is not None:
+            in_squote, in_dquote = quotes[pos]
         if token in variables or token in ["credit0", "level0", "level1", "number0", "number1", "year0", "business_rating0"]:
             ntokens.append(token)
+            if "'" in token or '"' in token:
+                quotes = None
+        elif not ("'" in token or '"' in token):
+            ntokens.append(token if in_squote or in_dquote else token.upper())
         else:
             modified = []
             for char in token:
@@ -642,129 +734,195 @@ def question_tokenise(question):
 def is_num(token):
     return all(c in '1234567890.' for c in token)
 
+def read_schema(schema_filename):
+    return load_schema(schema_filename, SQL_RESERVED_WORDS)
+
 punctuation = ['.', ',', '(', ')']
-def standarise_file(original, log, skip):
+def read_schemas(tables_filename, write_file):
+    """Compile the schema of each database, writing its fields to the csv file."""
     schemas = {}
-    schema_info = json.load(open("tables.json"))
-
-    with open("spider-schemas.csv", 'w') as write_file:
-        print("Database name, Table Name, Field Name, Is Primary Key, Is Foreign Key, Type", file=write_file)
-        for db in schema_info:
-            name = db['db_id']
-            all_words = set()
-            schema = {}
-            for i, column in enumerate(db['column_names']):
-                table = '_'.join(db['table_names'][column[0]].split()).upper()
-                field = '_'.join(column[1].split()).upper()
-                schema.setdefault(table, set()).add(field)
-                all_words.add(table)
-                all_words.add(field)
-                ctype = db['column_types'][i]
-                primary = i in db['primary_keys']
-                foreign =  i in db['foreign_keys']
-                if i > 0:
-                    print("{}, {}, {}, {}, {}, {}".format(name, table, field, primary, foreign, ctype), file=write_file)
-            schemas[name] = (schema, all_words)
-
-    # Canonicalise
-    for example in original:
-        schema = schemas[example['sentences'][0]['database']]
-        query = example['sql-original'][0]
-        question = example['sentences'][0]['original']
-
-        if log:
-            print(question)
-            print(query)
-
-        question = question_tokenise(question)
-
-        if 'add_semicolon' not in skip:
-            query = add_semicolon(query)
-        if 'standardise_blank_spaces' not in skip:
-            query = standardise_blank_spaces(query)
-    
-        # Variables
-        variables = []
-        tokens = question.split()
-        current = (None, None)
-        nquery = []
-        prev = None
-        for token in query.split():
-            used = False
-            if current[0] is not None:
-                if token.endswith(current[0]):
-                    current[1].append(token[:-1])
-                    var = ' '.join(current[1])
-                    if var[0] == '%' and var[-1] == '%' and len(var) > 2:
-                        var = var[1:-1]
-                    nquery.append('"' + "var"+ str(len(variables)) + '"')
+    schema_info = json.load(open(tables_filename))
+
+    print("Database name, Table Name, Field Name, Is Primary Key, Is Foreign Key, Type", file=write_file)
+    for db in schema_info:
+        # Each foreign key is a [referencing column, referenced column] pair
+        foreign_columns = {pair[0] for pair in db['foreign_keys']}
+        name = db['db_id']
+        all_words = set()
+        schema = {}
+        for i, column in enumerate(db['column_names']):
+            table = '_'.join(db['table_names'][column[0]].split()).upper()
+            field = '_'.join(column[1].split()).upper()
+            schema.setdefault(table, set()).add(field)
+            all_words.add(table)
+            all_words.add(field)
+            ctype = db['column_types'][i]
+            primary = i in db['primary_keys']
+            foreign = i in foreign_columns
+            if i > 0:
+                print("{}, {}, {}, {}, {}, {}".format(name, table, field, primary, foreign, ctype), file=write_file)
+        schemas[name] = compile_schema(schema, all_words, SQL_RESERVED_WORDS)
+    return schemas
+
+def code_version():
+    """Hashes of this file and of the tools it uses, so that editing any of
+    them invalidates saved schemas."""
+    return ' '.join(file_hash(filename) for filename in [__file__, common.__file__, json_stream.__file__, multi_match.__file__, schema_index.__file__, sql_lexer.__file__])
+
+def load_schemas(tables_filename, csv_filename, cache_filename):
+    """read_schemas, but reusing the last result if tables.json has not
+    changed since it was saved to cache_filename."""
+    key = file_hash(tables_filename) + ' ' + code_version()
+    if os.path.exists(cache_filename) and os.path.exists(csv_filename):
+        with open(cache_filename, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached['key'] == key:
+            return cached['schemas']
+
+    with open(csv_filename, 'w') as write_file:
+        schemas = read_schemas(tables_filename, write_file)
+    tmp_name = cache_filename + '.tmp'
+    with open(tmp_name, 'wb') as cache_file:
+        pickle.dump({'key': key, 'schemas': schemas}, cache_file)
+    os.replace(tmp_name, cache_filename)
+    return schemas
+
+def convert_example(example, schema, log, skip):
+    """Pull the variables out of one example and canonicalise its query."""
+    query = example['sql-original'][0]
+    question = example['sentences'][0]['original']
+
+    if log:
+        print(question)
+        print(query)
+
+    question = question_tokenise(question)
+
+    if 'add_semicolon' not in skip:
+        query = add_semicolon(query)
+    if 'standardise_blank_spaces' not in skip:
+        query = standardise_blank_spaces(query)
+
+    # Variables
+    variables = []
+    tokens = question.split()
+    current = (None, None)
+    nquery = []
+    prev = None
+    for token in query.split():
+        used = False
+        if current[0] is not None:
+            if token.endswith(current[0]):
+                current[1].append(token[:-1])
+                var = ' '.join(current[1])
+                if var[0] == '%' and var[-1] == '%' and len(var) > 2:
+                    var = var[1:-1]
+                nquery.append('"' + "var"+ str(len(variables)) + '"')
+                variables.append(var)
+                current = (None, None)
+                used = True
+            else:
+                current[1].append(token)
+                used = True
+        elif token.startswith('"') or token.startswith("'"):
+            if token.endswith(token[0]):
+                if len(token) > 2:
+                    var = token[1:-1]
+                    if var.endswith("/%"):
+                        var = var[:-2]
+                        nquery.append('"' + "var"+ str(len(variables)) + '/%"')
+                    else:
+                        if var[0] == '%' and var[-1] == '%':
+                            var = var[1:-1]
+                        nquery.append('"' + "var"+ str(len(variables)) + '"')
                     variables.append(var)
-                    current = (None, None)
-                    used = True
-                else:
-                    current[1].append(token)
-                    used = True
-            elif token.startswith('"') or token.startswith("'"):
-                if token.endswith(token[0]):
-                    if len(token) > 2:
-                        var = token[1:-1]
-                        if var.endswith("/%"):
-                            var = var[:-2]
-                            nquery.append('"' + "var"+ str(len(variables)) + '/%"')
-                        else:
-                            if var[0] == '%' and var[-1] == '%':
-                                var = var[1:-1]
-                            nquery.append('"' + "var"+ str(len(variables)) + '"')
-                        variables.append(var)
-                        used = True
-                else:
-                    current = (token[0], [token[1:]])
                     used = True
             else:
-                if token in tokens and token.upper() not in schema[1] and token not in punctuation:
-                    nquery.append("var"+ str(len(variables)))
-                    variables.append(token)
-                    used = True
-                elif is_num(token) and (prev != "LIMIT" or token != "1"):
-                    nquery.append("var"+ str(len(variables)))
-                    variables.append(token)
-                    used = True
-
-            if not used:
-                nquery.append(token)
-            prev = token
-        if log:
-            print(' '.join(nquery))
-        query = ' '.join(nquery)
-        final_variables = example['variables']
-        for i, var in enumerate(variables):
-            name = "var"+ str(i)
-            location = 'sql-only'
-            if var in question:
-                location = 'both'
-                example['sentences'][0]['variables'][name] = var
+                current = (token[0], [token[1:]])
+                used = True
+        else:
+            if token in tokens and token.upper() not in schema[1] and token not in punctuation:
+                nquery.append("var"+ str(len(variables)))
+                variables.append(token)
+                used = True
+            elif is_num(token) and (prev != "LIMIT" or token != "1"):
+                nquery.append("var"+ str(len(variables)))
+                variables.append(token)
+                used = True
+
+        if not used:
+            nquery.append(token)
+        prev = token
+    if log:
+        print(' '.join(nquery))
+    query = ' '.join(nquery)
+    final_variables = example['variables']
+    names = ["var"+ str(i) for i in range(len(variables))]
+    located = locate_variables(question, variables, variables, names)
+    if located is not None:
+        question = apply_spans(question, located[1])
+    for i, var in enumerate(variables):
+        name = names[i]
+        location = 'sql-only'
+        if located is not None:
+            both = located[0][i]
+        else:
+            # Replacements interact, so go one variable at a time
+            both = var in question
+            if both:
                 question = name.join(question.split(var))
-            final_variables.append({
-                'example': var,
-                'location': location,
-                'name': name,
-                'type': "unknown",
-            })
-        variables = ['var'+ str(i) for i in range(len(variables))]
-        if 'capitalise' not in skip:
-            query = capitalise(query, variables)
-        if 'standardise_aliases' not in skip:
-            query = standardise_aliases(query, schema)
-        if 'order_query' not in skip:
-            query = order_query(query, variables)
-
-        example['sql'] = [query]
-        example['sentences'][0]['text'] = question
-
-        if log:
-            print(example['sql'][0])
-            print(question)
-            print()
+        if both:
+            location = 'both'
+            example['sentences'][0]['variables'][name] = var
+        final_variables.append({
+            'example': var,
+            'location': location,
+            'name': name,
+            'type': "unknown",
+        })
+    variables = ['var'+ str(i) for i in range(len(variables))]
+    if 'capitalise' not in skip:
+        query = capitalise(query, variables)
+    if 'standardise_aliases' not in skip:
+        query = standardise_aliases(query, schema)
+    if 'order_query' not in skip:
+        query = order_query(query, variables)
+
+    example['sql'] = [query]
+    example['sentences'][0]['text'] = question
+
+    if log:
+        print(example['sql'][0])
+        print(question)
+        print()
+    return example
+
+def convert_database(job):
+    """Convert the (position, example) pairs for one database."""
+    schema, examples, log, skip = job
+    return [(position, convert_example(example, schema, log, skip)) for position, example in examples]
+
+def standarise_file(original, log, skip, jobs=1):
+    schemas = load_schemas("tables.json", "spider-schemas.csv", "spider-schemas.cache")
+
+    # Canonicalise
+    if jobs > 1:
+        # Each worker gets the examples for one database and only its schema
+        by_database = {}
+        for position, example in enumerate(original):
+            by_database.setdefault(example['sentences'][0]['database'], []).append((position, example))
+        groups = sorted(by_database.items(), key=lambda item: -len(item[1]))
+        pool = multiprocessing.Pool(jobs)
+        converted = [None for _ in original]
+        for results in pool.imap_unordered(convert_database, [(schemas[db], examples, log, skip) for db, examples in groups]):
+            for position, example in results:
+                converted[position] = example
+        pool.close()
+        pool.join()
+        original = converted
+    else:
+        for example in original:
+            convert_example(example, schemas[example['sentences'][0]['database']], log, skip)
 
     # Merge duplicates
     final = []
@@ -779,13 +937,10 @@ def standarise_file(original, log, skip):
 
     # Print to file
     with open("spider.json", 'w') as write_file:
-        to_print = json.dumps(final, indent=4, sort_keys=True)
-        for line in to_print.split("\n"):
-            line = line.rstrip()
-            print(line, file=write_file)
+        write_examples(final, write_file)
 
 def add_data(filename, split, data, seen):
-    for example in json.load(open(filename)):
+    for example in read_examples(open(filename)):
         question = example['question']
         query = ' '.join(example['query'].split())
         db = example['db_id']
@@ -814,8 +969,10 @@ if __name__ == '__main__':
     parser.add_argument('--testscholar', help='Run scholar test cases and exit.', action='store_true')
     parser.add_argument('--testgeo', help='Run geo test cases and exit.', action='store_true')
     parser.add_argument('--testyelp', help='Run yelp test cases and exit.', action='store_true')
+    parser.add_argument('--fields', help='The tables and fields for the test queries.')
     parser.add_argument('--log', help='Print SQL before and after.', action='store_true')
     parser.add_argument('--skip', help='Functions that should not be applied (choices are [add_semicolon, standardise_blank_spaces, capitalise, standardise_aliases, order_query]).')
+    parser.add_argument('--jobs', help='Number of worker processes, each converting the examples for one database at a time.', type=int, default=1)
     args = parser.parse_args()
 
 
@@ -831,11 +988,13 @@ if __name__ == '__main__':
         add_data("train_others.json", "train", ours, seen)
         add_data("dev.json", "dev", ours, seen)
 
-        standarise_file(ours, args.log, skip)
+        standarise_file(ours, args.log, skip, args.jobs)
 
         # TODO:
         # - Automatically extract variables by finding stuff that occurs in both query and question
     else:
+        if args.fields is None:
+            parser.error("the test cases need --fields")
         sample_queries = [
             ("select * from student where student.s_id < 5",
             "SELECT * FROM STUDENT AS STUDENTalias0 WHERE STUDENTalias0.S_ID < 5 ;"),
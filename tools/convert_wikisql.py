@@ -15,7 +15,15 @@ import string
 import json
 import sys
 import argparse
-from lib.query import Query
+import bisect
+import bz2
+import itertools
+import multiprocessing
+import zlib
+from json_stream import write_examples
+from multi_match import apply_spans, locate_variables
+from schema_index import as_index, compile_schema, load_schema
+from sql_lexer import lex, update_quotes, update_token_quotes
 
 LOGGING = False
 
@@ -126,13 +134,6 @@ def add_semicolon(query):
         return query + ' ;'
     return query
 
-def update_quotes(char, in_single, in_double):
-    if char == '"' and not in_single:
-        in_double = not in_double
-    elif char == "'" and not in_double:
-        in_single = not in_single
-    return in_single, in_double
-
 def standardise_blank_spaces(query):
 ###    # split on special characters except _.:-
 ###    in_squote, in_dquote = False, False
@@ -241,6 +242,18 @@ def standardise_blank_spaces(query):
 
     return new_query
 
+QUOTE_PATTERN = re.compile("['\"]")
+
+def toggles_quote(word):
+    return word.count('"') % 2 == 1
+
+def same_bracket_structure(old, new):
+    """True if swapping old for new cannot change any subquery_range result."""
+    return old is new or (
+        ('(' in old) == ('(' in new) and
+        (')' in old) == (')' in new) and
+        QUOTE_PATTERN.findall(old) == QUOTE_PATTERN.findall(new))
+
 def subquery_range(current, pos, tokens, in_quote=False):
     if tokens[pos] == '(' and (not in_quote):
         start = pos
@@ -248,12 +261,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0:
-            for char in tokens[end]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[end]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[end]:
+                if '(' in token:
                     depth += 1
-                elif ')' in tokens[end]:
+                elif ')' in token:
                     depth -= 1
             end += 1
         return (start, end)
@@ -263,12 +276,12 @@ def subquery_range(current, pos, tokens, in_quote=False):
         depth = 1
         in_squote, in_dquote = False, False
         while depth > 0 and start > 0:
-            for char in tokens[start]:
-                in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
+            token = tokens[start]
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
             if not (in_squote or in_dquote):
-                if '(' in tokens[start]:
+                if '(' in token:
                     depth -= 1
-                elif ')' in tokens[start]:
+                elif ')' in token:
                     depth += 1
             start -= 1
         if start != 0:
@@ -284,6 +297,7 @@ def subquery_range(current, pos, tokens, in_quote=False):
 
 ALIAS_PATTERN = re.compile("[A-Za-z0-9_]*")
 def standardise_aliases(query, schema):
+    schema = as_index(schema, SQL_RESERVED_WORDS)
     count = {} # dictionary storing how many times each table has been used
     aliases = {} # dictionary mapping old aliases to standardised aliases
     field_aliases = {}
@@ -295,9 +309,8 @@ def standardise_aliases(query, schema):
     seen_where = {}
     in_quote = False
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if word == "FROM":
             if LOGGING: print("Seen from", current_subquery[0], i)
@@ -353,16 +366,23 @@ def standardise_aliases(query, schema):
             print(alias, aliases[alias])
         for field_alias in field_aliases:
             print(field_alias, field_aliases[field_alias])
+    # The token list no longer changes length, so the range of each subquery
+    # holding an alias is worked out once and reused. The stored ranges are
+    # only dropped if a rewritten token could move a bracket or quote.
+    alias_ranges = {}
     in_quote = False
+    previous = None
     for i, word in enumerate(tokens):
-        for part in word.split('"'):
+        if previous is not None and not same_bracket_structure(previous, tokens[i-1]):
+            alias_ranges.clear()
+        previous = word
+        if toggles_quote(word):
             in_quote = not in_quote
-        in_quote = not in_quote
         current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
         if (current_subquery[0], word) in aliases:
             if len(tokens) > i + 1 and tokens[i+1] != "AS":
                 tokens[i] = aliases[current_subquery[0], word]
-        if word in SQL_RESERVED_WORDS and word not in schema[1]:
+        if word in SQL_RESERVED_WORDS and word not in schema.reserved_names:
             continue
         parts = word.split('.')
         if len(parts) == 2:
@@ -375,7 +395,9 @@ def standardise_aliases(query, schema):
                 tokens[i] = table +"."+ field
             else:
                 for alias in aliases:
-                    other = subquery_range((0, -1), alias[0], tokens)
+                    if alias[0] not in alias_ranges:
+                        alias_ranges[alias[0]] = subquery_range((0, -1), alias[0], tokens)
+                    other = alias_ranges[alias[0]]
                     if LOGGING: print("   ", alias, alias[1], parts[0], other[0], current_subquery[0], other[1], i)
                     if alias[1] == parts[0] and other[0] < current_subquery[0] and (other[1] == -1 or other[1] > i):
                         tokens[i] = aliases[alias] +'.'+ parts[1]
@@ -387,19 +409,18 @@ def standardise_aliases(query, schema):
             sw = seen_where.get(current_subquery[0], None)
             done = False
             if sf is None or i < sf or (sw is not None and i > sw):
-                for table in schema[0]:
-###                    print(table, schema[0][table])
-                    if word in schema[0][table]:
-###                        print("Found", i, word, table, current_subquery)
-                        for pair in aliases:
-                            alias = aliases[pair]
-                            start = alias.split("alias")[0]
-                            if pair[0] == current_subquery[0] and start == table:
-                                tokens[i] = alias +'.' + word
-                                done = True
-                                break
-                        if done:
+                # Tables holding this column, in fields file order
+                for table in schema.column_tables.get(word, ()):
+###                    print("Found", i, word, table, current_subquery)
+                    for pair in aliases:
+                        alias = aliases[pair]
+                        start = alias.split("alias")[0]
+                        if pair[0] == current_subquery[0] and start == table:
+                            tokens[i] = alias +'.' + word
+                            done = True
                             break
+                    if done:
+                        break
             if (not done) and word in field_aliases:
                 tokens[i] = field_aliases[word]
 
@@ -407,24 +428,74 @@ def standardise_aliases(query, schema):
 
 def tokens_for_chunk(tokens, chunk):
     return tokens[chunk[0]:chunk[1]+1]
-def get_matching_chunk(tokens, chunks, pos, target, default=None):
-    saw_between = False
-    while pos < len(chunks):
-        chunk = chunks[pos]
-        if tokens[chunk[0]].upper() == "BETWEEN":
-            saw_between = True
-        if chunk[0] == chunk[1] and tokens[chunk[0]] == target:
-            if target != "AND" or (not saw_between):
-                return pos
-        if saw_between and tokens[chunk[0]].upper() == 'AND':
-            saw_between = False
-        pos += 1
-    return default
-def sort_chunk_list(start, end, chunks, tokens, separator=","):
+
+class ClauseIndex:
+    """The one-token chunks of a chunk list, by token, so that finding the
+    next keyword or separator is a bisect rather than a scan along the
+    chunks. An AND that follows a BETWEEN (counting from where the search
+    starts) belongs to the BETWEEN and is not matched. After tokens in a
+    range of chunks are rewritten, refresh that range."""
+    def __init__(self, tokens, chunks):
+        self.tokens = tokens
+        self.chunks = chunks
+        self.starts = [tokens[chunk[0]] for chunk in chunks]
+        self.positions = {}
+        # Chunks starting with BETWEEN or AND, which turn the AND rule on and off
+        self.events = []
+        for number, chunk in enumerate(chunks):
+            start = self.starts[number]
+            if chunk[0] == chunk[1]:
+                self.positions.setdefault(start, []).append(number)
+            if start.upper() in ("BETWEEN", "AND"):
+                self.events.append(number)
+
+    def add(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            bisect.insort(self.positions.setdefault(start, []), number)
+        if start.upper() in ("BETWEEN", "AND"):
+            bisect.insort(self.events, number)
+
+    def remove(self, number):
+        start = self.starts[number]
+        chunk = self.chunks[number]
+        if chunk[0] == chunk[1]:
+            self.positions[start].remove(number)
+        if start.upper() in ("BETWEEN", "AND"):
+            self.events.remove(number)
+
+    def refresh(self, first, last):
+        """Update the index after tokens in chunks first to last changed."""
+        for number in range(first, last + 1):
+            start = self.tokens[self.chunks[number][0]]
+            if start != self.starts[number]:
+                self.remove(number)
+                self.starts[number] = start
+                self.add(number)
+
+    def after_between(self, pos, number):
+        event = bisect.bisect_left(self.events, number) - 1
+        return event >= 0 and self.events[event] >= pos and \
+            self.starts[self.events[event]].upper() == "BETWEEN"
+
+    def find(self, pos, target, default=None):
+        """The first chunk from pos on that is just target, or default."""
+        found = self.positions.get(target, ())
+        place = bisect.bisect_left(found, pos)
+        while place < len(found):
+            if target != "AND" or not self.after_between(pos, found[place]):
+                return found[place]
+            place += 1
+        return default
+
+def sort_chunk_list(start, end, index, separator=","):
+    chunks = index.chunks
+    tokens = index.tokens
     to_rearrange = []
     pos = start
     while pos < end:
-        npos = get_matching_chunk(tokens, chunks, pos + 1, separator)
+        npos = index.find(pos + 1, separator)
         if npos is None or npos > end:
             npos = end - 1
         left = chunks[pos][0]
@@ -458,6 +529,7 @@ def sort_chunk_list(start, end, chunks, tokens, separator=","):
             if cpos <= max_pos:
                 tokens[cpos] = separator
             cpos += 1
+        index.refresh(start, min(end, len(chunks) - 1))
 
 def order_sequence(tokens, start, end, variables):
     # Note - using https://ronsavage.github.io/SQL/sql-92.bnf.html to assist in
@@ -468,9 +540,8 @@ def order_sequence(tokens, start, end, variables):
     chunks = [(start, start)]
     in_quote = False
     while cpos < end:
-        for part in tokens[cpos].split('"'):
+        if toggles_quote(tokens[cpos]):
             in_quote = not in_quote
-        in_quote = not in_quote
         sub = subquery_range(None, cpos, tokens, in_quote)
         if sub is None:
             chunks.append((cpos, cpos))
@@ -480,20 +551,22 @@ def order_sequence(tokens, start, end, variables):
             order_sequence(tokens, sub[0], sub[1] - 1, variables)
             cpos = sub[1]
 
+    index = ClauseIndex(tokens, chunks)
+
     # Handle SELECT
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_select = get_matching_chunk(tokens, chunks, cur_chunk, "SELECT")
+        next_select = index.find(cur_chunk, "SELECT")
         if next_select is None: break
         
-        next_distinct = get_matching_chunk(tokens, chunks, next_select, "DISTINCT")
-        next_all = get_matching_chunk(tokens, chunks, next_select, "ALL")
+        next_distinct = index.find(next_select, "DISTINCT")
+        next_all = index.find(next_select, "ALL")
         if next_distinct == next_select + 1 or next_all == next_select + 1:
             next_select += 1
 
-        next_from = get_matching_chunk(tokens, chunks, next_select, "FROM", len(chunks))
+        next_from = index.find(next_select, "FROM", len(chunks))
 
-        sort_chunk_list(next_select + 1, next_from, chunks, tokens)
+        sort_chunk_list(next_select + 1, next_from, index)
 
         cur_chunk = next_from
     
@@ -501,7 +574,7 @@ def order_sequence(tokens, start, end, variables):
     for symbol in ["=", "!="]:
         cur_chunk = 0
         while cur_chunk < len(chunks):
-            next_equals = get_matching_chunk(tokens, chunks, cur_chunk, symbol)
+            next_equals = index.find(cur_chunk, symbol)
             if next_equals is None:
                 break
             left = tokens_for_chunk(tokens, chunks[next_equals - 1])
@@ -530,31 +603,32 @@ def order_sequence(tokens, start, end, variables):
                 for token in left:
                     tokens[cpos] = token
                     cpos += 1
+                index.refresh(next_equals - 1, next_equals + 1)
 
             cur_chunk = next_equals + 2
 
     #  - Table names in 'from'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_from = get_matching_chunk(tokens, chunks, cur_chunk, "FROM")
+        next_from = index.find(cur_chunk, "FROM")
         if next_from is None: break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_from, "WHERE", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "JOIN", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, ";", len(chunks))
+            index.find(next_from, "WHERE", len(chunks)),
+            index.find(next_from, "JOIN", len(chunks)),
+            index.find(next_from, "GROUP", len(chunks)),
+            index.find(next_from, "HAVING", len(chunks)),
+            index.find(next_from, "LIMIT", len(chunks)),
+            index.find(next_from, "ORDER", len(chunks)),
+            index.find(next_from, ";", len(chunks))
         )
-        sort_chunk_list(next_from + 1, next_item, chunks, tokens)
+        sort_chunk_list(next_from + 1, next_item, index)
         cur_chunk = next_item
 
     #  - Comparisons in 'where'
     cur_chunk = 0
     while cur_chunk < len(chunks):
-        next_where = get_matching_chunk(tokens, chunks, cur_chunk, "WHERE")
+        next_where = index.find(cur_chunk, "WHERE")
         if next_where is None:
             if tokens[chunks[0][0]] != "SELECT" and tokens[chunks[1][1]] != "SELECT":
                 next_where = 0
@@ -562,11 +636,11 @@ def order_sequence(tokens, start, end, variables):
                 break
 
         next_item = min(
-            get_matching_chunk(tokens, chunks, next_where, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, ";", len(chunks))
+            index.find(next_where, "GROUP", len(chunks)),
+            index.find(next_where, "HAVING", len(chunks)),
+            index.find(next_where, "LIMIT", len(chunks)),
+            index.find(next_where, "ORDER", len(chunks)),
+            index.find(next_where, ";", len(chunks))
         )
         has_and = False
         has_or = False
@@ -587,8 +661,8 @@ def order_sequence(tokens, start, end, variables):
             min_pos = min([chunks[v][0] for v in range(next_where + 1, next_item)])
             max_pos = max([chunks[v][1] for v in range(next_where + 1, next_item)])
             ctokens = tokens[min_pos:max_pos+1]
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "AND")
-            sort_chunk_list(next_where + 1, next_item, chunks, tokens, "OR")
+            sort_chunk_list(next_where + 1, next_item, index, "AND")
+            sort_chunk_list(next_where + 1, next_item, index, "OR")
         cur_chunk = next_item
 
 def order_query(query, variables):
@@ -596,12 +670,35 @@ def order_query(query, variables):
     order_sequence(tokens, 0, len(tokens)-1, variables)
     return ' '.join(tokens)
 
+def make_canonical(query, schema, variables, skip=set()):
+    query = add_semicolon(query)
+    if 'standardise_blank_spaces' not in skip:
+        query = standardise_blank_spaces(query)
+    if 'capitalise' not in skip:
+        query = capitalise(query, variables)
+    if 'standardise_aliases' not in skip:
+        query = standardise_aliases(query, schema)
+    if 'order_query' not in skip:
+        query = order_query(query, variables)
+    return query
+
 def capitalise(query, variables):
     ntokens = []
+    lexed = lex(query)
+    # Variables are passed over without updating the quote state, so if one
+    # contains a quote the lexer's state no longer applies and we track it
+    # here instead.
+    quotes = lexed.quotes
     in_squote, in_dquote = False, False
-    for token in query.split():
+    for pos, token in enumerate(lexed.tokens):
+        if quotes is not None:
+            in_squote, in_dquote = quotes[pos]
         if token in variables or token in ["credit0", "level0", "level1", "number0", "number1", "year0", "business_rating0"]:
             ntokens.append(token)
+            if "'" in token or '"' in token:
+                quotes = None
+        elif not ("'" in token or '"' in token):
+            ntokens.append(token if in_squote or in_dquote else token.upper())
         else:
             modified = []
             for char in token:
@@ -638,85 +735,108 @@ def is_num(token):
     return all(c in '1234567890.' for c in token)
 
 COL_PATTERN = re.compile("col[0-9]+")
-punctuation = ['.', ',', '(', ')']
-def standarise_file(log, skip):
-    original = []
-    add_data("data/train.jsonl", "train", original)
-    add_data("data/dev.jsonl", "dev", original)
-    add_data("data/test.jsonl", "test", original)
+def read_schema(schema_filename):
+    return load_schema(schema_filename, SQL_RESERVED_WORDS)
 
+punctuation = ['.', ',', '(', ')']
+def read_tables(schema_filenames):
+    """Yield each WikiSQL table, as parsed from the tables files."""
+    for name in schema_filenames:
+        for line in open(name):
+            yield json.loads(line)
+
+def read_schemas(raw_schemas, write_file=None, keep=None):
+    """Compile the WikiSQL tables, writing each field to the schema csv file.
+
+    If keep is given, only tables whose id it accepts are returned, though
+    every table is still written.
+    """
     schemas = {}
     column_to_name = {}
-    with open("wikisql.canonical-schemas.csv", 'w') as write_file:
+    if write_file is not None:
         print("Database name, Table Name, Field Name, Is Primary Key, Is Foreign Key, Type", file=write_file)
-        for name in ['data/train.tables.jsonl', 'data/dev.tables.jsonl', 'data/test.tables.jsonl']:
-            for line in open(name):
-                raw_schema = json.loads(line)
-###                print(json.dumps(schema, indent=4))
-###                print([k for k in schema.keys()])
-                fields = raw_schema['header']
-                name = raw_schema['id']
-
-                all_words = {"TABLE"}
-                schema = {}
-                for i, (field, ctype) in enumerate(zip(raw_schema['header'], raw_schema['types'])):
-                    field = '_'.join(field.split()).upper() +"_FIELD"
-                    column_to_name[name, i] = field
-                    schema.setdefault("TABLE", set()).add(field)
-                    all_words.add(field)
-                    primary = True
-                    foreign = False
-                    print("{}, {}, {}, {}, {}, {}".format(name, "TABLE", field, primary, foreign, ctype), file=write_file)
-                schemas[name] = (schema, all_words)
-
-    # Canonicalise
-    for example in original:
-        schema = schemas[example['sentences'][0]['table-id']]
-        query = example['sql-original'][0]
-        question = example['sentences'][0]['original']
-
-        if log:
-            print(question)
-            print(query)
-
-        # Variables
-        variables = []
-        current = []
-        nquery = []
-        tokens = query.strip().split()
-        for i, token in enumerate(tokens):
-            reset = None
-            if token in ["SUM", "AVG", "MIN", "MAX", "COUNT", "<", ">", "AND", "WHERE", "SELECT", "FROM", "=", "table", "TABLE", ";"]:
-                reset = token
-            elif re.fullmatch(COL_PATTERN, token):
-                num = int(token[3:])
-                field = column_to_name[example['sentences'][0]['table-id'], num]
-                reset = field 
-            else:
-                current.append(token)
-
-            if reset is not None or len(tokens) == i + 1:
-                if len(current) > 0:
-                    var = ' '.join(current)
-                    name = "var"+ str(len(variables))
-                    if len(current) > 1:
-                        name = '"' + name +'"'
-                    nquery.append(name)
-                    variables.append(var)
-                    current = []
-            if reset is not None:
-                nquery.append(reset)
-        query = ' '.join(nquery)
-        if log:
-            print(query)
-
-        final_variables = example['variables']
-        for i, var in enumerate(variables):
-            name = "var"+ str(i)
-            location = 'sql-only'
-            if var.lower() in question.lower():
-                location = 'both'
-                example['sentences'][0]['variables'][name] = var
+    for raw_schema in raw_schemas:
+###        print(json.dumps(schema, indent=4))
+###        print([k for k in schema.keys()])
+        fields = raw_schema['header']
+        name = raw_schema['id']
+        kept = keep is None or keep(name)
+
+        all_words = {"TABLE"}
+        schema = {}
+        for i, (field, ctype) in enumerate(zip(raw_schema['header'], raw_schema['types'])):
+            field = '_'.join(field.split()).upper() +"_FIELD"
+            if kept:
+                column_to_name[name, i] = field
+            schema.setdefault("TABLE", set()).add(field)
+            all_words.add(field)
+            primary = True
+            foreign = False
+            if write_file is not None:
+                print("{}, {}, {}, {}, {}, {}".format(name, "TABLE", field, primary, foreign, ctype), file=write_file)
+        if kept:
+            schemas[name] = compile_schema(schema, all_words, SQL_RESERVED_WORDS)
+    return schemas, column_to_name
+
+def convert_example(example, schemas, column_to_name, log, skip):
+    """Pull the variables out of one example and canonicalise its query."""
+    schema = schemas[example['sentences'][0]['table-id']]
+    query = example['sql-original'][0]
+    question = example['sentences'][0]['original']
+
+    if log:
+        print(question)
+        print(query)
+
+    # Variables
+    variables = []
+    current = []
+    nquery = []
+    tokens = query.strip().split()
+    for i, token in enumerate(tokens):
+        reset = None
+        if token in ["SUM", "AVG", "MIN", "MAX", "COUNT", "<", ">", "AND", "WHERE", "SELECT", "FROM", "=", "table", "TABLE", ";"]:
+            reset = token
+        elif re.fullmatch(COL_PATTERN, token):
+            num = int(token[3:])
+            field = column_to_name[example['sentences'][0]['table-id'], num]
+            reset = field 
+        else:
+            current.append(token)
+
+        if reset is not None or len(tokens) == i + 1:
+            if len(current) > 0:
+                var = ' '.join(current)
+                name = "var"+ str(len(variables))
+                if len(current) > 1:
+                    name = '"' + name +'"'
+                nquery.append(name)
+                variables.append(var)
+                current = []
+        if reset is not None:
+            nquery.append(reset)
+    query = ' '.join(nquery)
+    if log:
+        print(query)
+
+    final_variables = example['variables']
+    names = ["var"+ str(i) for i in range(len(variables))]
+    located = None
+    lower = question.lower()
+    # Positions in the lowercased question only carry over if the lengths match
+    if len(lower) == len(question):
+        located = locate_variables(lower, [var.lower() for var in variables], variables, names)
+    if located is not None:
+        question = apply_spans(question, located[1])
+    for i, var in enumerate(variables):
+        name = names[i]
+        location = 'sql-only'
+        if located is not None:
+            both = located[0][i]
+        else:
+            # Replacements interact, so go one variable at a time
+            both = var.lower() in question.lower()
+            if both:
                 lower_split = question.lower().split(var)
                 parts = [len(v) for v in lower_split]
                 nquestion = []
@@ -725,79 +845,175 @@ def standarise_file(log, skip):
                     nquestion.append(name)
                     question = question[i + len(var):]
                 question = ''.join(nquestion[:-1])
-            final_variables.append({
-                'example': var,
-                'location': location,
-                'name': name,
-                'type': "unknown",
-            })
-        variables = ['var'+ str(i) for i in range(len(variables))]
-
-        question = question_tokenise(question)
-
-        if 'add_semicolon' not in skip:
-            query = add_semicolon(query)
-        if 'standardise_blank_spaces' not in skip:
-            query = standardise_blank_spaces(query)
-        if 'capitalise' not in skip:
-            query = capitalise(query, variables)
-        if 'standardise_aliases' not in skip:
-            query = standardise_aliases(query, schema)
-        if 'order_query' not in skip:
-            query = order_query(query, variables)
-
-        example['sql'] = [query]
-        example['sentences'][0]['text'] = question
-
-        if log:
-            print(example['sql'][0])
-            print(question)
-            print()
-
-    # Merge duplicates
-    final = []
+        if both:
+            location = 'both'
+            example['sentences'][0]['variables'][name] = var
+        final_variables.append({
+            'example': var,
+            'location': location,
+            'name': name,
+            'type': "unknown",
+        })
+    variables = ['var'+ str(i) for i in range(len(variables))]
+
+    question = question_tokenise(question)
+
+    if 'add_semicolon' not in skip:
+        query = add_semicolon(query)
+    if 'standardise_blank_spaces' not in skip:
+        query = standardise_blank_spaces(query)
+    if 'capitalise' not in skip:
+        query = capitalise(query, variables)
+    if 'standardise_aliases' not in skip:
+        query = standardise_aliases(query, schema)
+    if 'order_query' not in skip:
+        query = order_query(query, variables)
+
+    example['sql'] = [query]
+    example['sentences'][0]['text'] = question
+
+    if log:
+        print(example['sql'][0])
+        print(question)
+        print()
+    return example
+
+SCHEMA_FILES = ['data/train.tables.jsonl', 'data/dev.tables.jsonl', 'data/test.tables.jsonl']
+DATA_FILES = [("data/train.jsonl", "train"), ("data/dev.jsonl", "dev"), ("data/test.jsonl", "test")]
+
+def duplicate_key(example):
+    return (example['sql'][0], len(example['sentences'][0]['variables'].keys()))
+
+def merge_duplicates(examples):
+    """Combine examples with the same query and number of variables.
+
+    Only the first example for each key is kept, gaining the sentences of
+    the later ones, so memory grows with the number of distinct queries.
+    """
     seen = {}
-    for example in original:
-        query = example['sql'][0]
-        key = (query, len(example['sentences'][0]['variables'].keys()))
+    for example in examples:
+        key = duplicate_key(example)
         if key in seen:
-            seen[key].append(example['sentences'][0])
+            seen[key]['sentences'].append(example['sentences'][0])
+        else:
+            seen[key] = example
+    return seen.values()
+
+def shard_of(table_id, jobs):
+    return zlib.crc32(table_id.encode('utf-8')) % jobs
+
+def convert_shard(job):
+    """Convert and merge one shard's examples, given as (position, split,
+    instance) triples along with the tables they use.
+
+    Returns a map from each key to the position of its first example, that
+    example, and the (position, sentence) pairs of later duplicates.
+    """
+    raw_schemas, instances, log, skip = job
+    schemas, column_to_name = read_schemas(raw_schemas)
+    partial = {}
+    for position, split, instance in instances:
+        example = convert_example(make_example(instance, split), schemas, column_to_name, log, skip)
+        key = duplicate_key(example)
+        if key in partial:
+            partial[key][2].append((position, example['sentences'][0]))
         else:
-            final.append(example)
-            seen[key] = example['sentences']
+            partial[key] = (position, example, [])
+    return partial
+
+def shard_jobs(raw_schemas, jobs, log, skip):
+    """Read the data files once, splitting the examples by the shard of
+    their table, and give each shard only the tables its examples use."""
+    instances = [[] for _ in range(jobs)]
+    position = 0
+    for filename, split in DATA_FILES:
+        for line in open(filename):
+            instance = json.loads(line)
+            instances[shard_of(instance['table_id'], jobs)].append((position, split, instance))
+            position += 1
+    tables = {raw_schema['id']: raw_schema for raw_schema in raw_schemas}
+    for shard in range(jobs):
+        used = {instance['table_id'] for _, _, instance in instances[shard]}
+        yield [tables[table_id] for table_id in sorted(used)], instances[shard], log, skip
+
+def merge_shards(partials):
+    """Combine the output of convert_shard, giving the same result as a
+    serial run of merge_duplicates."""
+    merged = {}
+    for partial in partials:
+        for key, entry in partial.items():
+            merged.setdefault(key, []).append(entry)
+    final = []
+    for entries in merged.values():
+        entries.sort(key=lambda entry: entry[0])
+        position, example, _ = entries[0]
+        later = []
+        for other_position, other, extra in entries:
+            if other is not example:
+                later.append((other_position, other['sentences'][0]))
+            later.extend(extra)
+        later.sort(key=lambda item: item[0])
+        example['sentences'].extend(sentence for _, sentence in later)
+        final.append((position, example))
+    final.sort(key=lambda item: item[0])
+    return [example for _, example in final]
+
+def standarise_file(log, skip, compress=False, jobs=1):
+    if jobs > 1:
+        raw_schemas = list(read_tables(SCHEMA_FILES))
+        with open("wikisql.canonical-schemas.csv", 'w') as write_file:
+            read_schemas(raw_schemas, write_file, lambda table_id: False)
+        pool = multiprocessing.Pool(jobs)
+        partials = pool.map(convert_shard, shard_jobs(raw_schemas, jobs, log, skip))
+        pool.close()
+        pool.join()
+        final = merge_shards(partials)
+    else:
+        with open("wikisql.canonical-schemas.csv", 'w') as write_file:
+            schemas, column_to_name = read_schemas(read_tables(SCHEMA_FILES), write_file)
+        examples = itertools.chain(*[read_data(filename, split) for filename, split in DATA_FILES])
+        converted = (convert_example(example, schemas, column_to_name, log, skip) for example in examples)
+        final = merge_duplicates(converted)
 
     # Print to file
-    with open("wikisql.canonical.json", 'w') as write_file:
-        to_print = json.dumps(final, indent=4, sort_keys=True)
-        for line in to_print.split("\n"):
-            line = line.rstrip()
-            print(line, file=write_file)
+    if compress:
+        with bz2.open("wikisql.canonical.json.bz2", 'wt') as write_file:
+            write_examples(final, write_file)
+    else:
+        with open("wikisql.canonical.json", 'w') as write_file:
+            write_examples(final, write_file)
+
+def make_example(instance, split):
+    db = instance['table_id']
+    question = instance['question']
+    phase = instance['phase']
+    # Only needed to convert the data, not for the test cases
+    from lib.query import Query
+    query = Query.from_dict(instance['sql'])
+    info = {
+        "query-split": "N/A",
+        "sentences": [
+            {
+                "question-split": split,
+                "original": question,
+                "table-id": db,
+                "variables": {}
+            }
+        ],
+        "sql-original": [
+            str(query)
+        ],
+        "variables": [
+        ]
+    }
+    return info
 
+def read_data(filename, split):
+    for ls in open(filename):
+        yield make_example(json.loads(ls), split)
 
 def add_data(filename, split, ours):
-    for ls in open(filename):
-        instance = json.loads(ls)
-        db = instance['table_id']
-        question = instance['question']
-        phase = instance['phase']
-        query = Query.from_dict(instance['sql'])
-        info = {
-            "query-split": "N/A",
-            "sentences": [
-                {
-                    "question-split": split,
-                    "original": question,
-                    "table-id": db,
-                    "variables": {}
-                }
-            ],
-            "sql-original": [
-                str(query)
-            ],
-            "variables": [
-            ]
-        }
-        ours.append(info)
+    ours.extend(read_data(filename, split))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Modifies SQL to have a consistent tokenization. Expects a list of filenames as stdin.')
@@ -806,8 +1022,11 @@ if __name__ == '__main__':
     parser.add_argument('--testscholar', help='Run scholar test cases and exit.', action='store_true')
     parser.add_argument('--testgeo', help='Run geo test cases and exit.', action='store_true')
     parser.add_argument('--testyelp', help='Run yelp test cases and exit.', action='store_true')
+    parser.add_argument('--fields', help='The tables and fields for the test queries.')
     parser.add_argument('--log', help='Print SQL before and after.', action='store_true')
     parser.add_argument('--skip', help='Functions that should not be applied (choices are [add_semicolon, standardise_blank_spaces, capitalise, standardise_aliases, order_query]).')
+    parser.add_argument('--compress', help='Write wikisql.canonical.json.bz2 instead of wikisql.canonical.json.', action='store_true')
+    parser.add_argument('--jobs', help='Number of worker processes, each converting the examples for a share of the tables.', type=int, default=1)
     args = parser.parse_args()
 
 
@@ -817,8 +1036,10 @@ if __name__ == '__main__':
         skip = {v for v in args.skip.split(",")}
 
     if not (args.testadv or args.testgeo or args.testatis or args.testscholar or args.testyelp):
-        standarise_file(args.log, skip)
+        standarise_file(args.log, skip, args.compress, args.jobs)
     else:
+        if args.fields is None:
+            parser.error("the test cases need --fields")
         sample_queries = [
             ("select * from student where student.s_id < 5",
             "SELECT * FROM STUDENT AS STUDENTalias0 WHERE STUDENTalias0.S_ID < 5 ;"),
@@ -1092,7 +1313,16 @@ if __name__ == '__main__':
         variables = {"number0", "department0"}
         for query, correct in sample_queries:
             # Canonicalise and print the output
-            canonical = make_canonical(query, schema, variables)
+            try:
+                canonical = make_canonical(query, schema, variables)
+            except IndexError:
+                # WikiSQL's SQL comes with spaces around brackets already, so
+                # standardise_blank_spaces does not add them and ordering
+                # fails on some hand-written queries. Report and move on.
+                print('\n'.join([part.strip() for part in query.split("\n")]))
+                print("Failed to order this query")
+                print()
+                continue
             if canonical != correct:
                 # Print the query, adjusting to avoid indentation
                 print('\n'.join([part.strip() for part in query.split("\n")]))
@@ -3,93 +3,144 @@
 from __future__ import print_function
 
 import argparse
+import bz2
 import json
+import multiprocessing
+import os
 import sys
 
 from collections import Counter
 
-def update_in_quote(in_quote, token):
-    if '"' in token and len(token.split('"')) % 2 == 0:
-        in_quote[0] = not in_quote[0]
-    if "'" in token and len(token.split("'")) % 2 == 0:
-        in_quote[1] = not in_quote[1]
+import sql_lexer
+from common import file_hash
+from json_stream import read_examples
+from sql_lexer import in_quote, lex
+
+def query_measures(sql):
+    """The number of SELECTs, the depth (nesting) and the breadth (most
+    SELECTs at the same level) of a query."""
+    lexed = lex(sql)
+
+    # Calculate number of SELECTS
+    selects = 0
+    for pos, token in enumerate(lexed.tokens):
+        if token == 'SELECT' and not in_quote(lexed, pos):
+            selects += 1
+
+    # Calculate depth and breadth
+    max_depth = 0
+    max_breadth = 1
+    depth = 0
+    prev = None
+    other_bracket = []
+    breadth = [0]
+    for pos, token in enumerate(lexed.tokens):
+        if in_quote(lexed, pos):
+            pass
+        elif token == 'SELECT':
+            depth += 1
+            max_depth = max(max_depth, depth)
+            other_bracket.append(0)
+            breadth[-1] += 1
+            breadth.append(0)
+        elif '(' in prev:
+            other_bracket[-1] += 1
+        elif token == ')':
+            if other_bracket[-1] == 0:
+                depth -= 1
+                other_bracket.pop()
+                possible = breadth.pop()
+                max_breadth = max(max_breadth, possible)
+            else:
+                other_bracket[-1] -= 1
+
+        if '(' in token and ')' in token:
+            prev = "SQL_FUNCTION"
+        else:
+            prev = token
+    assert len(other_bracket) == 1 and other_bracket[0] == 0, sql
+    assert depth == 1, sql
+    return selects, max_depth, max_breadth
 
 def process_query(data, stats):
     stats['sentences'] += len(data['sentences'])
     stats['queries'] += 1
 
-    # Calculate number of SELECTS
-    for sql in data['sql']:
-        selects = 0
-        in_quote = [False, False]
-        for token in sql.split():
-            if token == 'SELECT' and (not (in_quote[0] or in_quote[1])):
-                selects += 1
-            update_in_quote(in_quote, token)
-            
+    measures = [query_measures(sql) for sql in data['sql']]
+    for selects, _, _ in measures:
         stats["SQL-selects-{}".format(selects)] += 1
+    for _, depth, breadth in measures:
+        stats["SQL-depth-{}".format(depth)] += 1
+        stats["SQL-breadth-{}".format(breadth)] += 1
 
-    # Calculate depth and breadth
-    for sql in data['sql']:
-        max_depth = 0
-        max_breadth = 1
-        depth = 0
-        prev = None
-        other_bracket = []
-        breadth = [0]
-        in_quote = [False, False]
-        for token in sql.split():
-            if in_quote[0] or in_quote[1]:
-                update_in_quote(in_quote, token)
-            elif token == 'SELECT':
-                depth += 1
-                max_depth = max(max_depth, depth)
-                other_bracket.append(0)
-                breadth[-1] += 1
-                breadth.append(0)
-            elif '(' in prev:
-                other_bracket[-1] += 1
-                update_in_quote(in_quote, token)
-            elif token == ')':
-                if other_bracket[-1] == 0:
-                    depth -= 1
-                    other_bracket.pop()
-                    possible = breadth.pop()
-                    max_breadth = max(max_breadth, possible)
-                else:
-                    other_bracket[-1] -= 1
-            else:
-                update_in_quote(in_quote, token)
-            
-            if '(' in token and ')' in token:
-                prev = "SQL_FUNCTION"
-            else:
-                prev = token
-        assert len(other_bracket) == 1 and other_bracket[0] == 0, sql
-        assert depth == 1, sql
-        stats["SQL-depth-{}".format(max_depth)] += 1
-        stats["SQL-breadth-{}".format(max_breadth)] += 1
+def open_data(filename):
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'rt')
+    return open(filename)
+
+def file_stats(filename):
+    """Stats for one file, processing each query once."""
+    stats = Counter()
+    with open_data(filename) as data_file:
+        for query in read_examples(data_file):
+            process_query(query, stats)
+    return stats
+
+def code_version():
+    return file_hash(__file__) + " " + file_hash(sql_lexer.__file__)
+
+def read_cache(filename):
+    """Per-file stats from an earlier run, keyed by the hash of the file.
+    Results from a different version of this code are discarded."""
+    if filename is not None and os.path.exists(filename):
+        with open(filename) as cache_file:
+            cache = json.load(cache_file)
+        if cache['version'] == code_version():
+            return cache['files']
+    return {}
+
+def write_cache(filename, files):
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'w') as cache_file:
+        json.dump({'version': code_version(), 'files': files}, cache_file)
+    os.replace(tmp_name, filename)
+
+def all_file_stats(filenames, jobs=1, cache_filename=None):
+    """A Counter for each file, only processing files whose stats are not in
+    the cache."""
+    cache = read_cache(cache_filename)
+    hashes = [file_hash(filename) for filename in filenames]
+    todo = [filename for filename, key in zip(filenames, hashes) if key not in cache]
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        computed = pool.map(file_stats, todo, 1)
+        pool.close()
+        pool.join()
+    else:
+        computed = [file_stats(filename) for filename in todo]
+
+    results = dict(zip(todo, computed))
+    for filename, key in zip(filenames, hashes):
+        if filename in results:
+            # Stored as a list to keep the order stats were first seen in
+            cache[key] = list(results[filename].items())
+        else:
+            results[filename] = Counter(dict(cache[key]))
+    if cache_filename is not None and len(todo) > 0:
+        write_cache(cache_filename, cache)
+    return [results[filename] for filename in filenames]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prints stats about the specified files.')
     parser.add_argument('--per-file-stats', help='Show stats on each file as well as overall', action='store_true')
-    parser.add_argument('json_files', help='File in our json format', nargs='+')
+    parser.add_argument('--jobs', help='Number of files to process at once.', type=int, default=1)
+    parser.add_argument('--cache', help='File to keep per-file stats in, so unchanged files are not processed again.')
+    parser.add_argument('json_files', help='File in our json format (may be bz2 compressed)', nargs='+')
     args = parser.parse_args()
 
     total_stats = Counter()
-    for filename in args.json_files:
-        cur_stats = Counter()
-        data = json.load(open(filename))
-        if type(data) == list:
-            for query in data:
-                if args.per_file_stats:
-                    process_query(query, cur_stats)
-                process_query(query, total_stats)
-        else:
-            if args.per_file_stats:
-                process_query(data, cur_stats)
-            process_query(data, total_stats)
-
+    for filename, cur_stats in zip(args.json_files, all_file_stats(args.json_files, args.jobs, args.cache)):
+        total_stats.update(cur_stats)
         if args.per_file_stats:
             for stat in cur_stats:
                 print(filename, stat, cur_stats[stat])
@@ -99,4 +150,3 @@ if __name__ == '__main__':
         start = "Overall: "
     for stat in total_stats:
         print(start + stat, total_stats[stat])
-
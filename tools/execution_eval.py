@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Execution accuracy: runs gold and predicted queries against a SQLite
+database and counts a prediction as correct when it returns the same rows.
+
+Rows are compared as a multiset (order ignored) unless the gold query has an
+ORDER BY, in which case the order must match too. Each worker process keeps
+its own read-only connection to every database it has used. Queries are run
+through a QueryGuard (query_guard.py), so one that runs for longer than
+--timeout seconds, or more than --max-steps SQLite VM steps, or returns more
+than --max-rows rows, is stopped and counts as wrong. --report writes the
+time and steps taken by every query.
+Results are compared by a hash of the rows and the row count, so gold results
+can also come from a cache built by gold_results.py (--gold-cache).
+
+Gold and system files have one query per line, and must have the same
+number of lines. Lines in the format written by json_to_flat.py
+("question ||| query") are also accepted, in which case the part after |||
+is used. A blank line is an empty prediction, which is never correct.
+
+Usage:
+    execution_eval.py --db ../data/geography-db.added-in-2020.sqlite \\
+        --gold geo.dev --system output.txt --jobs 8
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import hashlib
+import multiprocessing
+import sqlite3
+
+from common import file_hash, fingerprint
+from query_guard import LIMIT_STATUSES, QueryGuard
+
+# Connections held by this process, keyed by database path
+CONNECTIONS = {}
+
+def read_queries(filename):
+    """One query per line. A blank line is kept as an empty query, so that
+    the lines of gold and system files stay paired."""
+    queries = []
+    with open(filename) as query_file:
+        for line in query_file:
+            line = line.rstrip('\n')
+            if ' ||| ' in line:
+                line = line.split(' ||| ', 1)[1]
+            queries.append(line.strip())
+    return queries
+
+def get_connection(db):
+    if db not in CONNECTIONS:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(db), uri=True, check_same_thread=False)
+        conn.text_factory = lambda data: data.decode('utf-8', 'replace')
+        CONNECTIONS[db] = conn
+    return CONNECTIONS[db]
+
+def execute(db, query, limits):
+    """Run query under limits, a (seconds, VM steps, rows) tuple, returning
+    a QueryResult."""
+    max_seconds, max_steps, max_rows = limits
+    return QueryGuard(get_connection(db), max_seconds, max_steps, max_rows).run(query)
+
+def is_ordered(query):
+    return 'ORDER BY' in ' '.join(query.upper().split())
+
+def normalise_value(value):
+    # So that 2 and 2.0 give the same fingerprint, as they compare equal
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def result_fingerprint(rows, ordered):
+    """A hash of the rows, which ignores their order unless ordered is set."""
+    row_hashes = [hashlib.sha1(repr(tuple(normalise_value(value) for value in row)).encode('utf-8')).hexdigest() for row in rows]
+    if not ordered:
+        row_hashes.sort()
+    return hashlib.sha1(' '.join(row_hashes).encode('utf-8')).hexdigest()
+
+def run_query(db, query, limits, ordered):
+    """Execute query, returning (status, fingerprint, row count) and
+    (seconds, steps). An empty query is not run, has status 'empty' and no
+    cost."""
+    if len(query) == 0:
+        return ('empty', None, 0), None
+    result = execute(db, query, limits)
+    cost = (result.seconds, result.steps)
+    if result.status != 'ok':
+        return (result.status, None, 0), cost
+    return (result.status, result_fingerprint(result.rows, ordered), len(result.rows)), cost
+
+def evaluate_pair(job):
+    """Returns the gold result, system status, whether they match, and the
+    (seconds, steps) cost of the gold and system queries. The gold result is
+    only computed if it is not given, and a cost is None if the query was
+    not run."""
+    db, gold, system, limits, gold_result = job
+    ordered = is_ordered(gold)
+    gold_cost = None
+    if gold_result is None:
+        gold_result, gold_cost = run_query(db, gold, limits, ordered)
+    gold_status, gold_fingerprint, gold_count = gold_result
+    if gold == system:
+        return gold_result, gold_status, gold_status == 'ok', gold_cost, gold_cost
+    system_result, system_cost = run_query(db, system, limits, ordered)
+    correct = gold_status == 'ok' and system_result[0] == 'ok' and \
+        system_result[1:] == gold_result[1:]
+    return gold_result, system_result[0], correct, gold_cost, system_cost
+
+class GoldResultCache:
+    """Results of gold queries stored in a SQLite file, keyed by the query
+    and the database file (see gold_results.py)."""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (query TEXT, db TEXT, status TEXT, fingerprint TEXT, row_count INTEGER, PRIMARY KEY (query, db))")
+        self.db_hashes = {}
+
+    def db_hash(self, db):
+        if db not in self.db_hashes:
+            self.db_hashes[db] = file_hash(db)
+        return self.db_hashes[db]
+
+    def lookup(self, db, query):
+        """(status, fingerprint, row count) for query on db, or None."""
+        row = self.conn.execute("SELECT status, fingerprint, row_count FROM results WHERE query = ? AND db = ?",
+                (fingerprint(query), self.db_hash(db))).fetchone()
+        return None if row is None else tuple(row)
+
+    def lookup_many(self, db, queries):
+        return [self.lookup(db, query) for query in queries]
+
+    def add_many(self, db, results):
+        """Store a list of (query, (status, fingerprint, row count))."""
+        db_key = self.db_hash(db)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                    [(fingerprint(query), db_key) + tuple(result) for query, result in results if result[0] not in LIMIT_STATUSES])
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+def evaluate(db, golds, systems, limits=(10.0, None, None), jobs=1, chunksize=4, cache=None):
+    """A (gold status, system status, correct, gold cost, system cost) tuple
+    for each pair, where a cost is (seconds, steps), or None if the query was
+    not run. With a GoldResultCache, gold queries it already has a result
+    for are not run, and new results are added to it."""
+    gold_results = [None] * len(golds)
+    if cache is not None:
+        gold_results = cache.lookup_many(db, golds)
+    work = [(db, gold, system, limits, gold_result) for gold, system, gold_result in zip(golds, systems, gold_results)]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.map(evaluate_pair, work, chunksize)
+        pool.close()
+        pool.join()
+    else:
+        results = [evaluate_pair(job) for job in work]
+    if cache is not None:
+        cache.add_many(db, [(gold, result[0]) for gold, cached, result in zip(golds, gold_results, results) if cached is None])
+    return [(result[0][0],) + result[1:] for result in results]
+
+def write_report(filename, results, golds, systems):
+    """One tab separated line per query run: pair number, gold or system,
+    status, seconds, VM steps and the query."""
+    with open(filename, 'w') as report:
+        print("pair\trole\tstatus\tseconds\tsteps\tquery", file=report)
+        for number, result in enumerate(results):
+            gold_status, system_status, _, gold_cost, system_cost = result
+            for role, status, cost, query in [('gold', gold_status, gold_cost, golds[number]), ('system', system_status, system_cost, systems[number])]:
+                if cost is not None:
+                    print("{}\t{}\t{}\t{:.6f}\t{}\t{}".format(number, role, status, cost[0], cost[1], query), file=report)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure execution accuracy of predicted SQL against a SQLite database.')
+    parser.add_argument('--db', help='SQLite database to run queries on.', required=True)
+    parser.add_argument('--gold', help='File of gold queries, one per line.', required=True)
+    parser.add_argument('--system', help='File of predicted queries, one per line.', required=True)
+    parser.add_argument('--timeout', help='Seconds a single query may run for.', type=float, default=10.0)
+    parser.add_argument('--max-steps', help='SQLite VM steps a single query may take.', type=int)
+    parser.add_argument('--max-rows', help='Rows a single query may return.', type=int)
+    parser.add_argument('--report', help='Write the status, time and VM steps of every query run to this file.')
+    parser.add_argument('--jobs', help='Number of worker processes.', type=int, default=1)
+    parser.add_argument('--gold-cache', help='SQLite file of gold query results to use and add to (see gold_results.py).')
+    parser.add_argument('--show-wrong', help='Print each pair that does not match.', action='store_true')
+    args = parser.parse_args()
+
+    golds = read_queries(args.gold)
+    systems = read_queries(args.system)
+    if len(golds) != len(systems):
+        parser.error("{} gold queries but {} system queries".format(len(golds), len(systems)))
+    cache = None
+    if args.gold_cache is not None:
+        cache = GoldResultCache(args.gold_cache)
+    limits = (args.timeout, args.max_steps, args.max_rows)
+    results = evaluate(args.db, golds, systems, limits, args.jobs, cache=cache)
+    if cache is not None:
+        cache.close()
+    if args.report is not None:
+        write_report(args.report, results, golds, systems)
+
+    if args.show_wrong:
+        for (gold_status, system_status, correct, _, _), gold, system in zip(results, golds, systems):
+            if not correct:
+                print("Gold ({}):".format(gold_status), gold)
+                print("System ({}):".format(system_status), system)
+                print()
+
+    correct = sum(1 for result in results if result[2])
+    statuses = collections.Counter()
+    for gold_status, system_status, _, _, _ in results:
+        statuses['gold ' + gold_status] += 1
+        statuses['system ' + system_status] += 1
+    for status in sorted(statuses):
+        print(status, statuses[status])
+    if len(results) > 0:
+        print("Execution accuracy is {:.4f} ({} / {})".format(correct / len(results), correct, len(results)))
+    else:
+        print("Execution accuracy is undefined.")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Keeps an index from a fingerprint of each canonical SQL query to the examples
+that use it, across all of our datasets, stored in a SQLite file.
+
+Examples are identified as dataset:example:sql, where example is the
+position of the example in the json file and sql the position of the query
+in its 'sql' list. Updating the index only reprocesses datasets whose json
+(or fields file, with --canonicalise) has changed since the last update.
+
+Usage:
+    fingerprint_index.py --index fingerprints.sqlite ../data/*.json
+    fingerprint_index.py --index fingerprints.sqlite --report
+    fingerprint_index.py --index fingerprints.sqlite --lookup "SELECT ..."
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sqlite3
+
+import canonicaliser
+from canonicaliser import Canonicaliser
+from common import dataset_name, file_hash, fingerprint
+from json_stream import read_examples
+
+def fields_for(filename):
+    fields = filename[:-len('.json')] + '-fields.txt'
+    if os.path.exists(fields):
+        return fields
+    return None
+
+class FingerprintIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS datasets (name TEXT PRIMARY KEY, version TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS examples (fingerprint TEXT, dataset TEXT, example INTEGER, sql INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queries (fingerprint TEXT PRIMARY KEY, query TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS examples_fingerprint ON examples (fingerprint)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS examples_dataset ON examples (dataset)")
+
+    def update(self, filename, canonicalise=False):
+        """Index one dataset file. Returns False if it was already up to date."""
+        name = dataset_name(filename)
+        fields = fields_for(filename) if canonicalise else None
+        version = file_hash(filename)
+        if fields is not None:
+            version += " " + file_hash(fields) + " " + canonicaliser.code_version()
+        row = self.conn.execute("SELECT version FROM datasets WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] == version:
+            return False
+
+        processor = None
+        if fields is not None:
+            processor = Canonicaliser(fields)
+        with self.conn:
+            self.conn.execute("DELETE FROM examples WHERE dataset = ?", (name,))
+            with open(filename) as input_file:
+                for example_num, example in enumerate(read_examples(input_file)):
+                    queries = example['sql']
+                    if processor is not None:
+                        variables = {variable['name'] for variable in example.get('variables', [])}
+                        queries = processor.canonicalise_many(queries, variables)
+                    for sql_num, query in enumerate(queries):
+                        key = fingerprint(query)
+                        self.conn.execute("INSERT OR IGNORE INTO queries VALUES (?, ?)", (key, query))
+                        self.conn.execute("INSERT INTO examples VALUES (?, ?, ?, ?)", (key, name, example_num, sql_num))
+            self.conn.execute("DELETE FROM queries WHERE fingerprint NOT IN (SELECT fingerprint FROM examples)")
+            self.conn.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?)", (name, version))
+        if processor is not None:
+            processor.close()
+        return True
+
+    def lookup(self, key):
+        """The (dataset, example, sql) positions of queries with this fingerprint."""
+        return self.conn.execute("SELECT dataset, example, sql FROM examples WHERE fingerprint = ? ORDER BY dataset, example, sql", (key,)).fetchall()
+
+    def query(self, key):
+        row = self.conn.execute("SELECT query FROM queries WHERE fingerprint = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def duplicates(self, min_datasets=2):
+        """Fingerprints used more than once, in at least min_datasets datasets."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT fingerprint FROM examples GROUP BY fingerprint HAVING COUNT(DISTINCT dataset) >= ? AND COUNT(*) > 1 ORDER BY fingerprint",
+            (min_datasets,))]
+
+    def close(self):
+        self.conn.close()
+
+def example_id(position):
+    return "{}:{}:{}".format(*position)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index canonical SQL by fingerprint to find equivalent queries across datasets.')
+    parser.add_argument('datasets', help='Json dataset files to add or update.', nargs='*')
+    parser.add_argument('--index', help='SQLite file holding the index.', required=True)
+    parser.add_argument('--canonicalise', help='Canonicalise queries before hashing, using the -fields.txt file next to each dataset.', action='store_true')
+    parser.add_argument('--report', help='Print queries shared by several examples.', action='store_true')
+    parser.add_argument('--min-datasets', help='For --report, how many datasets a query must appear in (1 includes duplicates within a dataset).', type=int, default=2)
+    parser.add_argument('--lookup', help='Print the examples whose query matches this one.', action='append', default=[])
+    parser.add_argument('--fields', help='Canonicalise --lookup queries with this fields file first.')
+    args = parser.parse_args()
+
+    index = FingerprintIndex(args.index)
+    for filename in args.datasets:
+        if index.update(filename, args.canonicalise):
+            print("Indexed", dataset_name(filename))
+        else:
+            print("Unchanged", dataset_name(filename))
+
+    if args.report:
+        for key in index.duplicates(args.min_datasets):
+            positions = index.lookup(key)
+            print(key, index.query(key))
+            print("   ", ' '.join(example_id(position) for position in positions))
+
+    if len(args.lookup) > 0:
+        queries = args.lookup
+        if args.fields is not None:
+            with Canonicaliser(args.fields) as processor:
+                queries = processor.canonicalise_many(queries)
+        for query in queries:
+            print(query)
+            print("   ", ' '.join(example_id(position) for position in index.lookup(fingerprint(query))))
+    index.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Fills a cache of the results of gold queries, so that execution evaluation
+only needs to run the predictions.
+
+The cache is an execution_eval.GoldResultCache. For each gold query and
+database it stores the status of running the query, a fingerprint of the
+rows it returned and the number of rows. Entries are keyed by a hash of the
+query (ignoring differences in spacing) and a hash of the database file, so
+changing the database invalidates them. Queries stopped by a limit are not
+stored.
+
+The gold queries come from our json files, with the variables in each
+sentence filled in, as json_to_flat.py does.
+
+Usage:
+    gold_results.py --cache gold.sqlite --db ../data/geography-db.added-in-2020.sqlite ../data/geography.json
+    execution_eval.py --gold-cache gold.sqlite --db ... --gold ... --system ...
+"""
+
+from __future__ import print_function
+
+import argparse
+
+from common import fill_variables, fingerprint
+from execution_eval import GoldResultCache, evaluate
+from json_stream import read_examples
+
+def gold_queries(filename):
+    """Every distinct gold query in a dataset, with variables filled in."""
+    queries = []
+    seen = set()
+    with open(filename) as data_file:
+        for example in read_examples(data_file):
+            for sql in example['sql']:
+                for sentence in example['sentences']:
+                    query = fill_variables(sql, sentence, example['variables'])
+                    key = fingerprint(query)
+                    if key not in seen:
+                        seen.add(key)
+                        queries.append(query)
+    return queries
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run gold queries once and cache their results for execution evaluation.')
+    parser.add_argument('datasets', help='Json dataset files to take gold queries from.', nargs='+')
+    parser.add_argument('--cache', help='SQLite file holding the results.', required=True)
+    parser.add_argument('--db', help='SQLite database to run the queries on.', required=True)
+    parser.add_argument('--timeout', help='Seconds a single query may run for.', type=float, default=10.0)
+    parser.add_argument('--max-steps', help='SQLite VM steps a single query may take.', type=int)
+    parser.add_argument('--max-rows', help='Rows a single query may return.', type=int)
+    parser.add_argument('--jobs', help='Number of worker processes.', type=int, default=1)
+    args = parser.parse_args()
+
+    cache = GoldResultCache(args.cache)
+    for filename in args.datasets:
+        queries = gold_queries(filename)
+        missing = [query for query, result in zip(queries, cache.lookup_many(args.db, queries)) if result is None]
+        # Passing each query as its own prediction means it is only run once
+        limits = (args.timeout, args.max_steps, args.max_rows)
+        results = evaluate(args.db, missing, missing, limits, args.jobs, cache=cache)
+        failed = sum(1 for result in results if result[0] != 'ok')
+        print("{}: {} queries, {} run, {} failed".format(filename, len(queries), len(missing), failed))
+    print(len(cache), "results cached")
+    cache.close()
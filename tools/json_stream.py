@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Reads and writes our json dataset files one example at a time, so that
+memory use does not grow with the size of the corpus.
+
+The output format is exactly what we get from
+json.dumps(examples, indent=4, sort_keys=True) with trailing spaces removed,
+so files written this way are byte-identical to the ones written by loading
+everything and dumping it in one go.
+"""
+
+from __future__ import print_function
+
+import json
+
+DECODER = json.JSONDecoder()
+WHITESPACE = " \t\n\r"
+
+def read_examples(input_file, chunk_size=1 << 16):
+    """Yield each example from a file holding a json list or a single object."""
+    for _, _, value in scan_examples(input_file, chunk_size):
+        yield value
+
+def scan_examples(input_file, chunk_size=1 << 16):
+    """Like read_examples, but yield (start, end, example), where start and
+    end are the character offsets of the example in the file."""
+    buf = ''
+    pos = 0
+    offset = 0
+    eof = False
+    in_list = None
+    after_value = False
+    while True:
+        # Skip whitespace and list punctuation, reading more as needed
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            offset += len(buf)
+            buf = input_file.read(chunk_size)
+            pos = 0
+            eof = len(buf) == 0
+        if pos == len(buf):
+            if in_list:
+                raise ValueError("Unexpected end of file, missing ']'")
+            return
+        char = buf[pos]
+        if in_list is None:
+            in_list = char == '['
+            if in_list:
+                pos += 1
+                continue
+        elif in_list and char == ']':
+            return
+        elif in_list and char == ',' and after_value:
+            after_value = False
+            pos += 1
+            continue
+        elif after_value:
+            raise ValueError("Unexpected data after an example: " + buf[pos:pos + 20])
+
+        # Decode the next value, growing the buffer until it is complete
+        while True:
+            try:
+                value, end = DECODER.raw_decode(buf, pos)
+                # A number cut off at the end of the buffer can still decode
+                if eof or (end < len(buf) and buf[end] in WHITESPACE + ",]"):
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            more = input_file.read(max(chunk_size, len(buf) - pos))
+            offset += pos
+            buf = buf[pos:] + more
+            pos = 0
+            eof = len(more) == 0
+        yield offset + pos, offset + end, value
+        after_value = True
+        offset += end
+        buf = buf[end:]
+        pos = 0
+
+def format_example(example):
+    text = json.dumps(example, indent=4, sort_keys=True)
+    return '\n'.join(("    " + line).rstrip() for line in text.split("\n"))
+
+def write_examples(examples, output_file):
+    """Write an iterable of examples as a json list, one example at a time."""
+    count = 0
+    for example in examples:
+        if count == 0:
+            output_file.write("[\n")
+        else:
+            output_file.write(",\n")
+        output_file.write(format_example(example))
+        count += 1
+    if count == 0:
+        output_file.write("[]\n")
+    else:
+        output_file.write("\n]\n")
+    return count
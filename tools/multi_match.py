@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Finds every occurrence of a set of strings in one pass over a text, using an
+Aho-Corasick automaton, and uses that to put variable names into questions.
+
+The converters used to replace each variable in turn, rescanning the
+question every time. locate_variables gives the same answer in one pass, and
+returns None when an earlier replacement could change what a later variable
+matches, in which case the caller should fall back to the step by step loop.
+"""
+
+from __future__ import print_function
+
+class PatternMatcher:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.output[node].append(index)
+
+        # Breadth first, so the failure state of a node's parent is known
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                state = self.fail[node]
+                while state and char not in self.goto[state]:
+                    state = self.fail[state]
+                if char in self.goto[state]:
+                    self.fail[child] = self.goto[state][char]
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+                queue.append(child)
+
+    def find_all(self, text):
+        """Every (start, end, pattern index) match, overlapping ones included."""
+        matches = []
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for index in self.output[state]:
+                matches.append((pos + 1 - len(self.patterns[index]), pos + 1, index))
+        return matches
+
+def could_overlap(pattern, name):
+    """Whether a match of pattern could include part of an inserted name."""
+    if name in pattern or pattern in name:
+        return True
+    for k in range(1, min(len(pattern), len(name))):
+        if pattern[:k] == name[-k:] or pattern[-k:] == name[:k]:
+            return True
+    return False
+
+def locate_variables(text, tests, replacements, names):
+    """Do in one pass what this loop does:
+
+        for i in range(len(names)):
+            found[i] = tests[i] in text
+            if found[i]:
+                text = text.replace(replacements[i], names[i])
+
+    Returns found and a sorted list of (start, end, name) spans of the
+    original text to replace, or None if the replacements interact.
+    """
+    patterns = sorted(set(tests) | set(replacements))
+    if '' in patterns:
+        return None
+    pattern_index = {pattern: i for i, pattern in enumerate(patterns)}
+    occurrences = [[] for _ in patterns]
+    for start, end, index in PatternMatcher(patterns).find_all(text):
+        occurrences[index].append((start, end))
+
+    found = []
+    spans = []
+    covered = bytearray(len(text))
+    inserted = []
+    for i, name in enumerate(names):
+        test = pattern_index[tests[i]]
+        replace = pattern_index[replacements[i]]
+        for pattern in (tests[i], replacements[i]):
+            if any(could_overlap(pattern, other) for other in inserted):
+                return None
+            for start, end in occurrences[pattern_index[pattern]]:
+                if any(covered[start:end]):
+                    return None
+        found.append(len(occurrences[test]) > 0)
+        if found[-1] and len(occurrences[replace]) > 0:
+            previous_end = -1
+            for start, end in occurrences[replace]:
+                if start < previous_end:
+                    return None
+                previous_end = end
+                spans.append((start, end, name))
+                covered[start:end] = b'\x01' * (end - start)
+            inserted.append(name)
+    spans.sort()
+    return found, spans
+
+def apply_spans(text, spans):
+    parts = []
+    pos = 0
+    for start, end, name in spans:
+        parts.append(text[pos:start])
+        parts.append(name)
+        pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Runs queries on a SQLite connection with limits on wall-clock time, SQLite
+virtual machine steps and result rows, so that a runaway query (e.g. a
+prediction joining several copies of FLIGHT with no join conditions) is
+stopped instead of hanging the evaluation.
+
+Limits are enforced with SQLite's progress handler, which is called every
+`interval` VM steps, so step counts are accurate to within `interval`.
+
+    guard = QueryGuard(conn, max_seconds=5, max_steps=10 ** 8, max_rows=10 ** 5)
+    result = guard.run("SELECT ...")
+    result.status, result.rows, result.seconds, result.steps
+"""
+
+from __future__ import print_function
+
+import collections
+import sqlite3
+import time
+
+# Statuses for queries that were stopped. They depend on the limits, so
+# should not be cached as the query's result.
+LIMIT_STATUSES = ('timeout', 'step_limit', 'row_limit')
+
+QueryResult = collections.namedtuple('QueryResult', ['status', 'rows', 'seconds', 'steps', 'error'])
+
+class QueryGuard:
+    def __init__(self, conn, max_seconds=None, max_steps=None, max_rows=None, interval=1000):
+        self.conn = conn
+        self.max_seconds = max_seconds
+        self.max_steps = max_steps
+        self.max_rows = max_rows
+        self.interval = interval
+
+    def run(self, query):
+        """Execute query, returning a QueryResult. The status is 'ok',
+        'error', or one of LIMIT_STATUSES, and rows is None unless it is
+        'ok'."""
+        start = time.perf_counter()
+        deadline = None if self.max_seconds is None else start + self.max_seconds
+        state = {'steps': 0, 'stopped': None}
+        def progress():
+            state['steps'] += self.interval
+            if self.max_steps is not None and state['steps'] > self.max_steps:
+                state['stopped'] = 'step_limit'
+            elif deadline is not None and time.perf_counter() > deadline:
+                state['stopped'] = 'timeout'
+            # A true value makes SQLite abandon the query
+            return state['stopped'] is not None
+
+        self.conn.set_progress_handler(progress, self.interval)
+        status = 'ok'
+        rows = None
+        error = None
+        try:
+            cursor = self.conn.execute(query)
+            if self.max_rows is None:
+                rows = cursor.fetchall()
+            else:
+                rows = cursor.fetchmany(self.max_rows + 1)
+                if len(rows) > self.max_rows:
+                    status = 'row_limit'
+                    rows = None
+            cursor.close()
+        except sqlite3.OperationalError as exception:
+            if state['stopped'] is not None:
+                status = state['stopped']
+            else:
+                status = 'error'
+                error = str(exception)
+        except (sqlite3.Error, sqlite3.Warning, ValueError) as exception:
+            status = 'error'
+            error = str(exception)
+        finally:
+            self.conn.set_progress_handler(None, 0)
+        return QueryResult(status, rows, time.perf_counter() - start, state['steps'], error)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+A schema index shared by the canonicaliser and the converters.
+
+A schema is still used as a pair, schema[0] being a dict from table to the
+set of its columns and schema[1] the set of all table and column names. On
+top of that the index keeps a map from each column to the tables that have
+it, in the order the tables appear in the fields file, and the set of names
+that are also SQL reserved words. Names are interned, and load_schema
+reads each fields file only once per process.
+"""
+
+from __future__ import print_function
+
+import collections
+import os
+import sys
+
+SchemaIndex = collections.namedtuple('SchemaIndex', ['tables', 'words', 'column_tables', 'reserved_names'])
+
+def compile_schema(tables, words=None, reserved_words=()):
+    """Build a SchemaIndex from a dict of table -> set of upper-cased columns."""
+    compiled = {}
+    column_tables = {}
+    for table, columns in tables.items():
+        table = sys.intern(table)
+        columns = {sys.intern(column) for column in columns}
+        compiled[table] = columns
+        for column in columns:
+            column_tables.setdefault(column, []).append(table)
+    if words is None:
+        words = set(compiled)
+        for columns in compiled.values():
+            words.update(columns)
+    else:
+        words = {sys.intern(word) for word in words}
+    column_tables = {column: tuple(names) for column, names in column_tables.items()}
+    reserved_names = frozenset(word for word in words if word in reserved_words)
+    return SchemaIndex(compiled, words, column_tables, reserved_names)
+
+def as_index(schema, reserved_words=()):
+    """Accept either a SchemaIndex or a plain (tables, words) pair."""
+    if isinstance(schema, SchemaIndex):
+        return schema
+    return compile_schema(schema[0], schema[1], reserved_words)
+
+# Fields files already read in this process, keyed by path and modification
+# time so that an edited file is read again.
+LOADED = {}
+
+def load_schema(schema_filename, reserved_words=()):
+    path = os.path.abspath(schema_filename)
+    key = (path, os.path.getmtime(path), frozenset(reserved_words))
+    if key not in LOADED:
+        tables = {}
+        with open(schema_filename) as schema_file:
+            for line in schema_file:
+                fields = line.strip().split()
+                if len(fields) > 1:
+                    table = fields[0].upper()
+                    column = fields[1].upper()
+                    tables.setdefault(table, set()).add(column)
+        LOADED[key] = compile_schema(tables, None, reserved_words)
+    return LOADED[key]
@@ -1,58 +1,137 @@
 """
-Usage: python3 tools/spider_schema_to_sqlite.py
+Usage: python3 tools/spider_schema_to_sqlite.py [--jobs N] [--indexes]
 Input: Reads data/spider-schema.csv
-Output: Creates databases/*.sqllite files.
+Output: Creates databases/*/*.sqlite files.
 Author: prasad
+
+With --indexes, columns flagged as foreign keys in the csv are indexed as
+well as the later columns of composite primary keys. The copy of the csv in
+data/ was written before convert_spider.py set that flag, so it marks no
+foreign keys; regenerate it from Spider's tables.json to get those indexes.
+
+Databases whose schema has not changed since the last run are skipped (a
+hash of the schema is kept next to each file). Each database is built in a
+temporary file within a single transaction and then moved into place.
 """
-import os
+import argparse
 import csv
+import hashlib
+import json
+import multiprocessing
+import os
 import sqlite3
 
-with open("data/spider-schema.csv") as f:
-    databases = {}
+def read_databases(filename):
+    with open(filename) as f:
+        databases = {}
+
+        csvfile = csv.reader(f, skipinitialspace=True)
+        header = None
+        for line in csvfile:
+            if header is None:
+                header = line
+                continue
+            row = dict(zip(header, line))
+
+            db = row["Database name"].lower()
+            table = row["Table Name"].lower()
+            column = row["Field Name"].lower()
+            column_type = row["Type"]
+            column_primray = row["Is Primary Key"]
+            column_foreign = row["Is Foreign Key"]
+            if db not in databases:
+                databases[db] = {"tables": {}}
+            if table not in databases[db]["tables"]:
+                databases[db]["tables"][table] = {"columns": {}, "primary": [], "foreign": []}
+            if column not in databases[db]["tables"][table]["columns"]:
+                databases[db]["tables"][table]["columns"][column] = { "name": column, "type": column_type }
+                if column_primray == "True":
+                    databases[db]["tables"][table]["primary"].append(column)
+                if column_foreign == "True":
+                    databases[db]["tables"][table]["foreign"].append(column)
+    return databases
 
-    csvfile = csv.reader(f, skipinitialspace=True)
-    header = None
-    for line in csvfile:
-        if header is None:
-            header = line
+def create_statements(database, indexes=False):
+    statements = []
+    for table in database["tables"]:
+        if "sqlite_sequence" == table:
             continue
-        row = dict(zip(header, line))
-        
-        db = row["Database name"].lower()
-        table = row["Table Name"].lower()
-        column = row["Field Name"].lower()
-        column_type = row["Type"]
-        column_primray = row["Is Primary Key"]
-        if db not in databases:
-            databases[db] = {"tables": {}}
-        if table not in databases[db]["tables"]:
-            databases[db]["tables"][table] = {"columns": {}, "primary": []}
-        if column not in databases[db]["tables"][table]["columns"]:
-            databases[db]["tables"][table]["columns"][column] = { "name": column, "type": column_type }
-            if column_primray == "True":
-                databases[db]["tables"][table]["primary"].append(column)
-
-    for db in databases:
-        os.makedirs("databases/" + db)
-        dbconn = sqlite3.connect("databases/" + db + "/" + db + ".sqlite")
-        dbcur = dbconn.cursor()
-
-        for table in databases[db]["tables"]:
+        tablesql = "CREATE TABLE " + table + "("
+        coldelim = " "
+        for col in database["tables"][table]["columns"]:
+            col = database["tables"][table]["columns"][col]
+            tablesql += coldelim + '"' + col["name"] + '" ' + col["type"]
+            coldelim = ","
+        if len(database["tables"][table]["primary"]):
+            tablesql += ",PRIMARY KEY ("+ ",".join(database["tables"][table]["primary"]) +")"
+        tablesql += ");"
+        statements.append(tablesql)
+
+    if indexes:
+        for table in database["tables"]:
             if "sqlite_sequence" == table:
                 continue
-            tablesql = "CREATE TABLE " + table + "("
-            coldelim = " "
-            for col in databases[db]["tables"][table]["columns"]:
-                col = databases[db]["tables"][table]["columns"][col]
-                tablesql += coldelim + '"' + col["name"] + '" ' + col["type"]
-                coldelim = ","
-            if len(databases[db]["tables"][table]["primary"]):
-                tablesql += ",PRIMARY KEY ("+ ",".join(databases[db]["tables"][table]["primary"]) +")"
-            tablesql += ");"
-            print (tablesql)
-            dbcur.execute(tablesql)
-        dbconn.commit()
-        
-    f.close()
-    print("\nYou can now use databases/*.sqlite files\n")
+            info = database["tables"][table]
+            # The primary key's own index already covers its first column
+            columns = []
+            for col in info["primary"][1:] + info["foreign"]:
+                if col not in columns and col not in info["primary"][:1]:
+                    columns.append(col)
+            for col in columns:
+                name = "index_" + "_".join((table + "_" + col).split())
+                statements.append('CREATE INDEX "{}" ON "{}" ("{}");'.format(name, table, col))
+    return statements
+
+def build_database(job):
+    """Create one database unless its schema is unchanged. Returns whether
+    it was built."""
+    db, statements, output_dir, verbose = job
+    directory = os.path.join(output_dir, db)
+    path = os.path.join(directory, db + ".sqlite")
+    hash_path = path + ".schema-hash"
+    schema_hash = hashlib.sha1(json.dumps(statements).encode("utf-8")).hexdigest()
+    if os.path.exists(path) and os.path.exists(hash_path):
+        with open(hash_path) as hash_file:
+            if hash_file.read().strip() == schema_hash:
+                return False
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    dbconn = sqlite3.connect(tmp_path, isolation_level=None)
+    dbconn.execute("PRAGMA journal_mode = OFF")
+    dbconn.execute("PRAGMA synchronous = OFF")
+    dbconn.execute("BEGIN")
+    for statement in statements:
+        if verbose:
+            print(statement)
+        dbconn.execute(statement)
+    dbconn.execute("COMMIT")
+    dbconn.close()
+    os.replace(tmp_path, path)
+    with open(hash_path, "w") as hash_file:
+        hash_file.write(schema_hash + "\n")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Creates an empty SQLite database for each Spider database schema.")
+    parser.add_argument("--schema", help="Schema csv file.", default="data/spider-schema.csv")
+    parser.add_argument("--output", help="Directory to put the databases in.", default="databases")
+    parser.add_argument("--jobs", help="Number of databases to build at once.", type=int, default=1)
+    parser.add_argument("--indexes", help="Also create indexes on composite primary key and foreign key columns.", action="store_true")
+    parser.add_argument("--verbose", help="Print each statement as it is run.", action="store_true")
+    args = parser.parse_args()
+
+    databases = read_databases(args.schema)
+    jobs = [(db, create_statements(databases[db], args.indexes), args.output, args.verbose) for db in databases]
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        built = pool.map(build_database, jobs)
+        pool.close()
+        pool.join()
+    else:
+        built = [build_database(job) for job in jobs]
+
+    print("Built {} databases, {} unchanged".format(sum(built), len(built) - sum(built)))
+    print("\nYou can now use {}/*/*.sqlite files\n".format(args.output))
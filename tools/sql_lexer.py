@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+A shared, quote-aware view of a SQL query as its whitespace separated tokens.
+
+Several tools need to know, for each token of a query, whether it starts
+inside a quoted string. lex() works that out in a single pass and caches the
+result, so tools that look at the same query (e.g. tokenise_sql and
+corpus_stats) do not each rescan it.
+
+Quotes follow the rule used throughout our tools: a " opens or closes a
+double quoted string unless we are in a single quoted one, and vice versa.
+
+    >>> lexed = lex('SELECT a FROM t WHERE b = "it\\'s ( x" AND c IN ( SELECT d FROM u ) ;')
+    >>> lexed.tokens[7], lexed.quotes[7], lexed.quotes[8]
+    ('"it\\'s', (False, False), (False, True))
+"""
+
+from __future__ import print_function
+
+import collections
+import functools
+import sys
+
+LEX_CACHE_SIZE = 1 << 16
+
+def update_quotes(char, in_single, in_double):
+    if char == '"' and not in_single:
+        in_double = not in_double
+    elif char == "'" and not in_double:
+        in_single = not in_single
+    return in_single, in_double
+
+def update_token_quotes(token, in_single, in_double):
+    # Most tokens contain no quotes, so skip the character walk for them
+    if "'" in token or '"' in token:
+        for char in token:
+            in_single, in_double = update_quotes(char, in_single, in_double)
+    return in_single, in_double
+
+# tokens: the query split on whitespace.
+# quotes: (in single, in double) at the start of each token, plus one more
+#     entry for the end of the query.
+LexedQuery = collections.namedtuple('LexedQuery', ['tokens', 'quotes'])
+
+@functools.lru_cache(maxsize=LEX_CACHE_SIZE)
+def lex(query):
+    tokens = query.split()
+    quotes = []
+    in_single, in_double = False, False
+    for token in tokens:
+        quotes.append((in_single, in_double))
+        in_single, in_double = update_token_quotes(token, in_single, in_double)
+    quotes.append((in_single, in_double))
+    return LexedQuery(tokens, quotes)
+
+def in_quote(lexed, pos):
+    """Whether token pos of a lexed query starts inside a quoted string."""
+    return lexed.quotes[pos] != (False, False)
+
+if __name__ == '__main__':
+    import doctest
+    sys.exit(doctest.testmod()[0])
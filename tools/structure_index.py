@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+An inverted index over the structure of every query in our datasets, stored
+in a SQLite file, for finding the queries that match a boolean expression
+such as:
+
+    table:FLIGHT AND table:FARE AND depth>=3
+    dataset:advising AND keyword:GROUP_BY
+    column:CITY.STATE_NAME AND NOT (keyword:ORDER_BY OR selects>1)
+
+Terms are:
+    dataset:NAME          the json file the query is from (without .json)
+    table:NAME            a table used in the query
+    column:TABLE.COLUMN   a column used in the query
+    keyword:WORD          a SQL keyword outside quotes (GROUP_BY, ORDER_BY,
+                          NOT_IN, NOT_LIKE, NOT_EXISTS, IS_NULL and IS_NOT
+                          for the two word forms)
+    selects, depth, breadth followed by =, !=, <, <=, > or >= and a number,
+                          as measured by corpus_stats.query_measures
+
+AND, OR, NOT and brackets combine terms, and terms next to each other are
+ANDed. Names are case insensitive. Matches are printed as dataset:example:sql
+ids, as in fingerprint_index.py.
+
+Usage:
+    structure_index.py --index structure.sqlite ../data/*.json
+    structure_index.py --index structure.sqlite --find "dataset:atis depth>=3 table:FLIGHT table:FARE"
+"""
+
+from __future__ import print_function
+
+import argparse
+import operator
+import re
+import sqlite3
+
+from common import SQL_RESERVED_WORDS, dataset_name, file_hash
+from corpus_stats import query_measures
+from json_stream import read_examples
+from sql_lexer import in_quote, lex
+
+COLUMN_PATTERN = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*?)(?:alias\d+)?\.([A-Za-z_][A-Za-z0-9_]*)$")
+KEYWORD_PAIRS = {('GROUP', 'BY'), ('ORDER', 'BY'), ('NOT', 'IN'), ('NOT', 'LIKE'), ('NOT', 'EXISTS'), ('IS', 'NULL'), ('IS', 'NOT')}
+MEASURES = ('selects', 'depth', 'breadth')
+KINDS = ('dataset', 'table', 'column', 'keyword')
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+TERM_PATTERN = re.compile(r"\(|\)|[^\s()]+")
+MEASURE_PATTERN = re.compile(r"^({})(!=|<=|>=|=|<|>)(\d+)$".format('|'.join(MEASURES)))
+
+def structure_keys(sql):
+    """The index keys for one query."""
+    keys = set()
+    lexed = lex(sql)
+    prev = None
+    for pos, token in enumerate(lexed.tokens):
+        if in_quote(lexed, pos):
+            prev = None
+            continue
+        word = token.rstrip('(').upper()
+        if word in SQL_RESERVED_WORDS:
+            keys.add('keyword:' + word)
+            if (prev, word) in KEYWORD_PAIRS:
+                keys.add('keyword:{}_{}'.format(prev, word))
+            prev = word
+        else:
+            prev = None
+
+        match = COLUMN_PATTERN.match(token)
+        if match is not None and not match.group(1).upper().startswith('DERIVED_'):
+            table = match.group(1).upper()
+            keys.add('table:' + table)
+            keys.add('column:{}.{}'.format(table, match.group(2).upper()))
+        elif token == 'AS' and 0 < pos < len(lexed.tokens) - 1:
+            # FROM TABLE AS TABLEalias0
+            table = lexed.tokens[pos - 1]
+            if lexed.tokens[pos + 1].startswith(table + 'alias'):
+                keys.add('table:' + table.upper())
+    try:
+        for name, value in zip(MEASURES, query_measures(sql)):
+            keys.add('{}:{}'.format(name, value))
+    except AssertionError:
+        # Brackets that corpus_stats cannot follow, so no measures
+        pass
+    return keys
+
+class StructureIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS datasets (name TEXT PRIMARY KEY, version TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS queries (id INTEGER PRIMARY KEY, dataset TEXT, example INTEGER, sql INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS postings (key TEXT, id INTEGER)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS postings_key ON postings (key, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS queries_dataset ON queries (dataset)")
+
+    def update(self, filename):
+        """Index one dataset file. Returns False if it was already up to date."""
+        name = dataset_name(filename)
+        version = file_hash(filename)
+        row = self.conn.execute("SELECT version FROM datasets WHERE name = ?", (name,)).fetchone()
+        if row is not None and row[0] == version:
+            return False
+
+        with self.conn:
+            self.conn.execute("DELETE FROM postings WHERE id IN (SELECT id FROM queries WHERE dataset = ?)", (name,))
+            self.conn.execute("DELETE FROM queries WHERE dataset = ?", (name,))
+            postings = []
+            with open(filename) as input_file:
+                for example_num, example in enumerate(read_examples(input_file)):
+                    for sql_num, sql in enumerate(example['sql']):
+                        cursor = self.conn.execute("INSERT INTO queries (dataset, example, sql) VALUES (?, ?, ?)", (name, example_num, sql_num))
+                        query_id = cursor.lastrowid
+                        postings.append(('dataset:' + name.upper(), query_id))
+                        for key in structure_keys(sql):
+                            postings.append((key, query_id))
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?)", postings)
+            self.conn.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?)", (name, version))
+        return True
+
+    def ids(self, key):
+        return {row[0] for row in self.conn.execute("SELECT id FROM postings WHERE key = ?", (key,))}
+
+    def all_ids(self):
+        return {row[0] for row in self.conn.execute("SELECT id FROM queries")}
+
+    def measure_ids(self, name, comparison, value):
+        """Ids of queries where the measure compares to value as given."""
+        ids = set()
+        prefix = name + ':'
+        # Keys are in the index in order, so this is a range scan
+        for key, in self.conn.execute("SELECT DISTINCT key FROM postings WHERE key >= ? AND key < ?", (prefix, name + ';')):
+            if COMPARISONS[comparison](int(key[len(prefix):]), value):
+                ids |= self.ids(key)
+        return ids
+
+    def find(self, expression):
+        """Ids of the queries matching a boolean expression (see above)."""
+        parser = ExpressionParser(self, TERM_PATTERN.findall(expression))
+        return parser.parse()
+
+    def positions(self, ids):
+        """The (dataset, example, sql) for each id, sorted."""
+        positions = []
+        ids = sorted(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            positions.extend(self.conn.execute("SELECT dataset, example, sql FROM queries WHERE id IN ({})".format(','.join('?' * len(chunk))), chunk))
+        return sorted(positions)
+
+    def close(self):
+        self.conn.close()
+
+class ExpressionParser:
+    """Recursive descent over: expr = conj (OR conj)*, conj = unary (AND? unary)*,
+    unary = NOT unary | ( expr ) | term."""
+    def __init__(self, index, terms):
+        self.index = index
+        self.terms = terms
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.terms):
+            return self.terms[self.pos]
+        return None
+
+    def take(self):
+        term = self.peek()
+        self.pos += 1
+        return term
+
+    def parse(self):
+        ids = self.expr()
+        if self.peek() is not None:
+            raise ValueError("Unexpected '{}' in query".format(self.peek()))
+        return ids
+
+    def expr(self):
+        ids = self.conj()
+        while self.peek() is not None and self.peek().upper() == 'OR':
+            self.take()
+            ids = ids | self.conj()
+        return ids
+
+    def conj(self):
+        ids = self.unary()
+        while self.peek() is not None and self.peek() != ')' and self.peek().upper() != 'OR':
+            if self.peek().upper() == 'AND':
+                self.take()
+            ids = ids & self.unary()
+        return ids
+
+    def unary(self):
+        term = self.take()
+        if term is None:
+            raise ValueError("Query ends too soon")
+        if term.upper() == 'NOT':
+            return self.index.all_ids() - self.unary()
+        if term == '(':
+            ids = self.expr()
+            if self.take() != ')':
+                raise ValueError("Missing ')' in query")
+            return ids
+        match = MEASURE_PATTERN.match(term.lower())
+        if match is not None:
+            return self.index.measure_ids(match.group(1), match.group(2), int(match.group(3)))
+        if ':' not in term:
+            raise ValueError("Unknown term '{}', expected e.g. table:NAME".format(term))
+        kind, value = term.split(':', 1)
+        kind = kind.lower()
+        if kind in MEASURES:
+            if not value.isdigit():
+                raise ValueError("Expected a number in '{}'".format(term))
+            return self.index.measure_ids(kind, '=', int(value))
+        if kind not in KINDS:
+            raise ValueError("Unknown term '{}', expected e.g. table:NAME".format(term))
+        return self.index.ids('{}:{}'.format(kind, value.upper()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the structure of queries (tables, columns, keywords, depth, ...) for boolean search.')
+    parser.add_argument('datasets', help='Json dataset files to add or update.', nargs='*')
+    parser.add_argument('--index', help='SQLite file holding the index.', required=True)
+    parser.add_argument('--find', help='Print the ids of queries matching this expression.', action='append', default=[])
+    parser.add_argument('--count', help='With --find, only print the number of matches.', action='store_true')
+    args = parser.parse_args()
+
+    index = StructureIndex(args.index)
+    for filename in args.datasets:
+        if index.update(filename):
+            print("Indexed", dataset_name(filename))
+        else:
+            print("Unchanged", dataset_name(filename))
+
+    for expression in args.find:
+        try:
+            ids = index.find(expression)
+        except ValueError as error:
+            parser.error("{}: {}".format(expression, error))
+        if args.count:
+            print(expression, len(ids))
+        else:
+            print(expression)
+            print("   ", ' '.join("{}:{}:{}".format(*position) for position in index.positions(ids)))
+    index.close()
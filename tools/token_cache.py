@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Writes the questions and SQL of our datasets as integer token ids, so that
+training can load them directly instead of re-tokenising text every run.
+
+For each dataset and split, and for each of question and sql, two NumPy
+arrays are saved:
+    DATASET.SPLIT.FIELD.ids.npy      every token id, one example after another
+    DATASET.SPLIT.FIELD.offsets.npy  where each example starts in ids (plus
+                                     the total length at the end)
+They are loaded with mmap_mode='r', so nothing is copied until it is used.
+All datasets share one vocabulary, vocab.txt, with the token for each id on
+its own line (0 is <pad> and 1 is <unk>), and manifest.json records the
+number of examples in each split and the settings used.
+
+SQL is tokenised with tokenise_sql.tokenise and questions are split on
+whitespace. Variables are filled in, as in json_to_flat.py, unless
+--keep-vars is given.
+
+NumPy is only needed to save and load the arrays.
+
+Usage:
+    token_cache.py --output tokens ../data/*.json
+    token_cache.py --output tokens --vocab tokens/vocab.txt ../data/geography.json
+
+    questions = load_field("tokens", "geography", "train", "question")
+    questions[0]  # array of ids for the first question
+"""
+
+from __future__ import print_function
+
+import argparse
+import array
+import collections
+import json
+import os
+
+from common import dataset_name, fill_variables
+from json_stream import read_examples
+from tokenise_sql import tokenise
+
+PAD = '<pad>'
+UNKNOWN = '<unk>'
+FIELDS = ['question', 'sql']
+
+def require_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("token_cache.py needs NumPy to save and load token arrays (pip install numpy)")
+    return numpy
+
+def example_tokens(example, keep_vars=False, query_split=False, process_sentence=None):
+    """Yield (split, question tokens, sql tokens) for each sentence.
+    process_sentence, if given, is applied to each question first."""
+    sql = example['sql'][0]
+    for sentence in example['sentences']:
+        text = sentence['text']
+        query = sql
+        if not keep_vars:
+            text = fill_variables(text, sentence, example['variables'])
+            query = fill_variables(sql, sentence, example['variables'])
+        if process_sentence is not None:
+            text = process_sentence(text)
+        split = example['query-split'] if query_split else sentence['question-split']
+        yield split, text.split(), tokenise(query).split()
+
+def read_dataset(filename, keep_vars=False, query_split=False, process_sentence=None):
+    """A map from each split to its list of (question tokens, sql tokens)."""
+    splits = collections.OrderedDict()
+    with open(filename) as data_file:
+        for example in read_examples(data_file):
+            for split, question, sql in example_tokens(example, keep_vars, query_split, process_sentence):
+                splits.setdefault(split, []).append((question, sql))
+    return splits
+
+def build_vocab(datasets):
+    """Tokens from all datasets, most frequent first."""
+    counts = collections.Counter()
+    for splits in datasets.values():
+        for pairs in splits.values():
+            for question, sql in pairs:
+                counts.update(question)
+                counts.update(sql)
+    return [PAD, UNKNOWN] + sorted(counts, key=lambda token: (-counts[token], token))
+
+def read_vocab(filename):
+    with open(filename) as vocab_file:
+        return [line.rstrip('\n') for line in vocab_file]
+
+def write_vocab(filename, vocab):
+    with open(filename, 'w') as vocab_file:
+        for token in vocab:
+            print(token, file=vocab_file)
+
+def encode(sequences, token_ids):
+    """Flat ids and offsets for a list of token lists, as arrays."""
+    unknown = token_ids[UNKNOWN]
+    ids = array.array('i')
+    offsets = array.array('q', [0])
+    for tokens in sequences:
+        ids.extend(token_ids.get(token, unknown) for token in tokens)
+        offsets.append(len(ids))
+    return ids, offsets
+
+def save_array(numpy, filename, values, dtype):
+    tmp_name = filename + '.tmp'
+    with open(tmp_name, 'wb') as out_file:
+        numpy.save(out_file, numpy.frombuffer(values, dtype=dtype) if len(values) > 0 else numpy.zeros(0, dtype=dtype))
+    os.replace(tmp_name, filename)
+
+def field_path(directory, dataset, split, field, kind):
+    return os.path.join(directory, "{}.{}.{}.{}.npy".format(dataset, split, field, kind))
+
+def write_cache(directory, datasets, vocab, settings):
+    numpy = require_numpy()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    token_ids = {token: number for number, token in enumerate(vocab)}
+    manifest = {'settings': settings, 'vocab_size': len(vocab), 'datasets': {}}
+    for dataset, splits in datasets.items():
+        manifest['datasets'][dataset] = {}
+        for split, pairs in splits.items():
+            manifest['datasets'][dataset][split] = len(pairs)
+            for position, field in enumerate(FIELDS):
+                ids, offsets = encode([pair[position] for pair in pairs], token_ids)
+                save_array(numpy, field_path(directory, dataset, split, field, 'ids'), ids, numpy.int32)
+                save_array(numpy, field_path(directory, dataset, split, field, 'offsets'), offsets, numpy.int64)
+    write_vocab(os.path.join(directory, 'vocab.txt'), vocab)
+    with open(os.path.join(directory, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    return manifest
+
+class TokenArrays:
+    """The encoded examples of one field of one split, indexed by example."""
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, number):
+        return self.ids[self.offsets[number]:self.offsets[number + 1]]
+
+def load_field(directory, dataset, split, field):
+    """Memory map the ids of field ('question' or 'sql') for a split."""
+    numpy = require_numpy()
+    ids = numpy.load(field_path(directory, dataset, split, field, 'ids'), mmap_mode='r')
+    offsets = numpy.load(field_path(directory, dataset, split, field, 'offsets'), mmap_mode='r')
+    return TokenArrays(ids, offsets)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Save the questions and SQL of datasets as memory mappable arrays of token ids.')
+    parser.add_argument('datasets', help='Json dataset files.', nargs='+')
+    parser.add_argument('--output', help='Directory to write the arrays, vocab.txt and manifest.json to.', required=True)
+    parser.add_argument('--vocab', help='Use this vocabulary (one token per line) instead of building one.')
+    parser.add_argument('--keep-vars', help='Do not replace variables with values.', action='store_true')
+    parser.add_argument('--query-split', help='Split based on queries, not questions.', action='store_true')
+    args = parser.parse_args()
+
+    # Check for NumPy before doing any work
+    try:
+        require_numpy()
+    except ImportError as error:
+        parser.error(str(error))
+    datasets = collections.OrderedDict()
+    for filename in args.datasets:
+        datasets[dataset_name(filename)] = read_dataset(filename, args.keep_vars, args.query_split)
+    if args.vocab is not None:
+        vocab = read_vocab(args.vocab)
+        if vocab[:2] != [PAD, UNKNOWN]:
+            parser.error("{} must start with {} and {}".format(args.vocab, PAD, UNKNOWN))
+    else:
+        vocab = build_vocab(datasets)
+    settings = {'keep_vars': args.keep_vars, 'query_split': args.query_split}
+    manifest = write_cache(args.output, datasets, vocab, settings)
+    for dataset in sorted(manifest['datasets']):
+        splits = manifest['datasets'][dataset]
+        print(dataset, ' '.join("{} {}".format(split, splits[split]) for split in sorted(splits)))
+    print(manifest['vocab_size'], "tokens in the vocabulary")
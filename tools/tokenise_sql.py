@@ -4,16 +4,21 @@ from __future__ import print_function
 
 import json
 import argparse
+import functools
+import multiprocessing
+import os
 import re
 import sys
+import zlib
 
-def update_quotes(token, in_squote, in_dquote):
-    for char in token:
-        if char == "'" and (not in_dquote):
-            in_squote = not in_squote
-        elif char == '"' and (not in_squote):
-            in_dquote = not in_dquote
-    return in_squote, in_dquote
+from json_stream import read_examples, write_examples
+from sql_lexer import lex, update_token_quotes
+
+ALIAS_PATTERN = re.compile(r"(?P<table>[A-Z_]+)(?P<alias>alias\d+)")
+SQL_FIELDS = ['sql', 'sql-with-vars']
+
+def has_quote(text):
+    return "'" in text or '"' in text
 
 def tokenise(query):
     """Adjust a query to have quotes and braces as tokens.
@@ -36,8 +41,16 @@ def tokenise(query):
     'test TEST alias0'
     """
     tokens = []
+    lexed = lex(query)
+    # Quote state has always been updated using only what is left of a token
+    # after splitting off a table name or alias. If a quote is in the part
+    # split off, the lexer's state no longer applies, so we track it here.
+    quotes = lexed.quotes
     in_squote, in_dquote = False, False
-    for token in query.split():
+    for pos, token in enumerate(lexed.tokens):
+        if quotes is not None:
+            in_squote, in_dquote = quotes[pos]
+
         # Handle prefixes
         if not (in_squote or in_dquote):
             if token.startswith("'%") or token.startswith('"%'):
@@ -65,13 +78,17 @@ def tokenise(query):
                     tokens.append(table)
                 tokens.append('.')
                 token = field
+                if has_quote(table):
+                    quotes = None
 
         # Handle aliases without field name.
         if not (in_squote or in_dquote):
-            m = re.search(r"(?P<table>[A-Z_]+)(?P<alias>alias\d+)", token)
+            m = ALIAS_PATTERN.search(token)
             if m:
                 tokens.append(m.group("table"))
                 tokens.append(m.group("alias"))
+                if has_quote(token):
+                    quotes = None
                 continue
 
         # Handle suffixes
@@ -88,7 +105,8 @@ def tokenise(query):
             tokens.append(token[-1])
         else:
             tokens.append(token)
-        in_squote, in_dquote = update_quotes(token, in_squote, in_dquote)
+        if quotes is None:
+            in_squote, in_dquote = update_token_quotes(token, in_squote, in_dquote)
 
     return ' '.join(tokens)
 
@@ -117,8 +135,8 @@ def untokenise(query):
     'test TESTalias0 test'
     """
     tokens = []
-    in_squote, in_dquote = False, False
-    for token in query.split():
+    lexed = lex(query)
+    for token, (in_squote, in_dquote) in zip(lexed.tokens, lexed.quotes):
         if in_squote and (token in ["%'", "'"] or tokens[-1] in ["'%", "'"]):
             tokens[-1] += token
         elif in_dquote and (token in ['%"', '"'] or tokens[-1] in ['"%', '"']):
@@ -131,15 +149,67 @@ def untokenise(query):
             tokens[-1] += token
         else:
             tokens.append(token)
-        in_squote, in_dquote = update_quotes(token, in_squote, in_dquote)
 
     return ' '.join(tokens)
 
+def sampled(query, rate):
+    # Based on a hash of the query, so the sample does not depend on which
+    # process handles it
+    return zlib.crc32(query.encode('utf-8')) % 10000 < rate * 10000
+
+def convert_example(example, convert, inverse=None, check_rate=0.0):
+    """Apply convert to every query in the 'sql' list and 'sql-with-vars' of
+    an example. Returns the example and a list of (query, round trip) for
+    sampled queries where inverse(convert(query)) != query."""
+    failures = []
+    def apply(query):
+        converted = convert(query)
+        if inverse is not None and sampled(query, check_rate):
+            back = inverse(converted)
+            if back != query:
+                failures.append((query, back))
+        return converted
+
+    for field in SQL_FIELDS:
+        if field not in example:
+            continue
+        value = example[field]
+        if isinstance(value, list):
+            example[field] = [apply(query) for query in value]
+        elif len(value) > 0:
+            example[field] = apply(value)
+    return example, failures
+
+def convert_stream(examples, converter, failures, jobs=1, chunksize=64):
+    """Yield each converted example, in order, adding round trip failures to
+    the failures list."""
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(converter, examples, chunksize)
+    else:
+        results = (converter(example) for example in examples)
+    for example, failed in results:
+        failures.extend(failed)
+        yield example
+    if jobs > 1:
+        pool.close()
+        pool.join()
+
+def read_jsonl(input_file):
+    for line in input_file:
+        if len(line.strip()) > 0:
+            yield json.loads(line)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Modifies SQL to be a more convenient set of tokens - though not executable anymore.')
     parser.add_argument('--tokenise', help='Convert to tokens.', action='store_true')
     parser.add_argument('--untokenise', help='Return to normal.', action='store_true')
     parser.add_argument('--test', help='Run a series of tests.', action='store_true')
+    parser.add_argument('--jsonl', help='Read one example per line from stdin and write one per line to stdout.', action='store_true')
+    parser.add_argument('--output-dir', help='Directory to write converted dataset files to.')
+    parser.add_argument('--jobs', help='Number of worker processes.', type=int, default=1)
+    parser.add_argument('--check-rate', help='Fraction of queries to check are unchanged by converting back.', type=float, default=0.01)
+    parser.add_argument('datasets', help='Json dataset files to convert (written to --output-dir). Without these or --jsonl, one example is read from stdin.', nargs='*')
     args = parser.parse_args()
 
     # Test
@@ -148,19 +218,46 @@ if __name__ == '__main__':
         doctest.testmod()
         sys.exit(0)
 
-    # Read
-    data = json.load(sys.stdin)
+    convert, inverse = None, None
+    if args.tokenise:
+        convert, inverse = tokenise, untokenise
+    elif args.untokenise:
+        convert, inverse = untokenise, tokenise
 
-    # Process
-    nqueries = []
-    for query in data['sql']:
-        if args.tokenise:
-            nqueries.append(tokenise(query))
-        elif args.untokenise:
-            nqueries.append(untokenise(query))
-        else:
-            nqueries.append(query)
-    data['sql'] = nqueries
+    if not (args.jsonl or args.datasets):
+        # Read
+        data = json.load(sys.stdin)
+
+        # Process
+        nqueries = []
+        for query in data['sql']:
+            if convert is not None:
+                nqueries.append(convert(query))
+            else:
+                nqueries.append(query)
+        data['sql'] = nqueries
+
+        # Output
+        print(json.dumps(data, indent=4, sort_keys=True))
+        sys.exit(0)
+
+    if convert is None:
+        parser.error("--tokenise or --untokenise is needed with --jsonl or dataset files")
+    converter = functools.partial(convert_example, convert=convert, inverse=inverse, check_rate=args.check_rate)
+    failures = []
+    if args.jsonl:
+        for example in convert_stream(read_jsonl(sys.stdin), converter, failures, args.jobs):
+            print(json.dumps(example, sort_keys=True))
+    for filename in args.datasets:
+        if args.output_dir is None:
+            parser.error("--output-dir is needed with dataset files")
+        output = os.path.join(args.output_dir, os.path.basename(filename))
+        if os.path.abspath(output) == os.path.abspath(filename):
+            parser.error("--output-dir must not be the directory {} is in".format(filename))
+        with open(filename) as input_file, open(output, 'w') as output_file:
+            write_examples(convert_stream(read_examples(input_file), converter, failures, args.jobs), output_file)
 
-    # Output
-    print(json.dumps(data, indent=4, sort_keys=True))
+    for query, back in failures:
+        print("Round trip changed:\n    {}\n    {}".format(query, back), file=sys.stderr)
+    if args.check_rate > 0:
+        print("{} sampled queries did not survive a round trip".format(len(failures)), file=sys.stderr)
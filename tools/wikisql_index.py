@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+An index over data/wikisql.json.bz2 so that single examples, or the examples
+of one split, can be read without decompressing and loading the whole file.
+
+The index (stored next to the data as wikisql.json.bz2.index) records where
+each bz2 stream starts in the compressed file and, for every example, which
+stream it is in, its byte range within that stream's decompressed text, and
+the splits of its sentences.
+
+The file we distribute is a single bz2 stream, so reading one example means
+decompressing from the start of the file up to it. --restream rewrites the
+file as a series of smaller bz2 streams, each holding a few hundred whole
+examples. Decompressed, the file is byte-for-byte the same as before (bz2
+readers, including Python's bz2 module, handle multiple streams), but a
+single example then only needs its own stream.
+
+Usage:
+    wikisql_index.py ../data/wikisql.json.bz2 --restream
+    wikisql_index.py ../data/wikisql.json.bz2 --show 10
+    wikisql_index.py ../data/wikisql.json.bz2 --count-split dev
+
+Or from Python:
+    index = WikiSQLIndex("data/wikisql.json.bz2")
+    example = index.example(10)
+    for example in index.iter_split("dev"):
+        ...
+"""
+
+from __future__ import print_function
+
+import argparse
+import bz2
+import json
+import os
+
+from common import file_hash
+from json_stream import scan_examples
+
+CHUNK_SIZE = 1 << 16
+
+def find_streams(filename):
+    """The offset and length in the file of each bz2 stream it contains, and
+    the length of its decompressed data."""
+    streams = []
+    with open(filename, 'rb') as data_file:
+        offset = 0
+        start = 0
+        size = 0
+        decompressor = bz2.BZ2Decompressor()
+        while True:
+            chunk = data_file.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            while len(chunk) > 0:
+                size += len(decompressor.decompress(chunk))
+                if decompressor.eof:
+                    used = len(chunk) - len(decompressor.unused_data)
+                    offset += used
+                    streams.append((start, offset - start, size))
+                    start = offset
+                    size = 0
+                    chunk = decompressor.unused_data
+                    decompressor = bz2.BZ2Decompressor()
+                else:
+                    offset += len(chunk)
+                    chunk = b''
+    return streams
+
+def example_splits(example):
+    splits = []
+    for sentence in example['sentences']:
+        if sentence['question-split'] not in splits:
+            splits.append(sentence['question-split'])
+    return splits
+
+def scan_file(filename):
+    """Byte offsets in the decompressed text and splits of every example."""
+    # The data is ascii, but decoding as latin-1 keeps character and byte
+    # offsets equal whatever the contents.
+    with bz2.open(filename, 'rt', encoding='latin-1') as data_file:
+        return [(start, end, example_splits(example)) for start, end, example in scan_examples(data_file)]
+
+def build_index(filename):
+    streams = find_streams(filename)
+    examples = scan_file(filename)
+
+    # Where each stream starts and ends in the decompressed text
+    bounds = []
+    total = 0
+    for _, _, size in streams:
+        bounds.append((total, total + size))
+        total += size
+
+    index_examples = []
+    stream = 0
+    for start, end, splits in examples:
+        while start >= bounds[stream][1]:
+            stream += 1
+        if end > bounds[stream][1]:
+            raise ValueError("Example spans two bz2 streams, rewrite the file with --restream")
+        base = bounds[stream][0]
+        index_examples.append([stream, start - base, end - base, splits])
+    return {
+        'source': {'size': os.path.getsize(filename), 'sha1': file_hash(filename)},
+        'streams': [[offset, length] for offset, length, _ in streams],
+        'examples': index_examples,
+    }
+
+def restream(filename, examples_per_stream=500):
+    """Rewrite filename as one bz2 stream per examples_per_stream examples."""
+    starts = [start for start, _, _ in scan_file(filename)]
+    cuts = starts[examples_per_stream::examples_per_stream]
+    tmp_name = filename + '.tmp'
+    with bz2.open(filename, 'rb') as data_file, open(tmp_name, 'wb') as out_file:
+        pos = 0
+        for cut in cuts + [None]:
+            if cut is None:
+                data = data_file.read()
+            else:
+                data = data_file.read(cut - pos)
+                pos = cut
+            out_file.write(bz2.compress(data))
+    os.replace(tmp_name, filename)
+
+class WikiSQLIndex:
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        self.index_filename = index_filename or filename + '.index'
+        self.index = None
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as index_file:
+                self.index = json.load(index_file)
+            source = self.index['source']
+            if source['size'] != os.path.getsize(filename) or source['sha1'] != file_hash(filename):
+                self.index = None
+        if self.index is None:
+            self.rebuild()
+
+    def rebuild(self):
+        self.index = build_index(self.filename)
+        tmp_name = self.index_filename + '.tmp'
+        with open(tmp_name, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_name, self.index_filename)
+
+    def __len__(self):
+        return len(self.index['examples'])
+
+    def splits(self, number):
+        return self.index['examples'][number][3]
+
+    def read_ranges(self, stream, ranges):
+        """Yield the decompressed bytes for each of the sorted (start, end)
+        ranges of one stream, decompressing only as far as needed."""
+        offset, length = self.index['streams'][stream]
+        decompressor = bz2.BZ2Decompressor()
+        buf = b''
+        buf_start = 0
+        with open(self.filename, 'rb') as data_file:
+            data_file.seek(offset)
+            remaining = length
+            for start, end in ranges:
+                while buf_start + len(buf) < end:
+                    chunk = data_file.read(min(CHUNK_SIZE, remaining))
+                    remaining -= len(chunk)
+                    if len(chunk) == 0:
+                        raise ValueError("Index does not match " + self.filename)
+                    more = decompressor.decompress(chunk)
+                    # Only keep what is needed for this range and later ones
+                    if buf_start + len(buf) + len(more) <= start:
+                        buf_start += len(buf) + len(more)
+                        buf = b''
+                    else:
+                        buf += more
+                if start > buf_start:
+                    buf = buf[start - buf_start:]
+                    buf_start = start
+                yield buf[:end - start]
+
+    def example(self, number):
+        stream, start, end, _ = self.index['examples'][number]
+        for data in self.read_ranges(stream, [(start, end)]):
+            return json.loads(data.decode('utf-8'))
+
+    def iter_examples(self, numbers):
+        """Yield the examples with the given numbers, in increasing order."""
+        by_stream = {}
+        for number in sorted(set(numbers)):
+            stream, start, end, _ = self.index['examples'][number]
+            by_stream.setdefault(stream, []).append((start, end))
+        for stream in sorted(by_stream):
+            for data in self.read_ranges(stream, by_stream[stream]):
+                yield json.loads(data.decode('utf-8'))
+
+    def iter_split(self, split):
+        """Yield the examples with sentences in split, keeping only those
+        sentences."""
+        numbers = [number for number, entry in enumerate(self.index['examples']) if split in entry[3]]
+        for example in self.iter_examples(numbers):
+            example['sentences'] = [sentence for sentence in example['sentences'] if sentence['question-split'] == split]
+            yield example
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds an index for random access to the WikiSQL data.')
+    parser.add_argument('data', help='The bz2 compressed json file.')
+    parser.add_argument('--index', help='Index file (default is the data file name with .index added).')
+    parser.add_argument('--restream', help='Rewrite the data as many small bz2 streams, so examples can be read without decompressing everything before them.', action='store_true')
+    parser.add_argument('--examples-per-stream', help='For --restream, the number of examples in each stream.', type=int, default=500)
+    parser.add_argument('--show', help='Print this example.', type=int, action='append', default=[])
+    parser.add_argument('--count-split', help='Print the number of examples and sentences in this split.')
+    args = parser.parse_args()
+
+    if args.restream:
+        restream(args.data, args.examples_per_stream)
+    index = WikiSQLIndex(args.data, args.index)
+    print(len(index), "examples in", len(index.index['streams']), "bz2 streams")
+    for number in args.show:
+        print(json.dumps(index.example(number), indent=4, sort_keys=True))
+    if args.count_split is not None:
+        examples = 0
+        sentences = 0
+        for example in index.iter_split(args.count_split):
+            examples += 1
+            sentences += len(example['sentences'])
+        print(args.count_split, examples, "examples", sentences, "sentences")